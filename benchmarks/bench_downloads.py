@@ -0,0 +1,321 @@
+"""
+Offline download benchmarks against the local mock server.
+
+Measures throughput, p50/p99 latency and peak RSS for:
+    - TokybookScraper.download_chapter
+    - download_chapters_session
+    - download_and_tag_audiobook (direct MP3 site and Tokybook)
+
+Each scenario runs in a fresh process so its peak RSS is isolated.
+
+Usage:
+    python -m benchmarks.bench_downloads --latency 0.02 --bandwidth 5000000
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from rich.console import Console
+from rich.table import Table
+
+from benchmarks.mock_server import MockConfig, MockServer
+
+try:
+    import resource
+except ImportError:  # POSIX only: peak RSS isn't reported on Windows
+    resource = None
+
+console = Console()
+
+
+class NullProgress:
+    """Stands in for rich.progress.Progress when calling downloader internals directly."""
+
+    def log(self, *args, **kwargs):
+        pass
+
+    def add_task(self, *args, **kwargs):
+        return 0
+
+    def update(self, *args, **kwargs):
+        pass
+
+    def advance(self, *args, **kwargs):
+        pass
+
+    def remove_task(self, *args, **kwargs):
+        pass
+
+
+@contextlib.contextmanager
+def tokybook_pointed_at(base_url):
+    """Temporarily redirects TokybookScraper to the mock server."""
+    from scrapers.tokybook import TokybookScraper
+
+    saved = TokybookScraper.BASE_URL, TokybookScraper.FULL_AUDIO_BASE
+    TokybookScraper.BASE_URL = base_url
+    TokybookScraper.FULL_AUDIO_BASE = f"{base_url}{TokybookScraper.AUDIO_API_PATH}"
+    try:
+        yield TokybookScraper
+    finally:
+        TokybookScraper.BASE_URL, TokybookScraper.FULL_AUDIO_BASE = saved
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+# --- Scenarios (run inside a child process) ---
+
+
+def bench_tokybook_chapter(base_url, workdir, iterations):
+    with tokybook_pointed_at(base_url) as scraper_cls:
+        book_data = scraper_cls().fetch_book_data(f"{base_url}/post/bench-book")
+        timings, total_bytes, failures = [], 0, 0
+        for n in range(iterations):
+            chapter = book_data["chapters"][n % len(book_data["chapters"])]
+            output = os.path.join(workdir, f"chapter-{n}.ts")
+            start = time.perf_counter()
+            try:
+                # A stream, as main.py passes its RemuxStream
+                with open(output, "wb") as f:
+                    scraper_cls.download_chapter(chapter, book_data, f, NullProgress())
+            except Exception:
+                failures += 1
+                continue
+            timings.append(time.perf_counter() - start)
+            total_bytes += os.path.getsize(output)
+            os.remove(output)
+    return timings, total_bytes, failures
+
+
+def bench_session_download(base_url, workdir, iterations):
+    import requests
+    from main import download_chapters_session
+
+    session = requests.Session()
+    timings, total_bytes, failures = [], 0, 0
+    for n in range(iterations):
+        output = os.path.join(workdir, f"chapter-{n}.mp3")
+        start = time.perf_counter()
+        try:
+            download_chapters_session(
+                session,
+                f"{base_url}/audio/bench-book/{n + 1}.mp3",
+                output,
+                {},
+                f"Chapter {n + 1:03d}",
+                NullProgress(),
+                max_attempts=1,
+                open_on_forbidden=False,
+            )
+        except Exception:
+            failures += 1
+            continue
+        timings.append(time.perf_counter() - start)
+        total_bytes += os.path.getsize(output)
+        os.remove(output)
+    return timings, total_bytes, failures
+
+
+def _bench_full_pipeline(book_data, workdir, iterations):
+    import main
+
+    timings, total_bytes, failures = [], 0, 0
+    old_cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for _ in range(iterations):
+            shutil.rmtree("Audiobooks", ignore_errors=True)
+            start = time.perf_counter()
+            try:
+                main.download_and_tag_audiobook(dict(book_data))
+            except Exception:
+                failures += 1
+                continue
+            timings.append(time.perf_counter() - start)
+            book_dir = os.path.join("Audiobooks", book_data["title"])
+            if os.path.isdir(book_dir):
+                total_bytes += sum(
+                    os.path.getsize(os.path.join(book_dir, name))
+                    for name in os.listdir(book_dir)
+                )
+    finally:
+        os.chdir(old_cwd)
+    return timings, total_bytes, failures
+
+
+def bench_full_direct_mp3(base_url, workdir, iterations):
+    from scrapers.fulllengthaudiobooks import FulllengthAudiobooksScraper
+
+    book_data = FulllengthAudiobooksScraper().fetch_book_data(
+        f"{base_url}/book/bench-book/"
+    )
+    return _bench_full_pipeline(book_data, workdir, iterations)
+
+
+def bench_full_tokybook(base_url, workdir, iterations):
+    with tokybook_pointed_at(base_url) as scraper_cls:
+        book_data = scraper_cls().fetch_book_data(f"{base_url}/post/bench-book")
+        book_data["title"] = "Tokybook Bench"
+        return _bench_full_pipeline(book_data, workdir, iterations)
+
+
+SCENARIOS = {
+    "tokybook.download_chapter": (bench_tokybook_chapter, False),
+    "download_chapters_session": (bench_session_download, False),
+    "download_and_tag_audiobook:mp3": (bench_full_direct_mp3, False),
+    "download_and_tag_audiobook:tokybook": (bench_full_tokybook, True),
+}
+
+
+def _run_scenario(name, base_url, iterations, queue):
+    func, _ = SCENARIOS[name]
+    workdir = tempfile.mkdtemp(prefix="audiobook-bench-")
+    try:
+        # Keep the downloader's own console output out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            timings, total_bytes, failures = func(base_url, workdir, iterations)
+            wall = time.perf_counter() - start
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    peak_rss = None
+    if resource is not None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            peak_rss *= 1024  # ru_maxrss is in KiB on Linux, bytes on macOS
+    queue.put(
+        {
+            "scenario": name,
+            "iterations": iterations,
+            "failures": failures,
+            "bytes": total_bytes,
+            "wall_seconds": wall,
+            "throughput_mib_s": total_bytes / wall / 2**20 if wall else 0.0,
+            "p50_seconds": percentile(timings, 50),
+            "p99_seconds": percentile(timings, 99),
+            "mean_seconds": statistics.fmean(timings) if timings else 0.0,
+            "peak_rss_mib": peak_rss / 2**20 if peak_rss is not None else None,
+        }
+    )
+
+
+def run_benchmarks(config, scenarios, iterations):
+    """Runs the given scenarios against a fresh mock server and returns the result rows."""
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    with MockServer(config) as server:
+        for name in scenarios:
+            server.requests.clear()
+            queue = ctx.Queue()
+            proc = ctx.Process(
+                target=_run_scenario, args=(name, server.base_url, iterations, queue)
+            )
+            proc.start()
+            proc.join()
+            if proc.exitcode != 0:
+                console.print(f"[red]Scenario {name} crashed ({proc.exitcode})[/red]")
+                continue
+            row = queue.get()
+            request_times = [seconds for _, seconds, _ in server.requests]
+            row["requests"] = len(request_times)
+            row["server_p50_seconds"] = percentile(request_times, 50)
+            row["server_p99_seconds"] = percentile(request_times, 99)
+            results.append(row)
+    return results
+
+
+def print_results(results):
+    table = Table(title="Download Benchmarks", show_lines=True)
+    table.add_column("Scenario", style="bold cyan")
+    table.add_column("OK/Total", justify="right")
+    table.add_column("MiB/s", justify="right")
+    table.add_column("p50 (s)", justify="right")
+    table.add_column("p99 (s)", justify="right")
+    table.add_column("Req p50/p99 (ms)", justify="right")
+    table.add_column("Peak RSS (MiB)", justify="right")
+    for row in results:
+        table.add_row(
+            row["scenario"],
+            f"{row['iterations'] - row['failures']}/{row['iterations']}",
+            f"{row['throughput_mib_s']:.2f}",
+            f"{row['p50_seconds']:.3f}",
+            f"{row['p99_seconds']:.3f}",
+            f"{row['server_p50_seconds'] * 1000:.1f}/{row['server_p99_seconds'] * 1000:.1f}",
+            f"{row['peak_rss_mib']:.1f}" if row["peak_rss_mib"] is not None else "n/a",
+        )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline download benchmarks.")
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--chapters", type=int, default=5)
+    parser.add_argument("--segments", type=int, default=20)
+    parser.add_argument("--segment-size", type=int, default=64 * 1024)
+    parser.add_argument("--mp3-size", type=int, default=1024 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--bandwidth", type=int, default=None, help="bytes/sec")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--token-ttl", type=float, default=None, help="Tokybook stream token lifetime"
+    )
+    parser.add_argument(
+        "--stall-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of GETs that stall for 2s before answering",
+    )
+    parser.add_argument(
+        "--hls",
+        choices=["plain", "master", "aes", "byterange"],
+        default="plain",
+        help="Tokybook playlist flavour served by the mock server",
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="Run only this scenario (repeatable).",
+    )
+    parser.add_argument("--json", help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    config = MockConfig(
+        chapters=args.chapters,
+        segments_per_chapter=args.segments,
+        segment_size=args.segment_size,
+        mp3_size=args.mp3_size,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        token_ttl=args.token_ttl,
+        stall_rate=args.stall_rate,
+        hls=args.hls,
+    )
+    scenarios = args.scenario or list(SCENARIOS)
+    if shutil.which("ffmpeg") is None:
+        skipped = [name for name in scenarios if SCENARIOS[name][1]]
+        for name in skipped:
+            console.print(f"[yellow]Skipping {name}: ffmpeg is not installed[/yellow]")
+        scenarios = [name for name in scenarios if name not in skipped]
+
+    results = run_benchmarks(config, scenarios, args.iterations)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,157 @@
+"""
+Micro-benchmarks for the scrapers' parse_book_data methods.
+
+Times parsing of generated real-size pages (12, 60 and 240 chapters) for
+every site, plus any saved pages from --corpus. With --baseline the run
+fails if any fixture got slower than the allowed tolerance.
+
+Usage:
+    python -m benchmarks.bench_parsers --save-baseline parsers.json
+    python -m benchmarks.bench_parsers --baseline parsers.json --tolerance 0.25
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from rich.console import Console
+from rich.table import Table
+
+from benchmarks.fixtures import iter_corpus
+from scrapers.bigaudiobooks import BigAudiobooksScraper
+from scrapers.fulllengthaudiobooks import FulllengthAudiobooksScraper
+from scrapers.goldenaudiobook import GoldenAudiobookScraper
+from scrapers.hdaudiobooks import HDAudiobooksScraper
+from scrapers.tokybook import TokybookScraper
+from scrapers.zaudiobooks import ZaudiobooksScraper
+
+console = Console()
+
+BOOK_URLS = {
+    "tokybook.com": "https://tokybook.com/post/fixture-book",
+    "goldenaudiobook.net": "https://goldenaudiobook.net/fixture-book/",
+    "zaudiobooks.com": "https://zaudiobooks.com/fixture-book/",
+    "fulllengthaudiobooks.net": "https://fulllengthaudiobooks.net/fixture-book/",
+    "hdaudiobooks.net": "https://hdaudiobooks.net/fixture-book/",
+    "bigaudiobooks.net": "https://bigaudiobooks.net/fixture-book/",
+}
+
+
+def make_parser(site, page):
+    """Returns a zero-argument callable that parses `page` with the site's scraper."""
+    if site == "tokybook.com":
+        data = json.loads(page)
+        scraper = TokybookScraper()
+        return lambda: scraper.parse_book_data(data["details"], data["playlist"])
+    scraper = {
+        "goldenaudiobook.net": GoldenAudiobookScraper,
+        "zaudiobooks.com": ZaudiobooksScraper,
+        "fulllengthaudiobooks.net": FulllengthAudiobooksScraper,
+        "hdaudiobooks.net": HDAudiobooksScraper,
+        "bigaudiobooks.net": BigAudiobooksScraper,
+    }[site]()
+    return lambda: scraper.parse_book_data(page, BOOK_URLS[site])
+
+
+def time_parser(parse, repeat, min_time=0.2):
+    """Returns (median seconds per call, result of the last call)."""
+    result = parse()
+    # Calibrate so each sample lasts at least min_time / repeat
+    loops, start = 1, time.perf_counter()
+    parse()
+    single = max(time.perf_counter() - start, 1e-6)
+    loops = max(1, int(min_time / repeat / single))
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(loops):
+            parse()
+        samples.append((time.perf_counter() - start) / loops)
+    return statistics.median(samples), result
+
+
+def run_benchmarks(corpus_dir=None, repeat=5):
+    results = []
+    for site, name, page, expected in iter_corpus(corpus_dir):
+        seconds, book_data = time_parser(make_parser(site, page), repeat)
+        chapters = len((book_data or {}).get("chapters", []))
+        if expected is not None and chapters != expected:
+            console.print(
+                f"[red]{site}/{name}: parsed {chapters} chapters, expected {expected}[/red]"
+            )
+        results.append(
+            {
+                "key": f"{site}/{name}",
+                "site": site,
+                "fixture": name,
+                "page_kib": len(page) / 1024,
+                "chapters": chapters,
+                "median_ms": seconds * 1000,
+                "us_per_chapter": seconds * 1e6 / chapters if chapters else 0.0,
+            }
+        )
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """Returns the keys of fixtures slower than baseline * (1 + tolerance)."""
+    previous = {row["key"]: row["median_ms"] for row in baseline}
+    regressions = []
+    for row in results:
+        before = previous.get(row["key"])
+        if before:
+            row["change"] = row["median_ms"] / before - 1
+            if row["change"] > tolerance:
+                regressions.append(row["key"])
+    return regressions
+
+
+def print_results(results):
+    table = Table(title="Parser Benchmarks", show_lines=False)
+    table.add_column("Site", style="bold cyan")
+    table.add_column("Fixture")
+    table.add_column("KiB", justify="right")
+    table.add_column("Chapters", justify="right")
+    table.add_column("Median (ms)", justify="right")
+    table.add_column("µs/chapter", justify="right")
+    table.add_column("vs baseline", justify="right")
+    for row in results:
+        change = row.get("change")
+        table.add_row(
+            row["site"],
+            row["fixture"],
+            f"{row['page_kib']:.0f}",
+            str(row["chapters"]),
+            f"{row['median_ms']:.2f}",
+            f"{row['us_per_chapter']:.1f}",
+            f"{change:+.0%}" if change is not None else "-",
+        )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scraper parsing micro-benchmarks.")
+    parser.add_argument("--corpus", help="Directory of saved pages (<site>/<file>).")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", help="Fail if slower than this saved run.")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--save-baseline", help="Write the results to this file.")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.corpus, args.repeat)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        console.print(
+            f"[bold red]Parsing regressions (>{args.tolerance:.0%}): {', '.join(regressions)}[/bold red]"
+        )
+        sys.exit(1)
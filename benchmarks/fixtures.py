@@ -0,0 +1,166 @@
+"""
+Generates real-size book pages for every supported site so the scrapers'
+parse_book_data methods can be exercised without the network.
+
+Pages are padded with the kind of WordPress chrome (navigation, sidebar,
+comments, inline scripts) the live sites serve, so parse times are
+representative of a real ~150-400 KB page.
+"""
+
+import json
+import os
+
+SITES = (
+    "tokybook.com",
+    "goldenaudiobook.net",
+    "zaudiobooks.com",
+    "fulllengthaudiobooks.net",
+    "hdaudiobooks.net",
+    "bigaudiobooks.net",
+)
+
+# (name, chapter count) pairs generated for every site
+CORPUS_SIZES = (("small", 12), ("medium", 60), ("large", 240))
+
+
+def _chrome(kb):
+    """Returns roughly `kb` kilobytes of typical WordPress page furniture."""
+    nav = "".join(
+        f'<li class="menu-item"><a href="https://example.com/category/{n}/">Category {n}</a></li>'
+        for n in range(40)
+    )
+    sidebar = "".join(
+        f'<div class="widget"><a href="https://example.com/book-{n}/">'
+        f'<img src="https://example.com/wp-content/uploads/cover-{n}.jpg" alt="Book {n}" /></a>'
+        f"<p>Another audiobook you might enjoy, number {n}.</p></div>"
+        for n in range(30)
+    )
+    comment = (
+        '<li class="comment"><div class="comment-body"><p>Thanks for uploading this, '
+        "the narration is great and the chapters are all in order.</p></div></li>"
+    )
+    script = (
+        "<script>var wpData = {"
+        + ",".join(f'"k{n}": {n}' for n in range(200))
+        + "};</script>"
+    )
+    head = f"<header><nav><ul>{nav}</ul></nav></header>{script}"
+    filler = f"<aside>{sidebar}</aside><ol class='comments'>"
+    body = head + filler
+    while len(body) < kb * 1024:
+        body += comment
+    return body + "</ol>"
+
+
+def _audio_tags(site, chapters, wrapper=""):
+    tags = []
+    for n in range(1, chapters + 1):
+        src = f"https://files.{site}/audio/book/{n:03d}.mp3?_={n}"
+        tags.append(
+            f'<p>Chapter {n}</p><audio class="wp-audio-shortcode" preload="none" '
+            f'style="width: 100%;" controls="controls">'
+            f'<source type="audio/mpeg" src="{src}" />'
+            f'<a href="{src}">{src}</a></audio>'
+        )
+    return "".join(tags)
+
+
+def build_page(site, chapters, chrome_kb=150):
+    """Returns the page body for `site` as served to fetch_book_data."""
+    chrome = _chrome(chrome_kb)
+    cover = (
+        f'<figure class="wp-caption"><img src="https://{site}/cover.jpg" /></figure>'
+    )
+    audio = _audio_tags(site, chapters)
+
+    if site == "tokybook.com":
+        details = {
+            "title": "Fixture Book",
+            "audioBookId": "FIXTURE",
+            "postDetailToken": "token",
+            "authors": [{"name": "Fixture Author"}],
+            "narrators": [{"name": "Fixture Narrator"}],
+            "year": 2020,
+            "coverImage": "https://tokybook.com/cover.jpg",
+            "description": "x" * 4000,
+        }
+        playlist = {
+            "streamToken": "stream",
+            "tracks": [
+                {"src": f"FIXTURE/Chapter {n:03d}.m3u8", "duration": 1234.5}
+                for n in range(1, chapters + 1)
+            ],
+        }
+        return json.dumps({"details": details, "playlist": playlist})
+    if site == "goldenaudiobook.net":
+        body = (
+            '<h1 class="title-page">Fixture Author – Fixture Book Audiobook</h1>'
+            '<time class="entry-date" datetime="2020-01-01T00:00:00+00:00"></time>'
+            f"{cover}<div class='entry'>{audio}</div>"
+        )
+    elif site == "zaudiobooks.com":
+        tracks = [
+            "tracks = [",
+            "{",
+            '"track": 1,',
+            'name: "welcome",',
+            'chapter_link_dropbox: "welcome.mp3",',
+            "},",
+        ]
+        for n in range(1, chapters + 1):
+            tracks.append("{")
+            tracks.append(f'"track": {n + 1},')
+            tracks.append(f'name: "Chapter {n}",')
+            tracks.append(f'chapter_link_dropbox: "fixture\\/{n:03d}.mp3",')
+            tracks.append("},")
+        tracks.append("],")
+        script = "<script>\n" + "\n".join(tracks) + "\n</script>"
+        body = (
+            '<meta property="og:image" content="https://zaudiobooks.com/cover.jpg" />'
+            '<h1 class="page-title">Fixture Book</h1>'
+            '<div class="inner-article-content"><img src="https://zaudiobooks.com/cover.jpg" /></div>'
+            f"\n{script}\n"
+        )
+    elif site == "fulllengthaudiobooks.net":
+        body = (
+            '<h1 class="entry-title post-title">Fixture Author - Fixture Book Audiobook Free</h1>'
+            f"<div class='entry'>{cover}{audio}</div>"
+        )
+    elif site == "hdaudiobooks.net":
+        body = (
+            '<h1 itemprop="headline">Fixture Book – Fixture Author (AUDIOBOOK)</h1>'
+            '<img itemprop="image" src="https://hdaudiobooks.net/cover.jpg" />'
+            f"<div class='entry'>{audio}</div>"
+        )
+    elif site == "bigaudiobooks.net":
+        body = (
+            '<h1 class="title-page">Fixture Author - Fixture Book Audiobook</h1>'
+            f"<div class='post-single'>{cover}{audio}</div>"
+        )
+    else:
+        raise ValueError(f"Unknown site: {site}")
+    return f"<html><head><title>Fixture</title></head><body>{chrome[: len(chrome) // 2]}{body}{chrome[len(chrome) // 2 :]}</body></html>"
+
+
+def iter_corpus(corpus_dir=None):
+    """
+    Yields (site, name, page, expected_chapters) for every fixture.
+
+    Generated pages are always included. If `corpus_dir` is given, saved
+    pages laid out as <corpus_dir>/<site>/<name>.html (or .json for
+    Tokybook, with "details" and "playlist" keys) are added with
+    expected_chapters=None.
+    """
+    for site in SITES:
+        for name, chapters in CORPUS_SIZES:
+            yield site, f"generated-{name}", build_page(site, chapters), chapters
+
+    if not corpus_dir:
+        return
+    for site in SITES:
+        site_dir = os.path.join(corpus_dir, site)
+        if not os.path.isdir(site_dir):
+            continue
+        for file_name in sorted(os.listdir(site_dir)):
+            with open(os.path.join(site_dir, file_name), encoding="utf-8") as f:
+                yield site, file_name, f.read(), None
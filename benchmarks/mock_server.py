@@ -0,0 +1,351 @@
+"""
+Local HTTP server that emulates the sites the downloader talks to, so the
+download paths can be benchmarked offline and reproducibly.
+
+Routes:
+    POST /api/v1/search/post-details            Tokybook metadata
+    POST /api/v1/playlist                       Tokybook tracks + stream token
+    GET  /api/v1/public/audio/<id>/<ch>.m3u8    Tokybook HLS playlist
+    GET  /api/v1/public/audio/<id>/<ch>/<n>.ts  Tokybook MPEG-TS segment
+    GET  /api/v1/public/audio/<id>/<ch>/all.ts  Every segment, for byte-range playlists
+    GET  /api/v1/public/audio/<id>/<ch>/key.bin AES-128 key, for encrypted playlists
+    GET  /book/<slug>/                          WordPress-style page with <audio> tags
+    GET  /audio/<slug>/<n>.mp3                  Direct chapter MP3
+"""
+
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Util.Padding import pad
+
+TS_PACKET_SIZE = 188
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz, no padding -> 417 byte frames
+MP3_FRAME_HEADER = b"\xff\xfb\x90\x00"
+MP3_FRAME_SIZE = 417
+
+
+def make_ts_payload(size):
+    """Returns `size` bytes (rounded up to whole packets) of sync-aligned MPEG-TS packets."""
+    packets = max(1, -(-size // TS_PACKET_SIZE))
+    packet = b"\x47" + b"\x00" * (TS_PACKET_SIZE - 1)
+    return packet * packets
+
+
+def make_mp3_payload(size):
+    """Returns roughly `size` bytes of back-to-back MP3 frames."""
+    frames = max(1, -(-size // MP3_FRAME_SIZE))
+    frame = MP3_FRAME_HEADER + b"\x00" * (MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+    return frame * frames
+
+
+def _chapter_key(chapter):
+    """Deterministic AES-128 key for a chapter's encrypted segments."""
+    return hashlib.md5(chapter.encode()).digest()
+
+
+class MockConfig:
+    """Tunable behaviour of the mock server. Can be changed while it is running."""
+
+    def __init__(
+        self,
+        chapters=10,
+        segments_per_chapter=20,
+        segment_size=64 * 1024,
+        mp3_size=1024 * 1024,
+        latency=0.0,
+        bandwidth=None,
+        error_rate=0.0,
+        token_ttl=None,
+        stall_rate=0.0,
+        stall_seconds=2.0,
+        hls="plain",
+        seed=0,
+    ):
+        self.chapters = chapters
+        self.segments_per_chapter = segments_per_chapter
+        self.segment_size = segment_size
+        self.mp3_size = mp3_size
+        self.latency = latency  # seconds added before every response
+        self.bandwidth = bandwidth  # bytes/sec per response, None = unlimited
+        self.error_rate = error_rate  # probability of answering 503
+        self.token_ttl = token_ttl  # seconds a Tokybook stream token stays valid
+        self.stall_rate = stall_rate  # probability a GET stalls for stall_seconds
+        self.stall_seconds = stall_seconds
+        # Tokybook playlist flavour: "plain", "master" (variant playlists),
+        # "aes" (AES-128 encrypted segments) or "byterange" (one file per chapter)
+        self.hls = hls
+        self.random = random.Random(seed)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def _inject_faults(self):
+        if self.config.latency:
+            time.sleep(self.config.latency)
+        if (
+            self.command == "GET"
+            and self.config.stall_rate
+            and self.config.random.random() < self.config.stall_rate
+        ):
+            time.sleep(self.config.stall_seconds)
+        if (
+            self.config.error_rate
+            and self.config.random.random() < self.config.error_rate
+        ):
+            self._send(503, b"injected error", "text/plain")
+            return True
+        return False
+
+    def _send(self, status, body, content_type):
+        start = time.perf_counter()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            bandwidth = self.config.bandwidth
+            chunk_size = 16 * 1024
+            for offset in range(0, len(body), chunk_size):
+                chunk = body[offset : offset + chunk_size]
+                self.wfile.write(chunk)
+                if bandwidth:
+                    time.sleep(len(chunk) / bandwidth)
+        self.server.record(self.path, time.perf_counter() - start, status)
+
+    def _send_range(self, body, content_type):
+        match = re.fullmatch(r"bytes=(\d+)-(\d+)", self.headers.get("Range") or "")
+        if not match:
+            self._send(200, body, content_type)
+            return
+        start, end = int(match.group(1)), int(match.group(2))
+        self.send_response(206)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Range", f"bytes {start}-{end}/{len(body)}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body[start : end + 1])
+        self.server.record(self.path, 0.0, 206)
+
+    def _playlist(self, chapter):
+        config = self.config
+        if config.hls == "master" and not chapter.endswith(("/audio", "/video")):
+            return "\n".join(
+                [
+                    "#EXTM3U",
+                    '#EXT-X-STREAM-INF:BANDWIDTH=800000,CODECS="avc1.4d401f,mp4a.40.2"',
+                    f"{chapter}/video.m3u8",
+                    '#EXT-X-STREAM-INF:BANDWIDTH=96000,CODECS="mp4a.40.2"',
+                    f"{chapter}/audio.m3u8",
+                ]
+            )
+        # Variant playlists live in the chapter's folder, next to its segments
+        prefix = "" if config.hls == "master" else f"{chapter}/"
+        lines = ["#EXTM3U", "#EXT-X-VERSION:4", "#EXT-X-TARGETDURATION:10"]
+        if config.hls == "aes":
+            lines.append(f'#EXT-X-KEY:METHOD=AES-128,URI="{prefix}key.bin"')
+        size = len(make_ts_payload(config.segment_size))
+        for n in range(config.segments_per_chapter):
+            lines.append("#EXTINF:10.0,")
+            if config.hls == "byterange":
+                lines.append(f"#EXT-X-BYTERANGE:{size}@{n * size}")
+                lines.append(f"{prefix}all.ts")
+            else:
+                lines.append(f"{prefix}{n}.ts")
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines)
+
+    def _token_expired(self):
+        if not self.config.token_ttl:
+            return False
+        token = self.headers.get("x-stream-token") or ""
+        try:
+            issued = float(token.rsplit("-", 1)[-1])
+        except ValueError:
+            return True
+        return time.time() - issued > self.config.token_ttl
+
+    def _send_json(self, data):
+        self._send(200, json.dumps(data).encode(), "application/json")
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if self._inject_faults():
+            return
+        path = urlparse(self.path).path
+        if path == "/api/v1/search/post-details":
+            slug = payload.get("dynamicSlugId", "mock-book")
+            self._send_json(
+                {
+                    "title": f"Mock Book {slug}",
+                    "audioBookId": f"MOCK-{slug}",
+                    "postDetailToken": "post-token",
+                    "authors": [{"name": "Mock Author"}],
+                    "narrators": [{"name": "Mock Narrator"}],
+                    "year": 2024,
+                    "coverImage": None,
+                }
+            )
+        elif path == "/api/v1/playlist":
+            book_id = payload.get("audioBookId", "MOCK")
+            self._send_json(
+                {
+                    "streamToken": f"stream-{time.time():.6f}",
+                    "tracks": [
+                        {"src": f"{book_id}/Chapter {n:03d}.m3u8", "duration": 600.0}
+                        for n in range(1, self.config.chapters + 1)
+                    ],
+                }
+            )
+        else:
+            self._send(404, b"not found", "text/plain")
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if self._inject_faults():
+            return
+        path = unquote(urlparse(self.path).path)
+        config = self.config
+
+        m3u8 = re.fullmatch(r"/api/v1/public/audio/([^/]+)/(.+)\.m3u8", path)
+        segment = re.fullmatch(
+            r"/api/v1/public/audio/([^/]+)/(.+)/(\d+|all)\.ts", path
+        )
+        key = re.fullmatch(r"/api/v1/public/audio/([^/]+)/(.+)/key\.bin", path)
+        page = re.fullmatch(r"/book/([^/]+)/?", path)
+        mp3 = re.fullmatch(r"/audio/([^/]+)/(\d+)\.mp3", path)
+
+        if (m3u8 or segment or key) and self._token_expired():
+            self._send(403, b"stream token expired", "text/plain")
+        elif m3u8:
+            body = self._playlist(m3u8.group(2)).encode()
+            self._send(200, body, "application/vnd.apple.mpegurl")
+        elif key:
+            self._send(200, _chapter_key(key.group(2)), "application/octet-stream")
+        elif segment and segment.group(3) == "all":
+            body = make_ts_payload(config.segment_size) * config.segments_per_chapter
+            self._send_range(body, "video/mp2t")
+        elif segment:
+            body = make_ts_payload(config.segment_size)
+            if config.hls == "aes":
+                iv = int(segment.group(3)).to_bytes(16, "big")
+                cipher = AES.new(_chapter_key(segment.group(2)), AES.MODE_CBC, iv)
+                body = cipher.encrypt(pad(body, AES.block_size))
+            self._send(200, body, "video/mp2t")
+        elif page:
+            slug = page.group(1)
+            audio_tags = "\n".join(
+                f'<audio class="wp-audio-shortcode"><source type="audio/mpeg" '
+                f'src="{self.server.base_url}/audio/{slug}/{n}.mp3?_={n}" /></audio>'
+                for n in range(1, config.chapters + 1)
+            )
+            body = (
+                "<html><head>"
+                f'<meta property="og:image" content="{self.server.base_url}/cover.jpg" />'
+                "</head><body>"
+                f'<h1 class="entry-title post-title">Mock Author - {slug} Audiobook</h1>'
+                f'<div class="entry">{audio_tags}</div>'
+                "</body></html>"
+            ).encode()
+            self._send(200, body, "text/html; charset=utf-8")
+        elif mp3:
+            self._send(200, make_mp3_payload(config.mp3_size), "audio/mpeg")
+        else:
+            self._send(404, b"not found", "text/plain")
+
+
+class _Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients drop connections on purpose, e.g. a hedged request that lost
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class MockServer:
+    """
+    Runs the mock site on a background thread.
+
+    Usage:
+        with MockServer(MockConfig(latency=0.05)) as server:
+            url = f"{server.base_url}/book/test/"
+    """
+
+    def __init__(self, config=None, host="127.0.0.1", port=0):
+        self.config = config or MockConfig()
+        self._httpd = _Server((host, port), _Handler)
+        self._httpd.daemon_threads = True
+        self._httpd.config = self.config
+        self._httpd.base_url = self.base_url
+        self._httpd.record = self._record
+        self._lock = threading.Lock()
+        self._thread = None
+        self.requests = []  # (path, seconds, status)
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _record(self, path, seconds, status):
+        with self._lock:
+            self.requests.append((path, seconds, status))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the mock audiobook site.")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--bandwidth", type=int, default=None)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--stall-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        error_rate=args.error_rate,
+        stall_rate=args.stall_rate,
+    )
+    server = MockServer(config, port=args.port).start()
+    print(f"Mock server listening on {server.base_url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
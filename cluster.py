@@ -0,0 +1,509 @@
+import argparse
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+from rich.console import Console
+from rich.table import Table
+
+from daemon import OVERRIDES, JSONHandler, call, load_book_cover, scrape_book
+from utils import parse_chapter_ranges
+
+console = Console()
+
+DEFAULT_PATH = "cluster.sqlite"
+DEFAULT_PORT = 8766
+DEFAULT_URL = f"http://127.0.0.1:{DEFAULT_PORT}"
+LEASE_SECONDS = 120
+MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    title TEXT,
+    book_data TEXT NOT NULL,
+    submitted REAL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    book_id INTEGER NOT NULL REFERENCES books (id),
+    chapter INTEGER NOT NULL,
+    title TEXT,
+    state TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER DEFAULT 0,
+    size INTEGER,
+    error TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_by_state ON tasks (state, lease_until);
+"""
+
+
+class ClusterQueue:
+    """
+    Chapter download queue, kept by the coordinator in a local SQLite file.
+
+    Every chapter is a task, identified by its index in the whole book. A
+    worker leases one task at a time and renews the lease with heartbeats
+    while it works; a task whose lease runs out (its worker died or lost the
+    network) goes to the next worker that asks, until it has had
+    MAX_ATTEMPTS attempts.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            self._db.commit()
+            return cursor
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def submit(self, url, book_data, indices):
+        """Queues the chapters at `indices` of book_data["chapters"]. Returns the book id."""
+        stored = {k: v for k, v in book_data.items() if k != "artwork_data"}
+        chapters = book_data["chapters"]
+        with self._lock:
+            book_id = self._db.execute(
+                "INSERT INTO books (url, title, book_data, submitted) VALUES (?, ?, ?, ?)",
+                (url, book_data["title"], json.dumps(stored), time.time()),
+            ).lastrowid
+            self._db.executemany(
+                "INSERT INTO tasks (book_id, chapter, title, updated) VALUES (?, ?, ?, ?)",
+                [
+                    (book_id, index, chapters[index]["title"], time.time())
+                    for index in indices
+                ],
+            )
+            self._db.commit()
+        return book_id
+
+    def lease(self, worker, seconds=LEASE_SECONDS):
+        """
+        Leases the oldest queued task, or one whose lease has expired.
+        Returns the task as a dict, or None if there is no work.
+        """
+        now = time.time()
+        with self._lock:
+            # A chapter that keeps taking its workers down gives up in the end
+            self._db.execute(
+                "UPDATE tasks SET state = 'failed', error = 'lease expired', "
+                "updated = ? WHERE state = 'leased' AND lease_until < ? "
+                "AND attempts >= ?",
+                (now, now, MAX_ATTEMPTS),
+            )
+            row = self._db.execute(
+                "SELECT id FROM tasks WHERE state = 'queued' "
+                "OR (state = 'leased' AND lease_until < ?) ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                self._db.execute(
+                    "UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, "
+                    "attempts = attempts + 1, updated = ? WHERE id = ?",
+                    (worker, now + seconds, now, row["id"]),
+                )
+                row = self._db.execute(
+                    "SELECT * FROM tasks WHERE id = ?", (row["id"],)
+                ).fetchone()
+            self._db.commit()
+        return dict(row) if row is not None else None
+
+    def heartbeat(self, task_id, worker, seconds=LEASE_SECONDS):
+        """Extends a lease. Returns False if the task was reassigned meanwhile."""
+        cursor = self._execute(
+            "UPDATE tasks SET lease_until = ?, updated = ? "
+            "WHERE id = ? AND worker = ? AND state = 'leased'",
+            (time.time() + seconds, time.time(), task_id, worker),
+        )
+        return cursor.rowcount == 1
+
+    def finish(self, task_id, worker, size=None, error=None):
+        """
+        Records a task's result, unless its lease was lost to another worker.
+        A failed task is queued again until it has had MAX_ATTEMPTS attempts.
+        Returns the task, or None if the result was ignored.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM tasks WHERE id = ? AND worker = ? AND state = 'leased'",
+                (task_id, worker),
+            ).fetchone()
+            if row is None:
+                return None
+            if error is None:
+                state = "done"
+            else:
+                state = "failed" if row["attempts"] >= MAX_ATTEMPTS else "queued"
+            self._db.execute(
+                "UPDATE tasks SET state = ?, size = ?, error = ?, lease_until = NULL, "
+                "updated = ? WHERE id = ?",
+                (state, size, error, time.time(), task_id),
+            )
+            self._db.commit()
+        return dict(row)
+
+    def requeue_failed(self):
+        cursor = self._execute(
+            "UPDATE tasks SET state = 'queued', attempts = 0, error = NULL, "
+            "updated = ? WHERE state = 'failed'",
+            (time.time(),),
+        )
+        return cursor.rowcount
+
+    def book_data(self, book_id):
+        rows = self._query("SELECT book_data FROM books WHERE id = ?", (book_id,))
+        return json.loads(rows[0]["book_data"]) if rows else None
+
+    def status(self):
+        return [dict(row) for row in self._query("""
+                SELECT books.id, books.title,
+                       COUNT(*) AS chapters,
+                       SUM(tasks.state = 'done') AS done,
+                       SUM(tasks.state = 'leased') AS running,
+                       SUM(tasks.state = 'failed') AS failed,
+                       GROUP_CONCAT(DISTINCT tasks.worker) AS workers
+                FROM books JOIN tasks ON tasks.book_id = books.id
+                GROUP BY books.id ORDER BY books.id
+                """)]
+
+    def close(self):
+        self._db.close()
+
+
+class Coordinator:
+    """
+    Hands out the queue's chapters to workers over HTTP, and is the only
+    writer of the books' manifests and the library index: workers download
+    into the shared Audiobooks folder and report each chapter's record back.
+    """
+
+    def __init__(self, queue, root="."):
+        from library import Library
+
+        self.queue = queue
+        self.root = os.path.join(os.path.abspath(root), "Audiobooks")
+        os.makedirs(self.root, exist_ok=True)
+        self.library = Library(os.path.join(self.root, ".library.sqlite"))
+        self._records_lock = threading.Lock()
+
+    def submit(self, url, overrides=None, chapters=None):
+        book_data = scrape_book(url, overrides)
+        count = len(book_data["chapters"])
+        indices = (
+            parse_chapter_ranges(chapters, count) if chapters else list(range(count))
+        )
+        book_id = self.queue.submit(url, book_data, indices)
+        self.library.upsert_book(book_data, url)
+        return {"id": book_id, "title": book_data["title"], "chapters": len(indices)}
+
+    def finish(self, task_id, worker, record=None, error=None):
+        size = record["size"] if record else None
+        task = self.queue.finish(task_id, worker, size=size, error=error)
+        if task is None or record is None:
+            return task is not None
+        book_data = self.queue.book_data(task["book_id"])
+        book_dir = os.path.join(self.root, book_data["title"])
+        from verify import load_manifest, save_manifest
+
+        with self._records_lock:
+            manifest = load_manifest(book_dir)
+            manifest[record["file_name"]] = {
+                key: record.get(key) for key in ("url", "size", "duration")
+            }
+            save_manifest(book_dir, manifest)
+        book = self.library.get_book(book_data["book_url"])
+        if book is not None:
+            self.library.record_chapter(
+                book["id"],
+                record["file_name"],
+                track=record.get("track"),
+                title=record.get("title"),
+                url=record.get("url"),
+                size=record.get("size"),
+                sha256=record.get("sha256"),
+                duration=record.get("duration"),
+            )
+        return True
+
+    def serve(self, port=DEFAULT_PORT, host="127.0.0.1"):
+        """Serves the JSON API on the calling thread until interrupted."""
+        server = ThreadingHTTPServer((host, port), _handler(self))
+        server.daemon_threads = True
+        console.print(f"[green]Coordinator listening on http://{host}:{port}[/green]")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+
+def _handler(coordinator):
+    queue = coordinator.queue
+
+    class Handler(JSONHandler):
+        def do_GET(self):
+            path = self.path.rstrip("/")
+            book_match = re.fullmatch(r"/books/(\d+)", path)
+            if path == "/books":
+                self._reply(200, queue.status())
+            elif book_match:
+                book_data = queue.book_data(int(book_match.group(1)))
+                if book_data is None:
+                    self._reply(404, {"error": "No such book"})
+                else:
+                    self._reply(200, book_data)
+            else:
+                self._reply(404, {"error": "Not found"})
+
+        def do_POST(self):
+            path = self.path.rstrip("/")
+            action = re.fullmatch(r"/tasks/(\d+)/(heartbeat|finish)", path)
+            try:
+                body = self._body()
+                if path == "/books":
+                    if not body.get("url"):
+                        raise ValueError("A url is required")
+                    overrides = {key: body.get(key) for key in OVERRIDES}
+                    self._reply(
+                        201,
+                        coordinator.submit(body["url"], overrides, body.get("chapters")),
+                    )
+                elif path == "/lease":
+                    task = queue.lease(
+                        body["worker"], int(body.get("lease") or LEASE_SECONDS)
+                    )
+                    self._reply(200, {"task": task})
+                elif action and action.group(2) == "heartbeat":
+                    ok = queue.heartbeat(
+                        int(action.group(1)),
+                        body["worker"],
+                        int(body.get("lease") or LEASE_SECONDS),
+                    )
+                    self._reply(200, {"ok": ok})
+                elif action:
+                    ok = coordinator.finish(
+                        int(action.group(1)),
+                        body["worker"],
+                        body.get("record"),
+                        body.get("error"),
+                    )
+                    self._reply(200, {"ok": ok})
+                elif path == "/requeue":
+                    self._reply(200, {"requeued": queue.requeue_failed()})
+                else:
+                    self._reply(404, {"error": "Not found"})
+            except (ValueError, KeyError) as e:
+                self._reply(400, {"error": str(e)})
+            except Exception as e:  # e.g. the book page could not be scraped
+                self._reply(500, {"error": str(e)})
+
+    return Handler
+
+
+# --- Worker ---
+
+
+class Heartbeat:
+    """Renews a task's lease in the background while it is being worked on."""
+
+    def __init__(self, url, task_id, worker, seconds=LEASE_SECONDS):
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+
+        def beat():
+            while not self._stop.wait(seconds / 3):
+                try:
+                    reply = call(
+                        url,
+                        "POST",
+                        f"/tasks/{task_id}/heartbeat",
+                        {"worker": worker, "lease": seconds},
+                    )
+                except OSError:
+                    # Unreachable or an error reply: try again on the next beat
+                    continue
+                if not reply["ok"]:
+                    self.lost.set()
+                    return
+
+        self._thread = threading.Thread(target=beat, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(url, worker, root, lease_seconds=LEASE_SECONDS, idle_exit=False):
+    """
+    Downloads chapters leased from the coordinator at `url` into
+    `root`/Audiobooks until interrupted (or, with `idle_exit`, until the
+    queue has no work left).
+    """
+    import main
+    from library import Library
+
+    os.chdir(root)
+    session = main.new_session()
+    # The coordinator's index when the Audiobooks folder is shared, read to
+    # skip chapters already finished
+    library = Library(os.path.join("Audiobooks", ".library.sqlite"))
+    # Book id -> book data with its cover, kept for the worker's lifetime so
+    # stream token refreshes carry over from one chapter to the next
+    books = {}
+    while True:
+        try:
+            task = call(url, "POST", "/lease", {"worker": worker, "lease": lease_seconds})[
+                "task"
+            ]
+            if task is not None and task["book_id"] not in books:
+                book_data = call(url, "GET", f"/books/{task['book_id']}")
+                load_book_cover(book_data)
+                books[task["book_id"]] = book_data
+        except OSError as e:  # Unreachable, or an error reply (daemon.CallError)
+            console.print(
+                f"[yellow]Coordinator request failed ({e}), retrying...[/yellow]"
+            )
+            time.sleep(10)
+            continue
+        if task is None:
+            if idle_exit:
+                return
+            time.sleep(5)
+            continue
+
+        book_data = books[task["book_id"]]
+        chapter = book_data["chapters"][task["chapter"]]
+
+        console.print(f"[cyan]{worker}: {book_data['title']} / {chapter['title']}[/cyan]")
+        heartbeat = Heartbeat(url, task["id"], worker, lease_seconds)
+        outcomes, records = [], []
+        try:
+            main.download_and_tag_audiobook(
+                book_data,
+                library=library,
+                session=session,
+                cancel=heartbeat.lost,
+                on_chapter=lambda chapter, outcome: outcomes.append(outcome),
+                only=[task["chapter"]],
+                record=lambda file_name, entry: records.append(
+                    {**entry, "file_name": file_name}
+                ),
+            )
+        except Exception as e:
+            outcomes.append(f"failed: {e}")
+        finally:
+            heartbeat.stop()
+
+        result = {"worker": worker}
+        if outcomes and outcomes[0] in ("done", "skipped"):
+            result["record"] = records[0] if records else None
+        else:
+            result["error"] = (outcomes or ["lease lost"])[0]
+        try:
+            call(url, "POST", f"/tasks/{task['id']}/finish", result)
+        except OSError as e:
+            # The lease runs out and the chapter, already on disk, is skipped
+            # by whoever leases it next
+            console.print(f"[yellow]Could not report {chapter['title']}: {e}[/yellow]")
+
+
+def print_status(rows):
+    table = Table(title="Cluster Queue")
+    table.add_column("ID", justify="right")
+    table.add_column("Title", style="bold cyan")
+    table.add_column("Done", justify="right")
+    table.add_column("Running", justify="right")
+    table.add_column("Failed", justify="right")
+    table.add_column("Workers")
+    for row in rows:
+        table.add_row(
+            str(row["id"]),
+            row["title"],
+            f"{row['done']}/{row['chapters']}",
+            str(row["running"]),
+            str(row["failed"]),
+            row["workers"] or "",
+        )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Share book downloads between machines through a coordinator."
+    )
+    parser.add_argument("--url", default=DEFAULT_URL, help="Coordinator address.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve", help="Run the coordinator.")
+    serve.add_argument("--db", default=DEFAULT_PATH, help="Queue file (local disk).")
+    serve.add_argument(
+        "--root", default=".", help="Folder the shared Audiobooks folder lives in."
+    )
+    serve.add_argument("--host", default="127.0.0.1", help="e.g. 0.0.0.0 for the LAN.")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    submit = sub.add_parser("submit", help="Scrape a book and queue its chapters.")
+    submit.add_argument("book_url")
+    for key in OVERRIDES:
+        submit.add_argument(f"--{key.replace('_', '-')}")
+    submit.add_argument("--chapters", help="Chapters to queue, e.g. '1-5, 8'.")
+    worker = sub.add_parser("worker", help="Download queued chapters.")
+    worker.add_argument("--id", default=f"{socket.gethostname()}-{os.getpid()}")
+    worker.add_argument(
+        "--root", default=".", help="Folder the shared Audiobooks folder lives in."
+    )
+    worker.add_argument("--lease", type=int, default=LEASE_SECONDS, metavar="SECONDS")
+    worker.add_argument(
+        "--exit-when-idle", action="store_true", help="Stop once the queue is empty."
+    )
+    sub.add_parser("status", help="Show progress per book.")
+    sub.add_parser("requeue", help="Queue failed chapters again.")
+    args = parser.parse_args()
+
+    try:
+        if args.command == "serve":
+            queue = ClusterQueue(os.path.abspath(args.db))
+            Coordinator(queue, args.root).serve(args.port, args.host)
+        elif args.command == "submit":
+            overrides = {key: getattr(args, key) for key in OVERRIDES}
+            book = call(
+                args.url,
+                "POST",
+                "/books",
+                {"url": args.book_url, **overrides, "chapters": args.chapters},
+            )
+            console.print(
+                f"[green]Queued {book['chapters']} chapters of "
+                f"'{book['title']}' as book {book['id']}.[/green]"
+            )
+        elif args.command == "worker":
+            run_worker(args.url, args.id, args.root, args.lease, args.exit_when_idle)
+        elif args.command == "status":
+            print_status(call(args.url, "GET", "/books"))
+        elif args.command == "requeue":
+            reply = call(args.url, "POST", "/requeue", {})
+            console.print(f"Queued {reply['requeued']} failed chapters again.")
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        console.print(f"[red]Error: {e}[/red]")
+        raise SystemExit(1)
@@ -0,0 +1,476 @@
+import argparse
+import heapq
+import itertools
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from rich.console import Console
+
+from throttle import limiter
+from utils import parse_chapter_ranges, parse_size, sanitize_book_title
+
+console = Console()
+
+DEFAULT_PORT = 8765
+DEFAULT_URL = f"http://127.0.0.1:{DEFAULT_PORT}"
+OVERRIDES = ("title", "author", "narrator", "year", "cover_url")
+FINISHED = ("done", "failed", "cancelled")
+
+
+class Job:
+    """A book download submitted to the daemon."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, url, overrides=None, chapters=None, priority=0):
+        self.id = next(self._ids)
+        self.url = url
+        self.overrides = {k: v for k, v in (overrides or {}).items() if v}
+        self.chapters = chapters  # Selection such as "1-5, 8", or None for all
+        self.priority = priority
+        self.state = "queued"
+        self.title = None
+        self.error = None
+        self.total = 0
+        self.outcomes = {"done": 0, "skipped": 0, "failed": 0}
+        self.created = time.time()
+        self.started = self.finished = None
+        self.cancel = threading.Event()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "url": self.url,
+            "title": self.title,
+            "state": self.state,
+            "priority": self.priority,
+            "chapters": self.total,
+            **self.outcomes,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class DownloadDaemon:
+    """
+    Runs submitted jobs one book at a time, highest priority first (oldest
+    first within a priority), in a single long-lived process: the HTTP
+    session, library index, blob store, latency statistics and circuit
+    breakers stay warm from one book to the next.
+    """
+
+    def __init__(self, chapter_workers=2, order=None, dedup=False):
+        # Imported here so the client commands stay light
+        import main
+        from dedup import BlobStore
+        from library import Library
+
+        self._main = main
+        self.chapter_workers = chapter_workers
+        self.order = order
+        root = os.path.join(os.getcwd(), "Audiobooks")
+        self.library = Library(os.path.join(root, ".library.sqlite"))
+        self.blob_store = BlobStore(os.path.join(root, ".blobs")) if dedup else None
+        self.session = main.new_session()
+        self.jobs = {}
+        self._queue = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopping = False
+        self._runner = threading.Thread(target=self._run, daemon=True)
+        self._runner.start()
+
+    # --- Job control ---
+
+    def submit(self, url, overrides=None, chapters=None, priority=0):
+        if self._main.get_scraper(url) is None:
+            raise ValueError(f"Unsupported website: {url}")
+        job = Job(url, overrides, chapters, priority)
+        with self._lock:
+            self.jobs[job.id] = job
+            self._push(job)
+            self._wakeup.notify()
+        return job
+
+    def cancel(self, job_id):
+        """Cancels a queued job, or stops a running one after its current chapters."""
+        job = self.jobs[job_id]
+        job.cancel.set()
+        with self._lock:
+            if job.state == "queued":
+                job.state = "cancelled"
+                job.finished = time.time()
+        return job
+
+    def set_priority(self, job_id, priority):
+        job = self.jobs[job_id]
+        with self._lock:
+            job.priority = priority
+            if job.state == "queued":
+                self._push(job)  # The old heap entry is skipped when popped
+        return job
+
+    def _push(self, job):
+        heapq.heappush(self._queue, (-job.priority, job.created, job.id, job.priority))
+
+    def _next_job(self):
+        with self._lock:
+            while not self._stopping:
+                while self._queue:
+                    _, _, job_id, priority = heapq.heappop(self._queue)
+                    job = self.jobs[job_id]
+                    # Stale entries: reprioritised or cancelled since they were queued
+                    if job.state == "queued" and job.priority == priority:
+                        job.state = "running"
+                        job.started = time.time()
+                        return job
+                self._wakeup.wait()
+        return None
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                self._download(job)
+            except Exception as e:
+                job.error = str(e)
+                job.state = "failed"
+            else:
+                if job.cancel.is_set():
+                    job.state = "cancelled"
+                elif job.outcomes["failed"]:
+                    job.state = "failed"
+                    job.error = f"{job.outcomes['failed']} chapters failed"
+                else:
+                    job.state = "done"
+            job.finished = time.time()
+
+    def _download(self, job):
+        book_data = self.prepare(job)
+
+        def on_chapter(chapter, outcome):
+            with self._lock:
+                job.outcomes[outcome] += 1
+
+        self._main.download_and_tag_audiobook(
+            book_data,
+            self.blob_store,
+            self.library,
+            chapter_workers=self.chapter_workers,
+            order=self.order,
+            session=self.session,
+            cancel=job.cancel,
+            on_chapter=on_chapter,
+        )
+
+    def prepare(self, job):
+        """Scrapes the job's book and applies its overrides, selection and cover."""
+        book_data = scrape_book(job.url, job.overrides)
+        chapters = book_data["chapters"]
+        if job.chapters:
+            selected = parse_chapter_ranges(job.chapters, len(chapters))
+            book_data["chapters"] = [chapters[index] for index in selected]
+        job.title = book_data["title"]
+        job.total = len(book_data["chapters"])
+        load_book_cover(book_data)
+        return book_data
+
+    def stop(self):
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for job in self.jobs.values():
+            job.cancel.set()
+
+    # --- HTTP API ---
+
+    def serve(self, port=DEFAULT_PORT, host="127.0.0.1"):
+        """Serves the JSON API on the calling thread until interrupted."""
+        server = ThreadingHTTPServer((host, port), _handler(self))
+        server.daemon_threads = True
+        console.print(f"[green]Daemon listening on http://{host}:{port}[/green]")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stop()
+
+
+def scrape_book(url, overrides=None):
+    """
+    Scrapes a book and applies `overrides` (see OVERRIDES), numbering every
+    chapter's track within the whole book.
+    """
+    from main import get_scraper
+
+    scraper = get_scraper(url)
+    if scraper is None:
+        raise ValueError(f"Unsupported website: {url}")
+    book_data = scraper.fetch_book_data(url)
+    if not book_data:
+        raise Exception("Could not retrieve book data")
+    book_data.update({k: v for k, v in (overrides or {}).items() if v})
+    book_data["title"] = sanitize_book_title(book_data.get("title"))
+    book_data["book_url"] = url
+    chapters = book_data["chapters"]
+    book_data["total_chapters_count"] = len(chapters)
+    for index, chapter in enumerate(chapters):
+        chapter["track_num"] = index + 1
+    return book_data
+
+
+def load_book_cover(book_data):
+    """Downloads the book's cover into book_data (artwork_data, mime_type)."""
+    from retag import load_cover
+
+    if not book_data.get("cover_url"):
+        return
+    try:
+        book_data["artwork_data"], book_data["mime_type"] = load_cover(
+            book_data["cover_url"]
+        )
+    except Exception as e:
+        console.print(f"[yellow]Could not download cover art: {e}[/yellow]")
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    """Request handler base for the small JSON APIs (daemon, cluster)."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+
+def _priority(value):
+    """A request's priority as an int; ValueError (a 400 reply) otherwise."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid priority: {value!r}") from None
+
+
+def _handler(daemon):
+    class Handler(JSONHandler):
+        def _job(self, job_id):
+            job = daemon.jobs.get(int(job_id))
+            if job is None:
+                self._reply(404, {"error": f"No job {job_id}"})
+            return job
+
+        def do_GET(self):
+            path = self.path.rstrip("/")
+            job_match = re.fullmatch(r"/jobs/(\d+)", path)
+            if path == "/jobs":
+                jobs = sorted(daemon.jobs.values(), key=lambda job: job.id)
+                self._reply(200, [job.to_dict() for job in jobs])
+            elif job_match:
+                job = self._job(job_match.group(1))
+                if job is not None:
+                    self._reply(200, job.to_dict())
+            elif path == "/rate":
+                self._reply(200, {"rate": limiter.rate})
+            else:
+                self._reply(404, {"error": "Not found"})
+
+        def do_POST(self):
+            path = self.path.rstrip("/")
+            action = re.fullmatch(r"/jobs/(\d+)/(cancel|priority)", path)
+            try:
+                body = self._body()
+                if path == "/jobs":
+                    if not body.get("url"):
+                        raise ValueError("A url is required")
+                    job = daemon.submit(
+                        body["url"],
+                        {key: body.get(key) for key in OVERRIDES},
+                        body.get("chapters"),
+                        _priority(body.get("priority") or 0),
+                    )
+                    self._reply(201, job.to_dict())
+                elif action:
+                    job = self._job(action.group(1))
+                    if job is None:
+                        return
+                    if action.group(2) == "cancel":
+                        daemon.cancel(job.id)
+                    else:
+                        daemon.set_priority(job.id, _priority(body.get("priority")))
+                    self._reply(200, job.to_dict())
+                elif path == "/rate":
+                    limiter.set_rate(parse_size(str(body.get("rate") or "")))
+                    self._reply(200, {"rate": limiter.rate})
+                else:
+                    self._reply(404, {"error": "Not found"})
+            except (ValueError, KeyError) as e:
+                self._reply(400, {"error": str(e)})
+
+    return Handler
+
+
+# --- Client ---
+
+
+class CallError(OSError):
+    """The daemon answered a request with an error status."""
+
+
+def call(base_url, method, path, data=None):
+    """
+    Sends a request to a running daemon and returns the decoded JSON reply.
+    Raises CallError for an error reply, OSError if it can't be reached.
+    """
+    body = json.dumps(data).encode() if data is not None else None
+    request = urllib.request.Request(
+        base_url.rstrip("/") + path,
+        data=body,
+        method=method,
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        try:
+            message = json.loads(e.read()).get("error", str(e))
+        except ValueError:  # Not one of our replies (e.g. a proxy's error page)
+            message = str(e)
+        raise CallError(message) from None
+
+
+def follow(base_url, job_id, interval=2.0):
+    """Prints a job's progress until it finishes. Returns its final state."""
+    last = None
+    while True:
+        job = call(base_url, "GET", f"/jobs/{job_id}")
+        done = job["done"] + job["skipped"]
+        line = (
+            f"{job['title'] or job['url']}: {job['state']}, "
+            f"{done}/{job['chapters'] or '?'} chapters"
+            + (f", {job['failed']} failed" if job["failed"] else "")
+        )
+        if line != last:
+            console.print(line)
+            last = line
+        if job["state"] in FINISHED:
+            if job["error"]:
+                console.print(f"[red]{job['error']}[/red]")
+            return job
+        time.sleep(interval)
+
+
+def print_jobs(jobs):
+    from rich.table import Table
+
+    table = Table(title="Jobs")
+    for column in ("ID", "State", "Priority", "Title", "Chapters"):
+        table.add_column(column)
+    for job in jobs:
+        table.add_row(
+            str(job["id"]),
+            job["state"],
+            str(job["priority"]),
+            job["title"] or job["url"],
+            f"{job['done'] + job['skipped']}/{job['chapters']}",
+        )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Keep a downloader running and feed it jobs over HTTP."
+    )
+    parser.add_argument("--url", default=DEFAULT_URL, help="Daemon address.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    serve = sub.add_parser("serve", help="Run the daemon.")
+    serve.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve.add_argument("--chapter-workers", type=int, default=2)
+    serve.add_argument("--order", choices=("list", "longest", "listen-first"))
+    serve.add_argument("--dedup", action="store_true")
+    serve.add_argument("--limit-rate", metavar="RATE")
+    submit = sub.add_parser("submit", help="Queue a book.")
+    submit.add_argument("book_url")
+    for key in OVERRIDES:
+        submit.add_argument(f"--{key.replace('_', '-')}")
+    submit.add_argument("--chapters", help="Chapters to download, e.g. '1-5, 8'.")
+    submit.add_argument("--priority", type=int, default=0)
+    submit.add_argument("--follow", action="store_true", help="Wait for the job.")
+    sub.add_parser("jobs", help="List jobs.")
+    status = sub.add_parser("status", help="Follow a job until it finishes.")
+    status.add_argument("job_id", type=int)
+    cancel = sub.add_parser("cancel", help="Cancel a job.")
+    cancel.add_argument("job_id", type=int)
+    priority = sub.add_parser("priority", help="Change a queued job's priority.")
+    priority.add_argument("job_id", type=int)
+    priority.add_argument("priority", type=int)
+    rate = sub.add_parser("rate", help="Show or change the bandwidth cap.")
+    rate.add_argument("rate", nargs="?", help="e.g. 2M, or 0 for no cap.")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        if args.limit_rate:
+            try:
+                limiter.set_rate(parse_size(args.limit_rate))
+            except ValueError:
+                console.print(
+                    f"[red]Error: invalid --limit-rate {args.limit_rate!r}[/red]"
+                )
+                raise SystemExit(2)
+        DownloadDaemon(args.chapter_workers, args.order, args.dedup).serve(args.port)
+    elif args.command == "submit":
+        overrides = {key: getattr(args, key) for key in OVERRIDES}
+        job = call(
+            args.url,
+            "POST",
+            "/jobs",
+            {
+                "url": args.book_url,
+                **overrides,
+                "chapters": args.chapters,
+                "priority": args.priority,
+            },
+        )
+        console.print(f"Queued job {job['id']}.")
+        if args.follow:
+            follow(args.url, job["id"])
+    elif args.command == "jobs":
+        print_jobs(call(args.url, "GET", "/jobs"))
+    elif args.command == "status":
+        follow(args.url, args.job_id)
+    elif args.command == "cancel":
+        console.print(call(args.url, "POST", f"/jobs/{args.job_id}/cancel"))
+    elif args.command == "priority":
+        job = call(
+            args.url,
+            "POST",
+            f"/jobs/{args.job_id}/priority",
+            {"priority": args.priority},
+        )
+        console.print(job)
+    elif args.command == "rate":
+        if args.rate is None:
+            console.print(call(args.url, "GET", "/rate"))
+        else:
+            console.print(call(args.url, "POST", "/rate", {"rate": args.rate}))
@@ -0,0 +1,253 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+
+from verify import id3v2_size, parse_mp3_frame_header
+
+# ioctl request number for FICLONE (Linux btrfs/xfs/bcachefs reflinks)
+_FICLONE = 0x40049409
+ID3V1_SIZE = 128
+# Tags of the header frame LAME/libavformat write first and rewrite when done
+_VBR_HEADERS = (b"Xing", b"Info", b"VBRI")
+
+
+class AudioHasher:
+    """
+    Streaming SHA-256 of a chapter's audio payload: the file without its
+    ID3v2 and ID3v1 tags and without a leading Xing/Info/VBRI header frame.
+
+    This is the hash recorded everywhere (library index, blob store), so the
+    download stream, a freshly converted file and an already tagged chapter
+    all give the same digest. Files that aren't MP3 are hashed whole.
+    """
+
+    def __init__(self):
+        self._digest = hashlib.sha256()
+        self._stage = "id3"
+        self._buffer = bytearray()
+        self._skip = 0
+        self._tail = b""  # Held back in case it is an ID3v1 tag
+        self.position = 0
+        # Offset of the first hashed byte, once known: bytes before it may
+        # still be rewritten without changing the digest
+        self.audio_start = None
+
+    def update(self, data):
+        data = bytes(data)
+        self.position += len(data)
+        if self._skip:
+            skipped = min(self._skip, len(data))
+            self._skip -= skipped
+            data = data[skipped:]
+        if self._stage != "audio":
+            self._buffer += data
+            data = self._read_header()
+        if data:
+            held = self._tail + data
+            self._digest.update(held[:-ID3V1_SIZE])
+            self._tail = held[-ID3V1_SIZE:]
+
+    def _read_header(self):
+        """Skips the tag and header frame once enough bytes are buffered.
+        Returns the buffered bytes that are audio."""
+        buffer = self._buffer
+        if self._stage == "id3":
+            if len(buffer) < 10:
+                return b""
+            size = id3v2_size(bytes(buffer[:10]))
+            self._skip = max(0, size - len(buffer))
+            del buffer[:size]
+            self._stage = "frame"
+            if self._skip:
+                return b""
+        if len(buffer) < 4:
+            return b""
+        header = parse_mp3_frame_header(buffer, 0)
+        if header is not None:
+            if len(buffer) < header[0]:
+                return b""
+            if any(tag in buffer[: min(header[0], 64)] for tag in _VBR_HEADERS):
+                del buffer[: header[0]]
+        self._stage = "audio"
+        self.audio_start = self.position - len(buffer)
+        data, self._buffer = bytes(buffer), None
+        return data
+
+    def hexdigest(self):
+        digest = self._digest.copy()
+        if self._stage != "audio":
+            digest.update(self._buffer)  # Shorter than a tag and a frame
+        if not (len(self._tail) == ID3V1_SIZE and self._tail[:3] == b"TAG"):
+            digest.update(self._tail)
+        return digest.hexdigest()
+
+
+class HashingWriter:
+    """
+    Binary file wrapper that feeds what is written to an AudioHasher, for
+    writers that produce the file themselves (the PyAV muxer). Rewrites of
+    the tag and header frame at the start, as muxers do when they finish,
+    are allowed; any other out-of-order write makes `hexdigest` return None.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self._end = 0
+        self._valid = True
+        self.hasher = AudioHasher()
+
+    def write(self, data):
+        position = self._f.tell()
+        if position == self._end:
+            self.hasher.update(data)
+            self._end += len(data)
+        elif (
+            position > self._end
+            or self.hasher.audio_start is None
+            or position + len(data) > self.hasher.audio_start
+        ):
+            self._valid = False
+        return self._f.write(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+    def flush(self):
+        self._f.flush()
+
+    def hexdigest(self):
+        return self.hasher.hexdigest() if self._valid else None
+
+
+def hash_audio(path, chunk_size=1024 * 1024):
+    """Returns the AudioHasher digest of a file."""
+    digest = AudioHasher()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def reflinks_supported(directory):
+    """Whether files in `directory` can be reflinked (probed with a small file)."""
+    probe = os.path.join(directory, f".reflink-probe.{os.getpid()}")
+    try:
+        with open(probe, "wb") as f:
+            f.write(b"\0" * 4096)
+        ok = reflink(probe, f"{probe}.clone")
+        if ok:
+            os.remove(f"{probe}.clone")
+        return ok
+    finally:
+        os.remove(probe)
+
+
+def reflink(src, dst):
+    """
+    Creates `dst` as a copy-on-write clone of `src`. Returns False if the
+    platform or filesystem doesn't support reflinks (nothing is created then).
+    """
+    if not sys.platform.startswith("linux"):
+        return False
+    import fcntl
+
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dst):
+            os.remove(dst)
+        return False
+
+
+class BlobStore:
+    """
+    Content-addressed store of downloaded chapters, shared by all books.
+
+    Blobs live in <root>/<sha[:2]>/<sha>, with a URL -> hash index in
+    <root>/index.sqlite so repeated URLs are recognised before any download.
+
+    Book folders get their chapters as reflinks of the blobs, so identical
+    audio shares its disk extents. Hardlinks are deliberately not used: each
+    book writes its own ID3 tags into the chapter file, in place, which would
+    corrupt every other book sharing the inode, and breaking the link before
+    tagging is a full copy anyway. On filesystems without reflink support
+    (`reflinks_supported` is False, e.g. ext4) the blob is a plain copy and
+    the saving is in network traffic only.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(root, "index.sqlite"), check_same_thread=False
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS urls ("
+            "url TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER, added REAL)"
+        )
+        self._db.commit()
+        self.reflinks_supported = reflinks_supported(root)
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def lookup(self, url):
+        """Returns the blob path already stored for `url`, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT sha256 FROM urls WHERE url = ?", (url,)
+            ).fetchone()
+        if row and os.path.exists(self.blob_path(row[0])):
+            return self.blob_path(row[0])
+        return None
+
+    def ingest(self, path, url=None, digest=None):
+        """
+        Adds the (untagged) chapter at `path` to the store and records `url`
+        for it. `digest` (see AudioHasher) can be passed if it was computed
+        while streaming. Returns the digest.
+        """
+        digest = digest or hash_audio(path)
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            tmp = f"{blob}.{os.getpid()}.{threading.get_ident()}.tmp"
+            if not self._clone(path, tmp):
+                shutil.copyfile(path, tmp)
+            os.replace(tmp, blob)
+        if url:
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?)",
+                    (url, digest, os.path.getsize(blob), time.time()),
+                )
+                self._db.commit()
+        return digest
+
+    def materialize(self, blob, dest):
+        """Creates `dest` from a blob: a reflink where possible, otherwise a copy."""
+        if not self._clone(blob, dest):
+            shutil.copyfile(blob, dest)
+
+    def _clone(self, src, dst):
+        return self.reflinks_supported and reflink(src, dst)
+
+    def close(self):
+        self._db.close()
+
+
+def url_key(url, site=None):
+    """Index key for a chapter URL; relative URLs (Tokybook) are qualified by site."""
+    if "://" in url:
+        return url
+    return f"{site}:{url}"
@@ -0,0 +1,192 @@
+import collections
+import contextvars
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from metrics import metrics
+
+
+class RequestCancelled(Exception):
+    """Raised inside a worker whose request lost a hedging race."""
+
+
+class AttemptsExhausted(Exception):
+    """Raised by run_hedged once every attempt at a job has failed."""
+
+
+class LatencyTracker:
+    """
+    Per-host sliding window of request durations and throughput.
+
+    Used to decide when a request is slow enough to hedge (slower than the
+    host's p95) and to size request timeouts from the throughput actually
+    observed instead of a fixed value.
+    """
+
+    def __init__(self, window=200, min_samples=20):
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._seconds = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.window)
+        )
+        self._bytes = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.window)
+        )
+
+    def observe(self, host, seconds, nbytes=None):
+        with self._lock:
+            self._seconds[host].append(seconds)
+            if nbytes:
+                self._bytes[host].append((nbytes, seconds))
+
+    def quantile(self, host, q):
+        """Returns the `q` quantile of recent durations, or None without enough data."""
+        with self._lock:
+            samples = sorted(self._seconds[host])
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def hedge_delay(self, host):
+        """How long a request may run before a duplicate is sent (p95), or None."""
+        return self.quantile(host, 0.95)
+
+    def throughput(self, host):
+        """Recent bytes/sec per request for `host`, or None."""
+        with self._lock:
+            samples = list(self._bytes[host])
+        seconds = sum(s for _, s in samples)
+        if len(samples) < self.min_samples or not seconds:
+            return None
+        return sum(n for n, _ in samples) / seconds
+
+    def timeout(self, host, nbytes=None, default=10.0, floor=3.0, ceiling=30.0):
+        """
+        Read timeout for a request of about `nbytes` to `host`: four times the
+        time the measured throughput predicts, within [floor, ceiling].
+        """
+        throughput = self.throughput(host)
+        if throughput is None:
+            return default
+        if nbytes is None:
+            expected = self.quantile(host, 0.5)
+        else:
+            expected = nbytes / throughput
+        return max(floor, min(ceiling, 4 * expected))
+
+    def reset(self):
+        with self._lock:
+            self._seconds.clear()
+            self._bytes.clear()
+
+
+def run_hedged(
+    executor,
+    worker,
+    jobs,
+    host,
+    on_result=None,
+    budget=0.1,
+    hedge_workers=4,
+    max_attempts=3,
+):
+    """
+    Runs `worker(job, cancel)` for every job on `executor` and returns the
+    results in job order, hedging slow ones.
+
+    A job whose latest attempt has run longer than the host's p95 duration
+    gets a duplicate request on a separate small pool (at most `max_attempts`
+    in flight); the first attempt to succeed wins and the others see their
+    `cancel` event set. A result of None (or an exception) counts as a
+    failure, and the run fails with AttemptsExhausted once every attempt at
+    a job has failed; exceptions raised by `on_result` are passed on.
+    At most `budget` * len(jobs) extra requests are sent. `on_result(index,
+    result)` is called as soon as each job completes, in completion order.
+    """
+    if not jobs:
+        return []
+    results = [None] * len(jobs)
+    cancels = [threading.Event() for _ in jobs]
+    started = {}
+    attempts = collections.defaultdict(int)
+    finished = set()
+    max_hedges = max(1, int(len(jobs) * budget))
+    hedges = 0
+    hedge_futures = set()
+
+    def run(index):
+        started[index] = time.perf_counter()
+        return worker(jobs[index], cancels[index])
+
+    # Attempts run in a copy of the caller's context (metrics book label)
+    pending = {
+        executor.submit(contextvars.copy_context().run, run, index): index
+        for index in range(len(jobs))
+    }
+    for index in pending.values():
+        attempts[index] += 1
+
+    hedge_pool = ThreadPoolExecutor(max_workers=hedge_workers)
+    try:
+        while len(finished) < len(jobs):
+            delay = latency.hedge_delay(host)
+            done, _ = wait(
+                pending,
+                timeout=delay / 4 if delay else None,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                index = pending.pop(future)
+                attempts[index] -= 1
+                try:
+                    result = future.result()
+                except Exception:
+                    result = None
+                if index in finished:
+                    continue
+                if result is None:
+                    if attempts[index] == 0:
+                        raise AttemptsExhausted("Segment download failed")
+                    continue
+                finished.add(index)
+                cancels[index].set()  # Stop the slower attempt, if any
+                if future in hedge_futures:
+                    metrics.inc("hedge_wins", host=host)
+                results[index] = result
+                if on_result is not None:
+                    on_result(index, result)
+
+            if delay is None or hedges >= max_hedges:
+                continue
+            now = time.perf_counter()
+            for index, start in list(started.items()):
+                if hedges >= max_hedges:
+                    break
+                if (
+                    index in finished
+                    or attempts[index] >= max_attempts
+                    or now - start < delay
+                ):
+                    continue
+                started[index] = now
+                future = hedge_pool.submit(
+                    contextvars.copy_context().run, worker, jobs[index], cancels[index]
+                )
+                pending[future] = index
+                hedge_futures.add(future)
+                attempts[index] += 1
+                hedges += 1
+                metrics.inc("hedged_requests", host=host)
+    finally:
+        # On failure, stop everything still queued or running
+        for future in pending:
+            future.cancel()
+        for cancel in cancels:
+            cancel.set()
+        hedge_pool.shutdown(wait=False)
+    return results
+
+
+latency = LatencyTracker()
@@ -0,0 +1,207 @@
+import re
+from urllib.parse import urljoin
+
+from Cryptodome.Cipher import AES
+
+# Audio-only variants below this bandwidth are considered too low quality
+MIN_AUDIO_BANDWIDTH = 64_000
+
+_ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+_VIDEO_CODECS = ("avc1", "avc3", "hvc1", "hev1", "vp09", "av01")
+
+
+class PlaylistError(Exception):
+    """Raised for playlists that can't be parsed or downloaded."""
+
+
+def parse_attributes(text):
+    """Parses an HLS attribute list (KEY=VALUE,KEY="VALUE",...) into a dict."""
+    return {
+        key: value[1:-1] if value.startswith('"') else value
+        for key, value in _ATTRIBUTE.findall(text)
+    }
+
+
+def parse_playlist(text, base_url):
+    """
+    Parses an m3u8 playlist. URIs are resolved against `base_url`.
+
+    Returns either a master playlist:
+        {"type": "master", "variants": [{"url", "bandwidth", "codecs",
+         "audio"}], "audio": [{"url", "group", "name", "default"}]}
+    or a media playlist:
+        {"type": "media", "segments": [{"url", "duration", "sequence",
+         "byterange", "key"}], "duration", "target_duration", "ended"}
+
+    `byterange` is (length, offset) or None. `key` is None or
+    {"method", "url", "iv"}, where `iv` is the explicit IV as bytes or None
+    (the segment's sequence number is the IV then).
+    """
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines or lines[0] != "#EXTM3U":
+        raise PlaylistError("Not an m3u8 playlist")
+
+    if any(line.startswith("#EXT-X-STREAM-INF") for line in lines):
+        return _parse_master(lines, base_url)
+    return _parse_media(lines, base_url)
+
+
+def _parse_master(lines, base_url):
+    variants, audio = [], []
+    pending = None
+    for line in lines:
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            pending = parse_attributes(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-MEDIA:"):
+            attrs = parse_attributes(line.split(":", 1)[1])
+            if attrs.get("TYPE") == "AUDIO" and attrs.get("URI"):
+                audio.append(
+                    {
+                        "url": urljoin(base_url, attrs["URI"]),
+                        "group": attrs.get("GROUP-ID"),
+                        "name": attrs.get("NAME"),
+                        "default": attrs.get("DEFAULT") == "YES",
+                    }
+                )
+        elif not line.startswith("#") and pending is not None:
+            variants.append(
+                {
+                    "url": urljoin(base_url, line),
+                    "bandwidth": int(pending.get("BANDWIDTH") or 0),
+                    "codecs": pending.get("CODECS", ""),
+                    "audio": pending.get("AUDIO"),
+                }
+            )
+            pending = None
+    return {"type": "master", "variants": variants, "audio": audio}
+
+
+def _parse_media(lines, base_url):
+    segments = []
+    sequence = 0
+    duration = None
+    byterange = None
+    key = None
+    target_duration = None
+    ended = False
+    next_offset = {}  # Byte ranges without an offset continue the previous range
+
+    for line in lines:
+        if line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+            sequence = int(line.split(":", 1)[1])
+        elif line.startswith("#EXT-X-TARGETDURATION:"):
+            target_duration = float(line.split(":", 1)[1])
+        elif line.startswith("#EXTINF:"):
+            duration = float(line.split(":", 1)[1].split(",", 1)[0])
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            length, _, offset = line.split(":", 1)[1].partition("@")
+            byterange = (int(length), int(offset) if offset else None)
+        elif line.startswith("#EXT-X-KEY:"):
+            attrs = parse_attributes(line.split(":", 1)[1])
+            method = attrs.get("METHOD", "NONE")
+            if method == "NONE":
+                key = None
+            elif method == "AES-128":
+                iv = attrs.get("IV")
+                key = {
+                    "method": method,
+                    "url": urljoin(base_url, attrs["URI"]),
+                    "iv": bytes.fromhex(iv[2:].zfill(32)) if iv else None,
+                }
+            else:
+                raise PlaylistError(f"Unsupported encryption method {method}")
+        elif line.startswith("#EXT-X-MAP:"):
+            raise PlaylistError("Fragmented MP4 playlists are not supported")
+        elif line == "#EXT-X-ENDLIST":
+            ended = True
+        elif not line.startswith("#"):
+            url = urljoin(base_url, line)
+            if byterange is not None:
+                length, offset = byterange
+                if offset is None:
+                    offset = next_offset.get(url, 0)
+                next_offset[url] = offset + length
+                byterange = (length, offset)
+            segments.append(
+                {
+                    "url": url,
+                    "duration": duration,
+                    "sequence": sequence,
+                    "byterange": byterange,
+                    "key": key,
+                }
+            )
+            sequence += 1
+            duration = byterange = None
+
+    return {
+        "type": "media",
+        "segments": segments,
+        "duration": sum(s["duration"] or 0 for s in segments),
+        "target_duration": target_duration,
+        "ended": ended,
+    }
+
+
+def select_variant(master, min_bandwidth=MIN_AUDIO_BANDWIDTH):
+    """
+    Picks the URL of the smallest adequate audio stream of a master playlist:
+    an audio rendition if there are any, otherwise the lowest-bandwidth
+    audio-only variant of at least `min_bandwidth` (the best one if none is
+    that good), falling back to the lowest-bandwidth variant of all.
+    """
+    if master["audio"]:
+        default = [a for a in master["audio"] if a["default"]]
+        return (default or master["audio"])[0]["url"]
+    variants = sorted(master["variants"], key=lambda v: v["bandwidth"])
+    if not variants:
+        raise PlaylistError("Master playlist has no variants")
+    audio_only = [
+        v for v in variants if not any(codec in v["codecs"] for codec in _VIDEO_CODECS)
+    ]
+    adequate = [v for v in audio_only if v["bandwidth"] >= min_bandwidth]
+    if adequate:
+        return adequate[0]["url"]
+    if audio_only:
+        return audio_only[-1]["url"]
+    return variants[0]["url"]
+
+
+def range_header(segment):
+    """Range header value for a byte-range segment, or None."""
+    if not segment.get("byterange"):
+        return None
+    length, offset = segment["byterange"]
+    return f"bytes={offset}-{offset + length - 1}"
+
+
+class SegmentDecryptor:
+    """
+    Decrypts an AES-128 (CBC, PKCS#7) segment chunk by chunk as it streams in.
+    Bytes are held back only up to the next block boundary, plus the final
+    block until `finalize()` strips its padding.
+    """
+
+    def __init__(self, key, segment):
+        iv = segment["key"]["iv"] or segment["sequence"].to_bytes(16, "big")
+        self._cipher = AES.new(key, AES.MODE_CBC, iv)
+        self._pending = b""
+
+    def update(self, chunk):
+        data = self._pending + chunk
+        # Always keep the last full block back: it may carry the padding
+        keep = len(data) % AES.block_size or AES.block_size
+        self._pending = data[-keep:]
+        return self._cipher.decrypt(data[:-keep]) if len(data) > keep else b""
+
+    def finalize(self):
+        if len(self._pending) != AES.block_size:
+            raise PlaylistError("Encrypted segment is not a whole number of blocks")
+        block = self._cipher.decrypt(self._pending)
+        padding = block[-1]
+        if (
+            not 1 <= padding <= AES.block_size
+            or block[-padding:] != bytes([padding]) * padding
+        ):
+            raise PlaylistError("Bad padding in encrypted segment")
+        return block[:-padding]
@@ -0,0 +1,402 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+from rich.console import Console
+from rich.table import Table
+
+from verify import MANIFEST_NAME, load_manifest
+
+console = Console()
+
+# The index lives in the Audiobooks folder it describes
+INDEX_NAME = ".library.sqlite"
+DEFAULT_PATH = os.path.join("Audiobooks", INDEX_NAME)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    source_url TEXT UNIQUE NOT NULL,
+    site TEXT,
+    title TEXT,
+    sanitized_title TEXT NOT NULL,
+    author TEXT,
+    narrator TEXT,
+    year TEXT,
+    chapter_count INTEGER,
+    total_bytes INTEGER DEFAULT 0,
+    tag_state TEXT DEFAULT 'pending',
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS books_by_title ON books (sanitized_title);
+CREATE TABLE IF NOT EXISTS chapters (
+    book_id INTEGER NOT NULL REFERENCES books (id) ON DELETE CASCADE,
+    file_name TEXT NOT NULL,
+    track INTEGER,
+    title TEXT,
+    url TEXT,
+    size INTEGER,
+    sha256 TEXT,
+    duration REAL,
+    tagged INTEGER DEFAULT 0,
+    updated REAL,
+    PRIMARY KEY (book_id, file_name)
+);
+CREATE INDEX IF NOT EXISTS chapters_by_hash ON chapters (sha256);
+"""
+
+
+class Library:
+    """
+    Persistent SQLite index of downloaded books and chapters.
+
+    The downloader updates it after every chapter, so "is this book/chapter
+    already here?" and duplicate checks are single indexed lookups instead of
+    filesystem walks, and can be answered before any network request.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._db.execute(sql, params)
+            self._db.commit()
+            return cursor
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    # --- Books ---
+
+    def get_book(self, source_url):
+        rows = self._query("SELECT * FROM books WHERE source_url = ?", (source_url,))
+        return rows[0] if rows else None
+
+    def books_with_title(self, sanitized_title):
+        return self._query(
+            "SELECT * FROM books WHERE sanitized_title = ?", (sanitized_title,)
+        )
+
+    def find_conflicts(self, source_url, sanitized_title):
+        """Other books that already use the same folder name."""
+        return [
+            row
+            for row in self.books_with_title(sanitized_title)
+            if row["source_url"] != source_url
+        ]
+
+    def upsert_book(self, book_data, source_url):
+        """Creates or updates the book's row and returns its id."""
+        self._execute(
+            """
+            INSERT INTO books (source_url, site, title, sanitized_title, author,
+                               narrator, year, chapter_count, updated)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (source_url) DO UPDATE SET
+                site = excluded.site,
+                title = excluded.title,
+                sanitized_title = excluded.sanitized_title,
+                author = excluded.author,
+                narrator = excluded.narrator,
+                year = excluded.year,
+                chapter_count = excluded.chapter_count,
+                updated = excluded.updated
+            """,
+            (
+                source_url,
+                book_data.get("site"),
+                book_data.get("title"),
+                book_data["title"],
+                book_data.get("author"),
+                book_data.get("narrator"),
+                book_data.get("year"),
+                book_data.get("total_chapters_count", len(book_data["chapters"])),
+                time.time(),
+            ),
+        )
+        return self.get_book(source_url)["id"]
+
+    def all_books(self):
+        return self._query("SELECT * FROM books ORDER BY sanitized_title")
+
+    def search(self, text):
+        pattern = f"%{text}%"
+        return self._query(
+            "SELECT * FROM books WHERE title LIKE ? OR author LIKE ? "
+            "OR sanitized_title LIKE ? OR source_url LIKE ? ORDER BY sanitized_title",
+            (pattern, pattern, pattern, pattern),
+        )
+
+    # --- Chapters ---
+
+    def chapters(self, book_id):
+        """Returns {file name: row} for the book, for O(1) per-chapter lookups."""
+        rows = self._query("SELECT * FROM chapters WHERE book_id = ?", (book_id,))
+        return {row["file_name"]: row for row in rows}
+
+    def record_chapter(
+        self,
+        book_id,
+        file_name,
+        track=None,
+        title=None,
+        url=None,
+        size=None,
+        sha256=None,
+        duration=None,
+        tagged=True,
+    ):
+        with self._lock:
+            self._db.execute(
+                """
+                INSERT OR REPLACE INTO chapters
+                    (book_id, file_name, track, title, url, size, sha256,
+                     duration, tagged, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    book_id,
+                    file_name,
+                    track,
+                    title,
+                    url,
+                    size,
+                    sha256,
+                    duration,
+                    int(tagged),
+                    time.time(),
+                ),
+            )
+            self._db.execute(
+                """
+                UPDATE books SET
+                    total_bytes = (SELECT COALESCE(SUM(size), 0) FROM chapters
+                                   WHERE book_id = :id),
+                    tag_state = CASE WHEN (SELECT COUNT(*) FROM chapters
+                                           WHERE book_id = :id AND tagged = 0) = 0
+                                THEN 'tagged' ELSE 'partial' END,
+                    updated = :now
+                WHERE id = :id
+                """,
+                {"id": book_id, "now": time.time()},
+            )
+            self._db.commit()
+
+    def remove_chapter(self, book_id, file_name):
+        self._execute(
+            "DELETE FROM chapters WHERE book_id = ? AND file_name = ?",
+            (book_id, file_name),
+        )
+
+    def update_metadata(self, book_id, author=None, narrator=None, year=None):
+        """Overwrites the given (non-empty) metadata fields of a book."""
+        self._execute(
+            """
+            UPDATE books SET
+                author = COALESCE(?, author),
+                narrator = COALESCE(?, narrator),
+                year = COALESCE(?, year),
+                updated = ?
+            WHERE id = ?
+            """,
+            (author or None, narrator or None, year or None, time.time(), book_id),
+        )
+
+    def duplicate_hashes(self):
+        """Audio hashes (see dedup.AudioHasher) shared by more than one chapter."""
+        rows = self._query(
+            "SELECT sha256 FROM chapters WHERE sha256 IS NOT NULL "
+            "GROUP BY sha256 HAVING COUNT(*) > 1 ORDER BY sha256"
+        )
+        return [row["sha256"] for row in rows]
+
+    def books_with_chapter_hash(self, sha256):
+        return self._query(
+            "SELECT DISTINCT books.* FROM books JOIN chapters "
+            "ON chapters.book_id = books.id WHERE chapters.sha256 = ?",
+            (sha256,),
+        )
+
+    def reindex(self, root="Audiobooks", hash_missing=False, workers=None):
+        """
+        Adds every book folder under `root` that has a download manifest.
+        Folders not yet in the index are keyed by their path ("file://...")
+        since the source URL isn't recorded in the manifest. With
+        `hash_missing`, chapters without a recorded SHA-256 are hashed, on a
+        process per core.
+        Returns the number of books added.
+        """
+        digests = {}
+        if hash_missing:
+            from parallel import hash_files
+
+            digests = hash_files(
+                [
+                    os.path.join(book_dir, name)
+                    for book_dir, name, record in _manifest_chapters(root)
+                    if not record.get("sha256")
+                ],
+                workers,
+            )
+        added = 0
+        for entry in sorted(os.scandir(root), key=lambda e: e.name):
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+            if not os.path.exists(os.path.join(entry.path, MANIFEST_NAME)):
+                continue
+            manifest = load_manifest(entry.path)
+            existing = self.books_with_title(entry.name)
+            if existing:
+                book_id = existing[0]["id"]
+            else:
+                book_id = self.upsert_book(
+                    {"title": entry.name, "chapters": list(manifest)},
+                    f"file://{os.path.abspath(entry.path)}",
+                )
+                added += 1
+            indexed = self.chapters(book_id)
+            for track, (file_name, record) in enumerate(sorted(manifest.items()), 1):
+                if not os.path.exists(os.path.join(entry.path, file_name)):
+                    continue
+                self.record_chapter(
+                    book_id,
+                    file_name,
+                    track=track,
+                    title=os.path.splitext(file_name)[0],
+                    url=record.get("url"),
+                    size=record.get("size"),
+                    sha256=record.get("sha256")
+                    or digests.get(os.path.join(entry.path, file_name))
+                    or (
+                        indexed[file_name]["sha256"] if file_name in indexed else None
+                    ),
+                    duration=record.get("duration"),
+                )
+        return added
+
+    def close(self):
+        self._db.close()
+
+
+def _manifest_chapters(root):
+    """Yields (book_dir, file name, manifest record) for chapters on disk."""
+    for entry in os.scandir(root):
+        if not entry.is_dir() or entry.name.startswith("."):
+            continue
+        for name, record in load_manifest(entry.path).items():
+            if os.path.exists(os.path.join(entry.path, name)):
+                yield entry.path, name, record
+
+
+def print_books(rows, title="Library"):
+    table = Table(title=title, show_lines=False)
+    table.add_column("Title", style="bold cyan")
+    table.add_column("Author")
+    table.add_column("Site")
+    table.add_column("Chapters", justify="right")
+    table.add_column("Size (MiB)", justify="right")
+    table.add_column("Tags")
+    for row in rows:
+        table.add_row(
+            row["sanitized_title"],
+            row["author"] or "",
+            row["site"] or "",
+            str(row["chapter_count"] or 0),
+            f"{(row['total_bytes'] or 0) / 2**20:.1f}",
+            row["tag_state"] or "",
+        )
+    console.print(table)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the library index.")
+    parser.add_argument("--db", default=DEFAULT_PATH, help="Index file.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="List every indexed book.")
+    find = sub.add_parser("find", help="Search titles, authors and URLs.")
+    find.add_argument("text")
+    show = sub.add_parser("show", help="Show the chapters of a book by source URL.")
+    show.add_argument("url")
+    dupes = sub.add_parser(
+        "dupes", help="Find books sharing chapter audio, or holding a given chapter."
+    )
+    dupes.add_argument(
+        "target", nargs="?", help="An MP3 file or audio hash to look up."
+    )
+    reindex = sub.add_parser("reindex", help="Index existing book folders.")
+    reindex.add_argument("root", nargs="?", default="Audiobooks")
+    reindex.add_argument(
+        "--hash",
+        action="store_true",
+        help="Hash chapters that have no recorded SHA-256 (one process per core).",
+    )
+    args = parser.parse_args()
+
+    library = Library(args.db)
+    if args.command == "list":
+        print_books(library.all_books())
+    elif args.command == "find":
+        print_books(library.search(args.text), title=f"Matches for '{args.text}'")
+    elif args.command == "show":
+        book = library.get_book(args.url)
+        if not book:
+            console.print("[red]Not in the library.[/red]")
+            raise SystemExit(1)
+        print_books([book], title="Book")
+        table = Table(show_lines=False)
+        table.add_column("#", justify="right")
+        table.add_column("File")
+        table.add_column("Size (MiB)", justify="right")
+        table.add_column("SHA-256")
+        for row in sorted(
+            library.chapters(book["id"]).values(), key=lambda r: r["track"] or 0
+        ):
+            table.add_row(
+                str(row["track"] or ""),
+                row["file_name"],
+                f"{(row['size'] or 0) / 2**20:.1f}",
+                (row["sha256"] or "")[:12],
+            )
+        console.print(table)
+    elif args.command == "dupes":
+        if args.target is None:
+            hashes = library.duplicate_hashes()
+        elif os.path.isfile(args.target):
+            from dedup import hash_audio
+
+            hashes = [hash_audio(args.target)]
+        else:
+            hashes = [args.target.lower()]
+        title = "Duplicate chapter audio" if args.target is None else "Books"
+        table = Table(title=title, show_lines=False)
+        table.add_column("SHA-256")
+        table.add_column("Books", style="bold cyan")
+        for sha256 in hashes:
+            books = library.books_with_chapter_hash(sha256)
+            if books:
+                table.add_row(
+                    sha256[:12], "\n".join(row["sanitized_title"] for row in books)
+                )
+        if not table.row_count:
+            console.print(
+                "[green]No duplicates found.[/green]"
+                if args.target is None
+                else "[yellow]No indexed chapter has this audio.[/yellow]"
+            )
+        else:
+            console.print(table)
+    elif args.command == "reindex":
+        added = library.reindex(args.root, hash_missing=args.hash)
+        console.print(f"[green]Indexed {added} new books.[/green]")
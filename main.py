@@ -1,31 +1,39 @@
+import argparse
 import os
 import requests
-import subprocess
+import threading
+import webbrowser
 from http.client import IncompleteRead
-from mutagen.id3 import (
-    ID3,
-    APIC,
-    TALB,
-    TPE1,
-    TPE2,
-    TCON,
-    TDRC,
-    TRCK,
-    TIT2,
-    ID3NoHeaderError,
-)
 from rich.table import Table
 from rich.console import Console
 from rich.progress import Progress
 import time
 
-from scrapers.tokybook import TokybookScraper
+from scrapers.tokybook import TokybookScraper, TokybookPlaylistPrefetcher
 from scrapers.goldenaudiobook import GoldenAudiobookScraper
 from scrapers.zaudiobooks import ZaudiobooksScraper
 from scrapers.fulllengthaudiobooks import FulllengthAudiobooksScraper
 from scrapers.hdaudiobooks import HDAudiobooksScraper
 from scrapers.bigaudiobooks import BigAudiobooksScraper
-from utils import sanitize_book_title, parse_chapter_ranges
+from ytdlp_worker import YtdlpWorker
+from metrics import metrics, host_of
+from profiling import profiler
+from throttle import limiter
+from dedup import AudioHasher, BlobStore, hash_audio, url_key
+from library import Library
+from mirrors import MirrorForbidden, MirrorSet
+from retry import default_policy, is_transient, status_of
+from preflight import preflight
+from remux import BACKENDS, RemuxError, ffmpeg_available, remuxer
+from tagging import tag_chapter
+from scheduler import ORDERS, chapter_weights, run_schedule, schedule_chapters
+from verify import load_manifest, save_manifest, quick_check
+from utils import (
+    sanitize_book_title,
+    parse_chapter_ranges,
+    is_direct_mp3_url,
+    parse_size,
+)
 
 
 console = Console()
@@ -48,30 +56,128 @@ def get_scraper(url):
     return None
 
 
-def download_and_tag_audiobook(book_data):
+def new_session():
+    """requests.Session with a connection pool sized for chapter downloads."""
+    session = requests.Session()
+    # One pooled connection per host is reused across every chapter of the book
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=10)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_and_tag_audiobook(
+    book_data,
+    blob_store=None,
+    library=None,
+    chapter_workers=1,
+    order=None,
+    mirrors=None,
+    session=None,
+    cancel=None,
+    on_chapter=None,
+    only=None,
+    record=None,
+    playlists=None,
+):
+    """
+    Downloads and tags every chapter in book_data["chapters"].
+
+    Up to `chapter_workers` chapters run at once, started in `order` (see
+    scheduler.schedule_chapters; by default longest first when running in
+    parallel, book order otherwise). With a benchmarked mirrors.MirrorSet,
+    each chapter comes from the fastest healthy mirror instead.
+
+    A long-running caller (see daemon.py) can pass its own `session` to keep
+    connections warm, a threading.Event `cancel` that stops chapters from
+    starting, and `on_chapter(chapter, outcome)`, called with "done",
+    "skipped" or "failed" as each chapter finishes.
+
+    A cluster worker (see cluster.py) passes `only`, the indices of the
+    chapters to download (resume checks still see the whole book), and
+    `record(file_name, entry)`, which reports each finished chapter instead
+    of writing the manifest and library index itself (a `library` given
+    along with it is only read).
+
+    `playlists` are Tokybook playlists already fetched by the preflight, by
+    chapter index.
+    """
     sanitized_title = book_data["title"]
-    author_name = book_data.get("author")
-    narrator_name = book_data.get("narrator")
-    year_text = book_data.get("year")
-    artwork_data = book_data.get("artwork_data")
-    mime_type = book_data.get("mime_type")
 
     book_dir = os.path.join(os.getcwd(), "Audiobooks", sanitized_title)
     os.makedirs(book_dir, exist_ok=True)
-
-    total_chapters = len(book_data["chapters"])
+    manifest = load_manifest(book_dir)
+    # Chapters the library index already knows are complete and tagged
+    book_id = indexed = None
+    if library is not None and book_data.get("book_url") and record is not None:
+        # A cluster worker only reads the index: the coordinator writes it
+        book = library.get_book(book_data["book_url"])
+        indexed = library.chapters(book["id"]) if book is not None else None
+    elif library is not None and book_data.get("book_url"):
+        book_id = library.upsert_book(book_data, book_data["book_url"])
+        indexed = library.chapters(book_id)
+
+    # Track numbers count the whole book, even when only some chapters are selected
+    total_tracks = book_data.get("total_chapters_count", len(book_data["chapters"]))
+    order = order or ("longest" if chapter_workers > 1 else "list")
+    schedule = schedule_chapters(book_data["chapters"], order)
+    if only is not None:
+        only = set(only)
+        schedule = [index for index in schedule if index in only]
+    total_chapters = len(schedule)
+    # Progress is weighted by duration (or size) so the ETA reflects the work left
+    weights = chapter_weights(book_data["chapters"])
     console.print(
-        f"\n[green]Found {total_chapters} chapters. Starting download...[/green]\n"
+        f"\n[green]Found {total_chapters} chapters. Starting download "
+        f"({order} order, {chapter_workers} at a time)...[/green]\n"
     )
 
-    with Progress() as progress:
+    with Progress() as progress, metrics.book(sanitized_title):
         task = progress.add_task(
-            f"[cyan]Downloading {sanitized_title}...", total=total_chapters
+            f"[cyan]Downloading {sanitized_title}...",
+            total=sum(weights[index] for index in schedule),
         )
-        session = requests.Session()
-        for i, chapter in enumerate(book_data["chapters"], start=1):
+        state_lock = threading.Lock()
+        pending = [total_chapters]
+        remaining = [sum(weights[index] for index in schedule)]
+        session = session or new_session()
+        # Created on first use and shared by every chapter that needs yt-dlp
+        ytdlp = None
+
+        def get_ytdlp():
+            nonlocal ytdlp
+            with state_lock:
+                if ytdlp is None:
+                    ytdlp = YtdlpWorker(book_data.get("site_headers"), progress)
+                return ytdlp
+
+        prefetcher = None
+        if book_data.get("site") == "tokybook.com":
+            prefetcher = TokybookPlaylistPrefetcher(
+                book_data["chapters"],
+                book_data,
+                ahead=max(3, chapter_workers + 1),
+                order=schedule,
+                playlists=playlists,
+            )
+
+        def skip(weight):
+            # Already-downloaded chapters aren't work: drop them from the ETA
+            with state_lock:
+                remaining[0] -= weight
+                progress.update(task, total=remaining[0])
+
+        def download_chapter(i, chapter):
+            if cancel is not None and cancel.is_set():
+                return None
             link = chapter["url"]
             chapter_title = chapter["title"]
+            host = host_of(link, book_data.get("site"))
+            track = chapter.get("track_num", i)
+            weight = weights[i - 1]
+            with state_lock:
+                pending[0] -= 1
+                metrics.set_gauge("chapters_pending", pending[0])
             # Formatting chapter names with leading zeros for sorting (e.g., Chapter 001.mp3)
             # This handles the user request for "f'Chapter {i:03}'" naming if the scraped title isn't sufficient
             # But usually we respect the scraped title.
@@ -81,154 +187,242 @@ def download_and_tag_audiobook(book_data):
 
             final_file_name = os.path.join(book_dir, f"{chapter_title}.mp3")
 
+            resumed = False
             try:
                 # --- CHECK IF FILE EXISTS ---
-                if os.path.exists(final_file_name):
-                    # For Tokybook, the user requested "Smart Resume" logic (redownload last file).
-                    # Since this loop runs linearly 1..N, if we find a file exists:
-                    # 1. We check if the NEXT file also exists.
-                    # 2. If the NEXT file exists, we assume THIS one is fine and skip.
-                    # 3. If the NEXT file does NOT exist, we assume THIS one is the "last modified" and redownload it.
-
-                    next_chapter_idx = i  # 'i' is 1-based, list is 0-based, so book_data["chapters"][i] is the NEXT one
-                    is_last_existing = False
-
-                    if next_chapter_idx < len(book_data["chapters"]):
-                        # Construct next filename to check
-                        next_title = book_data["chapters"][next_chapter_idx]["title"]
-                        next_path = os.path.join(book_dir, f"{next_title}.mp3")
-                        if not os.path.exists(next_path):
-                            is_last_existing = True
-                    else:
-                        # This is the very last chapter of the book and it exists
-                        is_last_existing = True
-
-                    if book_data.get("site") == "tokybook.com" and is_last_existing:
-                        progress.log(
-                            f"[yellow]Resume detected: Redownloading last found file ({chapter_title})...[/yellow]"
-                        )
-                        # Allow to fall through to download logic below
-                    else:
-                        progress.log(
-                            f"[dim]Skipping {chapter_title}, already exists.[/dim]"
-                        )
-                        progress.advance(task)
-                        continue
+                file_key = os.path.basename(final_file_name)
+                index_entry = indexed.get(file_key) if indexed else None
+                index_entry = dict(index_entry) if index_entry else None
+                if os.path.exists(final_file_name) and not quick_check(
+                    final_file_name, manifest.get(file_key) or index_entry
+                ):
+                    progress.log(
+                        f"[yellow]{chapter_title} is incomplete, downloading it again...[/yellow]"
+                    )
+                elif os.path.exists(final_file_name) and (
+                    file_key in manifest or (index_entry and index_entry["tagged"])
+                ):
+                    # Both are recorded only after tagging: nothing left to do
+                    progress.log(f"[dim]Skipping {chapter_title}, already exists.[/dim]")
+                    skip(weight)
+                    return "skipped"
+                elif os.path.exists(final_file_name):
+                    # Every download is written under a temporary name (.part,
+                    # .part.mp3) and renamed once complete, so an existing file
+                    # that passed the check above is whole, whatever order the
+                    # chapters ran in. With no manifest or index entry the run
+                    # stopped before tagging it: tag it instead of downloading.
+                    resumed = True
 
                 # --- DOWNLOAD LOGIC ---
+                blob_key = url_key(link, book_data.get("site"))
+                blob = blob_store.lookup(blob_key) if blob_store else None
+                digest = None
 
-                # 1. TOKYBOOK (New Parallel Downloader)
-                if book_data.get("site") == "tokybook.com":
+                # RESUMED: downloaded by an interrupted run, only tagging left
+                if resumed:
                     progress.log(
-                        f"[cyan]Downloading {chapter_title} (Parallel)...[/cyan]"
+                        f"[yellow]Resume detected: tagging {chapter_title}...[/yellow]"
                     )
-                    # Download to a temporary TS file first (Tokybook streams are MPEG-TS)
-                    temp_ts_file = os.path.join(book_dir, f"{chapter_title}.ts")
-                    TokybookScraper.download_chapter(
-                        chapter, book_data, temp_ts_file, progress
+
+                # 0. ALREADY IN THE BLOB STORE (same URL in another book or run)
+                elif blob:
+                    progress.log(
+                        f"[dim]Reusing {chapter_title} from the blob store...[/dim]"
                     )
+                    blob_store.materialize(blob, final_file_name)
+                    digest = os.path.basename(blob)
+                    metrics.inc("dedup_hits", host=host)
 
-                    # Convert TS to proper MP3 using FFmpeg to ensure metadata tags work
-                    progress.log(f"[dim]Converting {chapter_title} to MP3...[/dim]")
-                    try:
-                        subprocess.run(
-                            [
-                                "ffmpeg",
-                                "-i",
-                                temp_ts_file,
-                                "-y",  # Overwrite output
-                                "-vn",  # No video
-                                "-acodec",
-                                "libmp3lame",
-                                "-q:a",
-                                "2",  # VBR Quality ~190kbps
-                                "-loglevel",
-                                "error",
+                # 1. MIRRORS (same book on several sites, fastest healthy one)
+                elif mirrors is not None:
+                    progress.log(f"[cyan]Downloading {chapter_title}...[/cyan]")
+
+                    def fetch(mirror_chapter, mirror_book):
+                        nonlocal digest
+                        try:
+                            digest = download_chapters_session(
+                                session,
+                                mirror_chapter["url"],
                                 final_file_name,
-                            ],
-                            check=True,
+                                mirror_book.get("site_headers", {}),
+                                chapter_title,
+                                progress,
+                                max_attempts=1,
+                                open_on_forbidden=False,
+                            )
+                        except Exception as e:
+                            if status_of(e.__cause__) == 403:
+                                raise MirrorForbidden(mirror_chapter["url"]) from e
+                            raise
+                        return os.path.getsize(final_file_name)
+
+                    mirror, _ = mirrors.download(track - 1, fetch, progress)
+                    link = mirror.chapters[track - 1]["url"]
+
+                # 2. TOKYBOOK (New Parallel Downloader)
+                elif book_data.get("site") == "tokybook.com":
+                    progress.log(
+                        f"[cyan]Downloading {chapter_title} (Parallel)...[/cyan]"
+                    )
+                    # Left behind by versions that downloaded to a .ts first
+                    stale_ts_file = os.path.join(book_dir, f"{chapter_title}.ts")
+                    if os.path.exists(stale_ts_file):
+                        os.remove(stale_ts_file)
+                    playlist = prefetcher.get(i - 1)
+
+                    def download_ts(stream):
+                        nonlocal playlist
+                        TokybookScraper.download_chapter(
+                            chapter, book_data, stream, progress, playlist=playlist
                         )
+                        playlist = None  # A fallback backend downloads afresh
 
-                        # Cleanup temp file
-                        if os.path.exists(temp_ts_file):
-                            os.remove(temp_ts_file)
-
-                    except subprocess.CalledProcessError:
+                    # Tokybook streams are MPEG-TS: converted to MP3 (PyAV or
+                    # FFmpeg) as they download, so metadata tags work.
+                    # Encode to a temporary name so a killed run never leaves a partial MP3
+                    temp_mp3_file = os.path.join(book_dir, f"{chapter_title}.part.mp3")
+                    try:
+                        backend, seconds, digest = remuxer.convert(
+                            temp_mp3_file, download_ts
+                        )
+                    except RemuxError as e:
+                        metrics.inc("chapters_failed", host=host)
                         progress.log(
-                            f"[red]FFmpeg conversion failed for {chapter_title}[/red]"
+                            f"[red]MP3 conversion failed for {chapter_title}: {e}[/red]"
                         )
-                        continue
-                # 2. GOLDEN / ZAUDIO (Session based)
+                        return "failed"
+                    progress.log(
+                        f"[dim]Converted {chapter_title} to MP3 with {backend} "
+                        f"in {seconds:.1f}s[/dim]"
+                    )
+                    os.replace(temp_mp3_file, final_file_name)
+                # 3. GOLDEN / ZAUDIO (Session based)
                 elif (
                     book_data.get("site") == "goldenaudiobook.net"
                     or book_data.get("site") == "zaudiobooks.com"
                 ):
                     headers = book_data.get("site_headers", {})
                     progress.log(f"[cyan]Downloading {chapter_title}...[/cyan]")
-                    download_chapters_session(
+                    digest = download_chapters_session(
                         session, link, final_file_name, headers, chapter_title, progress
                     )
 
-                # 3. GENERIC FALLBACK (yt-dlp)
+                # 4. DIRECT MP3 (fulllength / hd / big) - in-process, yt-dlp only if it fails
+                elif is_direct_mp3_url(link):
+                    headers = book_data.get("site_headers", {})
+                    progress.log(f"[cyan]Downloading {chapter_title}...[/cyan]")
+                    try:
+                        digest = download_chapters_session(
+                            session,
+                            link,
+                            final_file_name,
+                            headers,
+                            chapter_title,
+                            progress,
+                            max_attempts=2,
+                            open_on_forbidden=False,
+                        )
+                    except Exception as e:
+                        progress.log(
+                            f"[yellow]Direct download failed for {chapter_title} ({e}), falling back to yt-dlp...[/yellow]"
+                        )
+                        if os.path.exists(final_file_name):
+                            os.remove(final_file_name)
+                        metrics.inc("ytdlp_fallbacks", host=host)
+                        if not get_ytdlp().download(link, book_dir, chapter_title):
+                            metrics.inc("chapters_failed", host=host)
+                            progress.log(
+                                f"[red]Error downloading {chapter_title}[/red]"
+                            )
+                            return "failed"
+
+                # 5. GENERIC FALLBACK (yt-dlp)
                 else:
                     progress.log(
                         f"[cyan]Downloading {chapter_title} (yt-dlp)...[/cyan]"
                     )
-                    output_template = os.path.join(book_dir, f"{chapter_title}.%(ext)s")
-                    command = [
-                        "yt-dlp",
-                        "-x",
-                        "--audio-format",
-                        "mp3",
-                        "--audio-quality",
-                        "0",
-                        "--retries",
-                        "5",
-                    ]
-                    if book_data.get("site_headers"):
-                        for key, value in book_data["site_headers"].items():
-                            command.extend(["--add-header", f"{key}: {value}"])
-
-                    command.extend(["-o", output_template, link])
-                    result = subprocess.run(command, capture_output=True, text=True)
-
-                    if result.returncode != 0:
+                    with metrics.timer("ytdlp_download_seconds", host=host):
+                        downloaded = get_ytdlp().download(
+                            link, book_dir, chapter_title
+                        )
+                    if not downloaded:
+                        metrics.inc("chapters_failed", host=host)
                         progress.log(f"[red]Error downloading {chapter_title}[/red]")
-                        continue
+                        return "failed"
+
+                # yt-dlp and ffmpeg write the file themselves: hash it before tagging
+                if digest is None:
+                    digest = hash_audio(final_file_name)
+                # Store the untagged audio so other books and re-runs can reuse it
+                if blob_store and not blob:
+                    blob_store.ingest(final_file_name, blob_key, digest)
 
                 # --- Add ID3 tags ---
-                try:
-                    audio = ID3(final_file_name)
-                except ID3NoHeaderError:
-                    audio = ID3()
-
-                audio.add(TALB(encoding=3, text=sanitized_title))
-                audio.add(TCON(encoding=3, text="Audiobook"))
-                audio.add(TRCK(encoding=3, text=f"{i}/{total_chapters}"))
-                audio.add(TIT2(encoding=3, text=chapter_title))
-                if author_name:
-                    audio.add(TPE1(encoding=3, text=author_name))
-                if narrator_name:
-                    audio.add(TPE2(encoding=3, text=narrator_name))
-                if year_text:
-                    audio.add(TDRC(encoding=3, text=year_text))
-                if artwork_data and mime_type:
-                    audio.add(
-                        APIC(
-                            encoding=3,
-                            mime=mime_type,
-                            type=3,
-                            desc="Cover",
-                            data=artwork_data,
-                        )
+                with metrics.timer("tag_write_seconds"):
+                    tag_chapter(
+                        final_file_name,
+                        book_data,
+                        f"{track}/{total_tracks}",
+                        chapter_title,
+                    )
+                metrics.inc("chapters_completed", host=host)
+
+                file_key = os.path.basename(final_file_name)
+                entry = {
+                    "url": link,
+                    "size": os.path.getsize(final_file_name),
+                    "duration": chapter.get("duration"),
+                }
+                if record is not None:
+                    record(
+                        file_key,
+                        dict(entry, track=track, title=chapter_title, sha256=digest),
+                    )
+                else:
+                    with state_lock:
+                        manifest[file_key] = entry
+                        save_manifest(book_dir, manifest)
+                if book_id is not None:
+                    library.record_chapter(
+                        book_id,
+                        file_key,
+                        track=track,
+                        title=chapter_title,
+                        url=link,
+                        size=entry["size"],
+                        sha256=digest,
+                        duration=entry["duration"],
                     )
-                audio.save(final_file_name, v2_version=3)
 
             except Exception as e:
+                metrics.inc("chapters_failed", host=host)
                 console.print(f"[red]Error downloading {chapter_title}: {e}[/red]")
+                return "failed"
 
             progress.log(f"[green]✔ Completed {chapter_title}[/green]")
-            progress.advance(task)
+            progress.advance(task, weight)
+            return "done"
+
+        def run_chapter(index):
+            # Each chapter gets its own fair share of a --limit-rate cap
+            with limiter.consumer((sanitized_title, index)):
+                outcome = download_chapter(index + 1, chapters[index])
+            if on_chapter is not None and outcome is not None:
+                on_chapter(chapters[index], outcome)
+
+        chapters = book_data["chapters"]
+        run_schedule(
+            schedule,
+            run_chapter,
+            chapter_workers,
+            first_alone=order == "listen-first",
+        )
+
+        if ytdlp is not None:
+            ytdlp.close()
+        if prefetcher is not None:
+            prefetcher.close()
 
     console.print(
         "\n[bold green]All chapters downloaded and tagged successfully![/bold green]"
@@ -236,42 +430,228 @@ def download_and_tag_audiobook(book_data):
 
 
 def download_chapters_session(
-    session, url, final_file_name, headers, chapter_title, progress
+    session,
+    url,
+    final_file_name,
+    headers,
+    chapter_title,
+    progress,
+    max_attempts=5,
+    open_on_forbidden=True,
 ):
-    max_attempts = 5
+    """
+    Streams `url` to `final_file_name` and returns its audio hash (see
+    dedup.AudioHasher). Transient
+    errors are retried with the default retry policy; a host whose circuit
+    breaker is open fails straight away with retry.CircuitOpen.
+    """
+    host = host_of(url)
+    last_error = None
+    # Written under a temporary name so a killed run never leaves a truncated chapter
+    part_file_name = f"{final_file_name}.part"
     for attempt in range(max_attempts):
+        if attempt:
+            metrics.inc("retries", host=host)
+        received = 0
+        digest = AudioHasher()
+        default_policy.check(host)
+        start = time.perf_counter()
         try:
             with session.get(url, headers=headers, stream=True, timeout=(10, 180)) as r:
                 if r.status_code == 403:
-                    raise requests.exceptions.HTTPError("403 Forbidden")
+                    raise requests.exceptions.HTTPError("403 Forbidden", response=r)
                 r.raise_for_status()
-                with open(final_file_name, "wb") as f:
+                metrics.observe(
+                    "response_seconds", time.perf_counter() - start, host=host
+                )
+                expected = r.headers.get("Content-Length")
+                if r.headers.get("Content-Encoding"):
+                    expected = None  # Length of the compressed body, not the file
+                # Write into a .part file preallocated by the preflight, if any
+                mode = "r+b" if os.path.exists(part_file_name) else "wb"
+                with open(part_file_name, mode) as f:
                     for chunk in r.iter_content(chunk_size=8192):
                         if chunk:
+                            limiter.acquire(len(chunk))
                             f.write(chunk)
-            return
+                            digest.update(chunk)
+                            received += len(chunk)
+                    f.truncate()
+            if expected is not None and received != int(expected):
+                raise IncompleteRead(b"", int(expected) - received)
+            os.replace(part_file_name, final_file_name)
+            default_policy.record(host)
+            metrics.inc("bytes_downloaded", received, host=host)
+            metrics.observe(
+                "chapter_download_seconds", time.perf_counter() - start, host=host
+            )
+            return digest.hexdigest()
         except (requests.exceptions.RequestException, IncompleteRead) as e:
+            last_error = e
+            default_policy.record(host, e)
+            metrics.inc("bytes_downloaded", received, host=host)
+            metrics.inc("request_errors", host=host)
             progress.log(
                 f"[yellow]Attempt {attempt + 1} failed for {chapter_title}: {e}[/yellow] [link={url}]{url}[/link]"
             )
-            if isinstance(e, requests.exceptions.HTTPError) and "403" in str(e):
-                subprocess.run(["open", url])  # works only on macOS
-            if attempt < max_attempts - 1:
-                time.sleep(5**attempt)
+            # Opening the page lets the user pass the site's check before the retry
+            forbidden = open_on_forbidden and status_of(e) == 403
+            if forbidden:
+                webbrowser.open(url)
+            if attempt == max_attempts - 1 or not (forbidden or is_transient(e)):
+                break
+            delay = default_policy.delay(attempt, e)
+            if forbidden:
+                # Full jitter can be ~0s: leave the user time to pass the check
+                delay = max(delay, 5 ** (attempt + 1))
+            time.sleep(delay)
+    if os.path.exists(part_file_name):
+        os.remove(part_file_name)
     raise Exception(
-        f"Failed to download {chapter_title} ({url}) after {max_attempts} attempts"
-    )
+        f"Failed to download {chapter_title} ({url}) after {attempt + 1} attempts"
+    ) from last_error
 
 
 if __name__ == "__main__":
-    console.print("[bold cyan]--- Audiobook Downloader ---[/bold cyan]")
+    parser = argparse.ArgumentParser(description="Audiobook Downloader")
+    parser.add_argument(
+        "--metrics-json",
+        metavar="PATH",
+        help="Write a JSON summary of the run's metrics to PATH when it finishes.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        metavar="PORT",
+        help="Serve live metrics in Prometheus text format on localhost:PORT/metrics.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile scraping and downloading (cProfile + tracemalloc) and write "
+        "the reports to the book's profile/ folder.",
+    )
+    parser.add_argument(
+        "--limit-rate",
+        metavar="RATE",
+        help="Cap total download bandwidth, e.g. 500K or 2M (bytes/sec).",
+    )
+    parser.add_argument(
+        "--limit-rate-file",
+        metavar="PATH",
+        help="Read the bandwidth cap from PATH and re-read it whenever it changes.",
+    )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Keep one copy of every chapter in Audiobooks/.blobs and reuse it "
+        "across books and re-runs.",
+    )
+    parser.add_argument(
+        "--daemon",
+        nargs="?",
+        const="http://127.0.0.1:8765",
+        metavar="URL",
+        help="Hand the book to a running daemon (python daemon.py serve) "
+        "instead of downloading it here, and follow its progress.",
+    )
+    parser.add_argument(
+        "--mirror",
+        action="append",
+        default=[],
+        metavar="URL",
+        help="Another page with the same book (repeatable). Each chapter is "
+        "downloaded from the fastest healthy source.",
+    )
+    parser.add_argument(
+        "--no-preflight",
+        action="store_true",
+        help="Skip probing chapter sizes, disk space and ETA before downloading.",
+    )
+    parser.add_argument(
+        "--preallocate",
+        action="store_true",
+        help="Reserve disk space for every chapter before downloading it.",
+    )
+    parser.add_argument(
+        "--chapter-workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Download up to N chapters at once (default 1).",
+    )
+    parser.add_argument(
+        "--order",
+        choices=ORDERS,
+        help="Order to start chapters in: book order (list), longest first, or "
+        "listen-first (chapter 1 alone, then the rest). Defaults to longest "
+        "with --chapter-workers > 1, list otherwise.",
+    )
+    parser.add_argument(
+        "--remux",
+        choices=BACKENDS,
+        default="auto",
+        help="How Tokybook chapters are converted to MP3: in-process with PyAV "
+        "(pip install av), with an ffmpeg process, or auto (PyAV if installed, "
+        "ffmpeg as the fallback).",
+    )
+    args = parser.parse_args()
+
+    try:
+        remuxer.set_backend(args.remux)
+    except ValueError as e:
+        console.print(f"[red]Error: {e}[/red]")
+        exit()
+
+    if args.limit_rate:
+        try:
+            limiter.set_rate(parse_size(args.limit_rate))
+        except ValueError:
+            console.print(f"[red]Error: invalid --limit-rate {args.limit_rate!r}[/red]")
+            exit()
+    if args.limit_rate_file:
+        limiter.watch_file(args.limit_rate_file)
+
+    if args.profile:
+        profiler.enable()
 
-    if subprocess.run(["ffmpeg", "-version"], capture_output=True).returncode != 0:
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
         console.print(
-            "[red]Error: ffmpeg is not installed. Check the README for installation instructions.[/red]"
+            f"[dim]Metrics available at http://127.0.0.1:{args.metrics_port}/metrics[/dim]"
         )
+
+    console.print("[bold cyan]--- Audiobook Downloader ---[/bold cyan]")
+
+    if args.daemon:
+        import daemon
+
+        input_book_url = console.input("\nEnter the audiobook URL: ").strip()
+        selection = console.input(
+            "[yellow]Chapters to download (e.g. '1-5, 8'), or Enter for all: [/yellow]"
+        ).strip()
+        job = daemon.call(
+            args.daemon,
+            "POST",
+            "/jobs",
+            {"url": input_book_url, "chapters": selection or None},
+        )
+        console.print(f"[green]Queued as job {job['id']} on {args.daemon}[/green]")
+        daemon.follow(args.daemon, job["id"])
         exit()
 
+    if not ffmpeg_available():
+        if "pyav" not in remuxer.backends():
+            console.print(
+                "[red]Error: ffmpeg is not installed. Check the README for installation instructions.[/red]"
+            )
+            exit()
+        console.print(
+            "[yellow]ffmpeg is not installed; converting with PyAV only.[/yellow]"
+        )
+
+    library = Library(os.path.join(os.getcwd(), "Audiobooks", ".library.sqlite"))
+
     while True:
         input_book_url = console.input("\nEnter the audiobook URL: ").strip()
         scraper = get_scraper(input_book_url)
@@ -281,14 +661,67 @@ if __name__ == "__main__":
             "[red]Error: Unsupported website. Please enter a valid URL from a supported site.[/red]"
         )
 
+    # Answered from the index, before any request to the site
+    known_book = library.get_book(input_book_url)
+    if known_book:
+        known_dir = os.path.join(
+            os.getcwd(), "Audiobooks", known_book["sanitized_title"]
+        )
+        indexed = library.chapters(known_book["id"])
+        if (
+            known_book["chapter_count"]
+            and len(indexed) >= known_book["chapter_count"]
+            and known_book["tag_state"] == "tagged"
+            and all(os.path.exists(os.path.join(known_dir, name)) for name in indexed)
+        ):
+            console.print(
+                f"[green]'{known_book['sanitized_title']}' is already downloaded "
+                f"and tagged ({len(indexed)} chapters). Nothing to do.[/green]"
+            )
+            exit()
+        console.print(
+            f"[yellow]Already in the library as '{known_book['sanitized_title']}' "
+            f"({len(indexed)}/{known_book['chapter_count']} "
+            f"chapters). Downloaded chapters will be skipped.[/yellow]"
+        )
+
     # --- 1. Scrape data ---
-    book_data = scraper.fetch_book_data(input_book_url)
+    with profiler.stage(f"fetch_book_data-{type(scraper).__name__}"):
+        book_data = scraper.fetch_book_data(input_book_url)
     book_data["title"] = sanitize_book_title(book_data.get("title", "Unknown_Book"))
 
     if not book_data:
         console.print("[bold red]Could not retrieve book data. Exiting.[/bold red]")
         exit()
 
+    # --- 1b. Mirrors: the same book on other sites ---
+    mirrors = None
+    if args.mirror:
+        sources = [(input_book_url, book_data)]
+        for mirror_url in args.mirror:
+            mirror_scraper = get_scraper(mirror_url)
+            if mirror_scraper is None:
+                console.print(
+                    f"[yellow]Skipping unsupported mirror {mirror_url}[/yellow]"
+                )
+                continue
+            mirror_data = mirror_scraper.fetch_book_data(mirror_url)
+            if mirror_data:
+                sources.append((mirror_url, mirror_data))
+        # Tokybook chapters are HLS streams, not files that can be swapped
+        if any(data.get("site") == "tokybook.com" for _, data in sources):
+            console.print(
+                "[yellow]Mirrors work between MP3 sites only; ignoring them.[/yellow]"
+            )
+        elif len(sources) > 1:
+            mirrors = MirrorSet(sources)
+            with console.status("[cyan]Matching and benchmarking mirrors..."):
+                usable = mirrors.benchmark()
+            mirrors.print_table()
+            if not usable:
+                console.print("[yellow]No usable mirror; using the main URL.[/yellow]")
+                mirrors = None
+
     # --- 2. Review and Override Metadata ---
     details_table = Table(title="Scraped Book Details", show_lines=True)
     details_table.add_column("Field", style="bold cyan", width=15)
@@ -323,6 +756,21 @@ if __name__ == "__main__":
             f"Cover URL [{book_data.get('cover_url', '')}]: "
         ).strip() or book_data.get("cover_url")
 
+    book_data["book_url"] = input_book_url
+
+    # Different titles can sanitize to the same folder name
+    for other in library.find_conflicts(input_book_url, book_data["title"]):
+        console.print(
+            f"[yellow]Warning: the folder '{book_data['title']}' already holds "
+            f"another book ({other['source_url']}).[/yellow]"
+        )
+        new_title = console.input(
+            "[yellow]Enter a different title, or press Enter to share the folder: [/yellow]"
+        ).strip()
+        if new_title:
+            book_data["title"] = sanitize_book_title(new_title)
+        break
+
     # --- 3. Chapter Selection Menu ---
     total_chapters = len(book_data["chapters"])
     # Store the true total for ID3 tags later
@@ -402,5 +850,50 @@ if __name__ == "__main__":
                 f"[yellow]Warning: Could not download cover art. Error: {e}[/yellow]"
             )
 
-    # --- 4. Start the download process ---
-    download_and_tag_audiobook(book_data)
+    # --- 4. Pre-flight: sizes, disk space and ETA ---
+    playlists = None
+    if not args.no_preflight:
+        book_dir = os.path.join(os.getcwd(), "Audiobooks", book_data["title"])
+        fits, playlists = preflight(
+            book_data,
+            book_dir,
+            chapter_workers=max(1, args.chapter_workers),
+            preallocate=args.preallocate,
+        )
+        if not fits and console.input(
+            "[yellow]Download anyway? [y/N]: [/yellow]"
+        ).strip().lower() not in ("y", "yes"):
+            exit()
+
+    # --- 5. Start the download process ---
+    blob_store = None
+    if args.dedup:
+        blob_store = BlobStore(os.path.join(os.getcwd(), "Audiobooks", ".blobs"))
+        if not blob_store.reflinks_supported:
+            console.print(
+                "[yellow]This filesystem has no reflinks: --dedup keeps a second "
+                "copy of every chapter in Audiobooks/.blobs and only saves "
+                "downloads.[/yellow]"
+            )
+
+    with profiler.stage("download_and_tag_audiobook"):
+        download_and_tag_audiobook(
+            book_data,
+            blob_store,
+            library,
+            chapter_workers=max(1, args.chapter_workers),
+            order=args.order,
+            mirrors=mirrors,
+            playlists=playlists,
+        )
+
+    if args.profile:
+        profile_dir = os.path.join(
+            os.getcwd(), "Audiobooks", book_data["title"], "profile"
+        )
+        profiler.write_reports(profile_dir)
+        console.print(f"[dim]Profiling reports written to {profile_dir}[/dim]")
+
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+        console.print(f"[dim]Metrics summary written to {args.metrics_json}[/dim]")
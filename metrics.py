@@ -0,0 +1,218 @@
+import contextlib
+import contextvars
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Upper bounds (seconds) for latency/timing histograms
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+_current_book = contextvars.ContextVar("metrics_book", default=None)
+
+
+def host_of(url, default="unknown"):
+    """Returns the host part of a URL, used as the "host" label."""
+    return urlparse(url).netloc or default
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "min": self.min,
+            "max": self.max,
+            "buckets": {
+                **{str(b): c for b, c in zip(self.buckets, self.counts)},
+                "+Inf": self.counts[-1],
+            },
+        }
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, gauges and histograms.
+
+    Every metric is keyed by name plus labels (typically "host" and "book").
+    The "book" label is filled in automatically inside `with metrics.book(title):`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._server = None
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        book = _current_book.get()
+        if book is not None and "book" not in labels:
+            labels = {**labels, "book": book}
+        return name, tuple(
+            sorted((k, str(v)) for k, v in labels.items() if v is not None)
+        )
+
+    @contextlib.contextmanager
+    def book(self, title):
+        """Labels every metric recorded in this context (and thread) with the book title."""
+        token = _current_book.set(title)
+        try:
+            yield
+        finally:
+            _current_book.reset(token)
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(buckets)
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Observes the wall time of the block (in seconds) into histogram `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+            self.started = time.time()
+
+    # --- Export ---
+
+    def summary(self):
+        """Returns all metrics as a JSON-serialisable dict."""
+
+        def rows(items, render):
+            return [
+                {"name": name, "labels": dict(labels), **render(value)}
+                for (name, labels), value in sorted(items, key=lambda kv: kv[0])
+            ]
+
+        with self._lock:
+            return {
+                "started": self.started,
+                "elapsed_seconds": time.time() - self.started,
+                "counters": rows(self._counters.items(), lambda v: {"value": v}),
+                "gauges": rows(self._gauges.items(), lambda v: {"value": v}),
+                "histograms": rows(self._histograms.items(), lambda h: h.to_dict()),
+            }
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_prometheus(self):
+        """Renders all metrics in the Prometheus text exposition format."""
+
+        def fmt(name, labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return f"audiobook_{name}"
+            body = ",".join(f'{k}="{_escape_label(v)}"' for k, v in pairs)
+            return f"audiobook_{name}{{{body}}}"
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"{fmt(name, labels)} {value}")
+            for (name, labels), value in sorted(self._gauges.items()):
+                lines.append(f"{fmt(name, labels)} {value}")
+            for (name, labels), h in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{fmt(name + '_bucket', labels, [('le', bound)])} {cumulative}"
+                    )
+                lines.append(
+                    f"{fmt(name + '_bucket', labels, [('le', '+Inf')])} {h.count}"
+                )
+                lines.append(f"{fmt(name + '_sum', labels)} {h.sum}")
+                lines.append(f"{fmt(name + '_count', labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serves /metrics in Prometheus format on a background thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.rstrip("/") == "/metrics":
+                    body = registry.to_prometheus().encode()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path.rstrip("/") == "/metrics.json":
+                    body = json.dumps(registry.summary()).encode()
+                    content_type = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+    def stop_server(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+# Process-wide registry used by the downloader and scrapers
+metrics = Metrics()
@@ -0,0 +1,277 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from rich.console import Console
+from rich.table import Table
+
+from metrics import host_of, metrics
+from verify import id3v2_size, iter_mp3_frames
+
+console = Console()
+
+# Bytes fetched from the start of every chapter to read its MP3 header
+SAMPLE_BYTES = 64 * 1024
+# Chapter durations may differ by this much (seconds, or fraction) between mirrors
+DURATION_TOLERANCE = 5.0
+DURATION_TOLERANCE_RATIO = 0.02
+# A mirror that returned 403 is left alone for this long
+FORBIDDEN_COOLDOWN = 600
+FAILURE_COOLDOWN = 60
+# Weight of the latest chapter in a mirror's throughput average
+RATE_SMOOTHING = 0.3
+
+
+class MirrorForbidden(Exception):
+    """Raised by a mirror download that was refused with 403."""
+
+
+def mp3_duration(head, total_size):
+    """
+    Estimates an MP3's duration from its first bytes and total size: exact
+    from a Xing/Info or VBRI frame count, otherwise from the first frame's
+    bitrate (CBR). Returns None if `head` holds no frame.
+    """
+    frame = next(iter_mp3_frames(head), None)
+    if frame is None:
+        return None
+    pos, length, seconds = frame
+    data = head[pos : pos + length]
+    for tag in (b"Xing", b"Info"):
+        index = data.find(tag)
+        if index != -1 and data[index + 7] & 0x01:
+            frames = int.from_bytes(data[index + 8 : index + 12], "big")
+            return frames * seconds
+    if data[36:40] == b"VBRI":
+        frames = int.from_bytes(data[50:54], "big")
+        return frames * seconds
+    if not total_size:
+        return None
+    return (total_size - pos) / length * seconds
+
+
+def probe_mp3(session, url, headers):
+    """
+    Fetches the first SAMPLE_BYTES of an MP3. Returns {"duration", "size",
+    "rate"} (rate in bytes/sec for this request).
+    """
+    headers = dict(headers or {})
+    headers["Range"] = f"bytes=0-{SAMPLE_BYTES - 1}"
+    start = time.perf_counter()
+    with session.get(url, headers=headers, stream=True, timeout=(10, 30)) as r:
+        if r.status_code == 403:
+            raise MirrorForbidden(url)
+        r.raise_for_status()
+        if r.status_code == 206 and "/" in r.headers.get("Content-Range", ""):
+            total = r.headers["Content-Range"].rsplit("/", 1)[1]
+        else:
+            total = r.headers.get("Content-Length")
+        head = b""
+        for chunk in r.iter_content(chunk_size=16384):
+            head += chunk
+            if len(head) >= SAMPLE_BYTES:
+                break
+    seconds = time.perf_counter() - start
+    size = int(total) if total and total.isdigit() else None
+    if id3v2_size(head) >= len(head):
+        duration = None  # Tag (cover art) larger than the sample
+    else:
+        duration = mp3_duration(head, size)
+    return {
+        "duration": duration,
+        "size": size,
+        "rate": len(head) / seconds if seconds > 0 else None,
+    }
+
+
+def durations_match(first, second):
+    if first is None or second is None:
+        return True  # Unknown: the chapter count has to do
+    tolerance = max(DURATION_TOLERANCE, DURATION_TOLERANCE_RATIO * max(first, second))
+    return abs(first - second) <= tolerance
+
+
+class Mirror:
+    """One source of a book, with its measured throughput and health."""
+
+    def __init__(self, url, book_data):
+        self.url = url
+        self.book_data = book_data
+        self.site = book_data.get("site")
+        # Copied, since the caller narrows book_data["chapters"] to a selection
+        self.chapters = list(book_data["chapters"])
+        self.host = host_of(self.chapters[0]["url"]) if self.chapters else None
+        self.durations = [None] * len(self.chapters)
+        self.rate = None
+        self.failures = 0
+        self.blocked_until = 0.0
+        self.problem = None
+
+    @property
+    def healthy(self):
+        return self.problem is None and time.monotonic() >= self.blocked_until
+
+
+class MirrorSet:
+    """
+    The same book on several sites. After `benchmark()`, every chapter is
+    downloaded from the fastest healthy mirror; a mirror that returns 403,
+    fails, or slows down below another one loses its place to the next.
+    """
+
+    def __init__(self, urls_and_books):
+        self.mirrors = [Mirror(url, book) for url, book in urls_and_books]
+        self._lock = threading.Lock()
+
+    def benchmark(self, workers=8):
+        """
+        Probes the start of every chapter on every mirror (concurrently) for
+        its duration, and measures each mirror's throughput. Mirrors whose
+        chapters don't match the first one's by count and duration are
+        dropped. Returns the mirrors that are usable.
+        """
+        session = requests.Session()
+
+        def probe(job):
+            mirror, index = job
+            chapter = mirror.chapters[index]
+            for attempt in range(2):
+                try:
+                    return probe_mp3(
+                        session, chapter["url"], mirror.book_data.get("site_headers")
+                    )
+                except MirrorForbidden:
+                    return "403 Forbidden"
+                except Exception as e:
+                    error = f"unreachable ({e.__class__.__name__})"
+            return error
+
+        jobs = [
+            (mirror, index)
+            for mirror in self.mirrors
+            for index in range(len(mirror.chapters))
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(probe, jobs))
+
+        for mirror in self.mirrors:
+            outcomes = {
+                index: result
+                for (owner, index), result in zip(jobs, results)
+                if owner is mirror
+            }
+            probed = {i: r for i, r in outcomes.items() if not isinstance(r, str)}
+            # A 403 rules the mirror out; other errors only if no chapter worked
+            if "403 Forbidden" in outcomes.values():
+                mirror.problem = "403 Forbidden"
+            elif not probed:
+                mirror.problem = next(iter(outcomes.values()), "no chapters")
+            else:
+                for index, result in probed.items():
+                    mirror.durations[index] = result["duration"]
+                rates = sorted(r["rate"] for r in probed.values() if r["rate"])
+                mirror.rate = rates[len(rates) // 2] if rates else None
+
+        reference = self.mirrors[0]
+        for mirror in self.mirrors[1:]:
+            if mirror.problem:
+                continue
+            if len(mirror.durations) != len(reference.durations):
+                mirror.problem = (
+                    f"{len(mirror.durations)} chapters, "
+                    f"expected {len(reference.durations)}"
+                )
+                continue
+            for index, (a, b) in enumerate(zip(reference.durations, mirror.durations)):
+                if not durations_match(a, b):
+                    mirror.problem = (
+                        f"chapter {index + 1} is {b:.0f}s, expected {a:.0f}s"
+                    )
+                    break
+        return [mirror for mirror in self.mirrors if mirror.problem is None]
+
+    def ranked(self):
+        """Healthy mirrors, fastest first."""
+        with self._lock:
+            healthy = [mirror for mirror in self.mirrors if mirror.healthy]
+        return sorted(healthy, key=lambda mirror: -(mirror.rate or 0))
+
+    def download(self, index, fetch, progress=None):
+        """
+        Downloads chapter `index` (of the full book) with `fetch(chapter,
+        book_data)`, trying mirrors fastest first. `fetch` returns the number
+        of bytes downloaded, or raises MirrorForbidden or another exception.
+        Returns (mirror, bytes).
+        """
+        log = progress.log if progress is not None else console.print
+        errors = []
+        for mirror in self.ranked():
+            chapter = mirror.chapters[index]
+            start = time.perf_counter()
+            try:
+                nbytes = fetch(chapter, mirror.book_data)
+            except MirrorForbidden:
+                with self._lock:
+                    mirror.blocked_until = time.monotonic() + FORBIDDEN_COOLDOWN
+                metrics.inc("mirror_failovers", host=mirror.host)
+                log(f"[yellow]{mirror.site} returned 403, switching mirror...[/yellow]")
+                errors.append(f"{mirror.site}: 403")
+                continue
+            except Exception as e:
+                with self._lock:
+                    mirror.failures += 1
+                    mirror.blocked_until = (
+                        time.monotonic() + FAILURE_COOLDOWN * mirror.failures
+                    )
+                metrics.inc("mirror_failovers", host=mirror.host)
+                log(f"[yellow]{mirror.site} failed ({e}), switching mirror...[/yellow]")
+                errors.append(f"{mirror.site}: {e}")
+                continue
+
+            seconds = time.perf_counter() - start
+            if seconds > 0 and nbytes:
+                self._record_rate(mirror, nbytes / seconds, log)
+            return mirror, nbytes
+        reasons = "; ".join(errors) or "none healthy"
+        raise Exception(f"Every mirror failed for chapter {index + 1}: {reasons}")
+
+    def _record_rate(self, mirror, rate, log):
+        with self._lock:
+            # Every mirror may be cooling down; this one just succeeded anyway
+            leader = max(
+                (m for m in self.mirrors if m.healthy),
+                key=lambda m: m.rate or 0,
+                default=None,
+            )
+            if mirror.rate is None:
+                mirror.rate = rate
+            else:
+                mirror.rate += RATE_SMOOTHING * (rate - mirror.rate)
+            mirror.failures = 0
+            best = max(
+                (m for m in self.mirrors if m.healthy),
+                key=lambda m: m.rate or 0,
+                default=mirror,
+            )
+        if leader is mirror and best is not mirror:
+            log(f"[yellow]{mirror.site} slowed down, switching to {best.site}[/yellow]")
+
+    def print_table(self):
+        table = Table(title="Mirrors")
+        table.add_column("Site", style="cyan")
+        table.add_column("Chapters", justify="right")
+        table.add_column("KiB/s", justify="right")
+        table.add_column("Status")
+        for mirror in self.mirrors:
+            table.add_row(
+                mirror.site or mirror.url,
+                str(len(mirror.chapters)),
+                f"{mirror.rate / 1024:.0f}" if mirror.rate else "",
+                (
+                    f"[red]{mirror.problem}[/red]"
+                    if mirror.problem
+                    else "[green]ok[/green]"
+                ),
+            )
+        console.print(table)
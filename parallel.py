@@ -0,0 +1,232 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from rich.console import Console
+from rich.table import Table
+
+console = Console()
+
+# Per worker process: shared blocks already read, by name
+_attached = {}
+
+
+class SharedBlob:
+    """
+    A bytes payload (cover art) placed in shared memory once, so pool tasks
+    receive only its small `handle` instead of a pickled copy each. The
+    creating process owns the block; use it as a context manager.
+    """
+
+    def __init__(self, data):
+        self.size = len(data)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(1, self.size))
+        self._shm.buf[: self.size] = data
+
+    @property
+    def handle(self):
+        return (self._shm.name, self.size)
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(handle):
+    """Returns the bytes behind a SharedBlob handle, read once per process."""
+    if handle is None:
+        return None
+    name, size = handle
+    if name not in _attached:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            _attached[name] = bytes(shm.buf[:size])
+        finally:
+            shm.close()
+    return _attached[name]
+
+
+def process_pool(workers=None):
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+
+
+def _share_artwork(data):
+    """Splits artwork_data out of a tag dict into a SharedBlob (or None)."""
+    data = dict(data)
+    artwork = data.pop("artwork_data", None)
+    return data, (SharedBlob(artwork) if artwork else None)
+
+
+def _with_artwork(data, handle):
+    if handle is not None:
+        data = dict(data, artwork_data=attach(handle))
+    return data
+
+
+# --- Tasks, run in the worker processes ---
+
+
+def _scrape(url):
+    from main import get_scraper
+
+    scraper = get_scraper(url)
+    if scraper is None:
+        raise ValueError("Unsupported website")
+    book_data = scraper.fetch_book_data(url)
+    if not book_data:
+        raise ValueError("Could not retrieve book data")
+    return book_data
+
+
+def _tag(job, book_data, handle):
+    from tagging import tag_chapter
+
+    file_name, track, title = job
+    tag_chapter(file_name, _with_artwork(book_data, handle), track, title)
+
+
+def _retag(path, updates, handle):
+    from retag import retag_chapter
+
+    return retag_chapter(path, _with_artwork(updates, handle))
+
+
+def _verify(path, entry, use_ffprobe):
+    from verify import verify_chapter
+
+    return verify_chapter(path, entry, use_ffprobe)
+
+
+def _hash(path):
+    from dedup import hash_audio
+
+    return hash_audio(path)
+
+
+# --- Parent side ---
+
+
+def scrape_books(urls, workers=None):
+    """
+    Scrapes the metadata of many books at once, one process per page parse.
+    Returns [(url, book_data, None) or (url, None, error)] in input order.
+    """
+    results = []
+    with process_pool(workers) as pool:
+        futures = [pool.submit(_scrape, url) for url in urls]
+        for url, future in zip(urls, futures):
+            try:
+                results.append((url, future.result(), None))
+            except Exception as e:
+                results.append((url, None, e))
+    return results
+
+
+def tag_chapters(jobs, book_data, workers=None):
+    """
+    Writes the book's tags into many chapters in parallel. `jobs` are
+    (file name, "n/total", chapter title) as for tagging.tag_chapter.
+    """
+    data, blob = _share_artwork(book_data)
+    handle = blob.handle if blob else None
+    try:
+        with process_pool(workers) as pool:
+            futures = [pool.submit(_tag, job, data, handle) for job in jobs]
+            for future in futures:
+                future.result()
+    finally:
+        if blob:
+            blob.close()
+
+
+def retag_chapters(paths, updates, workers=None):
+    """
+    retag.retag_chapter for every path, in parallel.
+    Returns [(grew, error)] in input order.
+    """
+    data, blob = _share_artwork(updates)
+    handle = blob.handle if blob else None
+    results = []
+    try:
+        with process_pool(workers) as pool:
+            futures = [pool.submit(_retag, path, data, handle) for path in paths]
+            for future in futures:
+                try:
+                    results.append((future.result(), None))
+                except Exception as e:
+                    results.append((False, e))
+    finally:
+        if blob:
+            blob.close()
+    return results
+
+
+def verify_chapters(jobs, use_ffprobe=False, workers=None):
+    """
+    verify.verify_chapter for every (path, manifest entry), in parallel.
+    Returns the problem lists in input order.
+    """
+    with process_pool(workers) as pool:
+        futures = [
+            pool.submit(_verify, path, entry, use_ffprobe) for path, entry in jobs
+        ]
+        return [future.result() for future in futures]
+
+
+def hash_files(paths, workers=None):
+    """Returns {path: dedup.hash_audio digest}, hashing the files in parallel."""
+    with process_pool(workers) as pool:
+        return dict(zip(paths, pool.map(_hash, paths)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Scrape the metadata of many books using every core."
+    )
+    parser.add_argument("urls", nargs="*", help="Book URLs.")
+    parser.add_argument("--file", help="Text file with one book URL per line.")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--json", help="Write the scraped book data to this file.")
+    args = parser.parse_args()
+
+    urls = list(args.urls)
+    if args.file:
+        with open(args.file) as f:
+            urls += [line.strip() for line in f if line.strip()]
+    if not urls:
+        console.print("[red]Error: no book URLs given.[/red]")
+        raise SystemExit(2)
+
+    results = scrape_books(urls, args.workers)
+
+    table = Table(title="Scraped books")
+    table.add_column("Title", style="cyan")
+    table.add_column("Author")
+    table.add_column("Chapters", justify="right")
+    table.add_column("URL", style="dim")
+    for url, book_data, error in results:
+        if error is not None:
+            table.add_row(f"[red]{error}[/red]", "", "", url)
+        else:
+            table.add_row(
+                book_data.get("title") or "",
+                book_data.get("author") or "",
+                str(len(book_data.get("chapters", []))),
+                url,
+            )
+    console.print(table)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {url: book_data for url, book_data, _ in results if book_data},
+                f,
+                indent=2,
+            )
@@ -0,0 +1,292 @@
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from rich.console import Console
+from rich.table import Table
+
+from retry import SEGMENT_CONNECTIONS
+from scrapers.tokybook import TokybookScraper
+from throttle import limiter
+from utils import is_direct_mp3_url
+
+console = Console()
+
+SESSION_SITES = ("goldenaudiobook.net", "zaudiobooks.com")
+SAMPLE_BYTES = 256 * 1024
+
+
+def probe_chapter(chapter, book_data, session):
+    """
+    Finds out how big a chapter's download is without downloading it.
+
+    Returns {"size", "exact", "duration", "playlist"}; `size` is None
+    when it can't be known up front (yt-dlp sites). Tokybook sizes are exact
+    for byte-range playlists, otherwise extrapolated from the first
+    segment's size and duration; `playlist` is the parsed Tokybook playlist
+    (see TokybookScraper.fetch_playlist), so the download can reuse it.
+    """
+    result = {
+        "size": None,
+        "exact": False,
+        "duration": chapter.get("duration"),
+        "playlist": None,
+    }
+    if book_data.get("site") == "tokybook.com":
+        playlist = result["playlist"] = TokybookScraper.fetch_playlist(
+            chapter, book_data
+        )
+        segments = playlist["segments"]
+        result["duration"] = playlist["duration"] or result["duration"]
+        if segments and all(segment["byterange"] for segment in segments):
+            result["size"] = sum(segment["byterange"][0] for segment in segments)
+            result["exact"] = True
+        elif segments:
+            first = segments[0]
+            size = TokybookScraper._probe_segment_size((first, book_data, None))
+            if size and first["duration"] and playlist["duration"]:
+                result["size"] = int(size * playlist["duration"] / first["duration"])
+            elif size:
+                result["size"] = size * len(segments)
+            result["exact"] = size is not None and len(segments) == 1
+        return result
+
+    url = chapter["url"]
+    if book_data.get("site") not in SESSION_SITES and not is_direct_mp3_url(url):
+        return result
+    r = session.head(
+        url,
+        headers=book_data.get("site_headers", {}),
+        allow_redirects=True,
+        timeout=10,
+    )
+    length = r.headers.get("Content-Length")
+    if r.ok and length and not r.headers.get("Content-Encoding"):
+        result["size"] = int(length)
+        result["exact"] = True
+    return result
+
+
+def sample_throughput(chapter, book_data, session, playlist=None):
+    """
+    Times a small download from the chapter's host and returns bytes/sec for
+    one connection, or None if the sample fails. `playlist` is the chapter's
+    Tokybook playlist, if already fetched.
+    """
+    start = time.perf_counter()
+    try:
+        if book_data.get("site") == "tokybook.com":
+            playlist = playlist or TokybookScraper.fetch_playlist(chapter, book_data)
+            if not playlist["segments"]:
+                return None
+            start = time.perf_counter()
+            received = TokybookScraper._stream_segment(
+                playlist["segments"][0], book_data, lambda position, chunk: None
+            )
+        else:
+            headers = dict(book_data.get("site_headers", {}))
+            headers["Range"] = f"bytes=0-{SAMPLE_BYTES - 1}"
+            with session.get(
+                chapter["url"], headers=headers, stream=True, timeout=(10, 30)
+            ) as r:
+                r.raise_for_status()
+                received = 0
+                for chunk in r.iter_content(chunk_size=65536):
+                    received += len(chunk)
+                    if received >= SAMPLE_BYTES:
+                        break
+    except Exception:
+        return None
+    seconds = time.perf_counter() - start
+    return received / seconds if received and seconds > 0 else None
+
+
+def probe_book(book_data, workers=8):
+    """
+    Probes every chapter in book_data["chapters"] concurrently and stores
+    the expected size of each (chapter["size"]) and its duration where it
+    was missing, so progress can be weighted by bytes. Returns the probe
+    results in chapter order; a chapter that fails to probe gets None.
+    """
+    session = requests.Session()
+
+    def probe(chapter):
+        try:
+            return probe_chapter(chapter, book_data, session)
+        except Exception:
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="probe") as pool:
+        results = list(pool.map(probe, book_data["chapters"]))
+
+    for chapter, result in zip(book_data["chapters"], results):
+        if result and result["size"]:
+            chapter["size"] = result["size"]
+        if result and result["duration"] and not chapter.get("duration"):
+            chapter["duration"] = result["duration"]
+    return results
+
+
+def plan_download(book_data, book_dir, results, chapter_workers=1):
+    """
+    Totals the probe results and estimates how long the download takes.
+    Chapters already on disk are left out. Returns a dict with the expected
+    and needed bytes, the free disk space and the ETA in seconds (or None).
+    """
+    pending = [
+        (chapter, result)
+        for chapter, result in zip(book_data["chapters"], results)
+        if not os.path.exists(os.path.join(book_dir, f"{chapter['title']}.mp3"))
+    ]
+    sizes = [result["size"] for _, result in pending if result and result["size"]]
+    total = sum(sizes)
+    # A chapter in progress needs room for its temporary file as well
+    needed = total + max(sizes, default=0) * chapter_workers
+
+    os.makedirs(book_dir, exist_ok=True)
+    free = shutil.disk_usage(book_dir).free
+
+    rate = None
+    if pending:
+        session = requests.Session()
+        chapter, result = pending[0]
+        rate = sample_throughput(
+            chapter, book_data, session, result and result["playlist"]
+        )
+    eta = None
+    if rate and total:
+        connections = chapter_workers
+        if book_data.get("site") == "tokybook.com":
+            connections *= SEGMENT_CONNECTIONS
+        rate *= connections
+        if limiter.rate:
+            rate = min(rate, limiter.rate)
+        eta = total / rate
+
+    return {
+        "chapters": len(pending),
+        "unknown": sum(1 for _, result in pending if not (result and result["size"])),
+        "estimated": any(result and not result["exact"] for _, result in pending),
+        "bytes": total,
+        "needed": needed,
+        "free": free,
+        "rate": rate,
+        "eta": eta,
+    }
+
+
+def _preallocate(fd, size):
+    """Reserves `size` bytes for the file, falling back to a sparse truncate."""
+    if size and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(fd, size)
+
+
+def preallocate_chapters(book_data, book_dir):
+    """
+    Reserves disk space for every chapter that is downloaded in one piece
+    (direct MP3 and session sites) by preallocating its .part file, which
+    the download then writes into. Returns the number of bytes reserved.
+    """
+    if book_data.get("site") == "tokybook.com":
+        return 0  # Converted to MP3 while they download, size unknown up front
+    reserved = 0
+    for chapter in book_data["chapters"]:
+        final_file_name = os.path.join(book_dir, f"{chapter['title']}.mp3")
+        if not chapter.get("size") or os.path.exists(final_file_name):
+            continue
+        fd = os.open(f"{final_file_name}.part", os.O_RDWR | os.O_CREAT)
+        try:
+            _preallocate(fd, chapter["size"])
+        finally:
+            os.close(fd)
+        reserved += chapter["size"]
+    return reserved
+
+
+def format_bytes(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size:.0f} B"
+        size /= 1024
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+def print_plan(book_data, results, plan):
+    table = Table(title=f"Download Plan: {book_data['title']}")
+    table.add_column("#", style="dim", width=4)
+    table.add_column("Chapter")
+    table.add_column("Size", justify="right")
+    table.add_column("Duration", justify="right")
+    for index, (chapter, result) in enumerate(zip(book_data["chapters"], results)):
+        size = ""
+        if result and result["size"]:
+            size = ("" if result["exact"] else "~") + format_bytes(result["size"])
+        duration = chapter.get("duration")
+        table.add_row(
+            f"{chapter.get('track_num', index + 1):02}",
+            chapter["title"],
+            size or "[dim]unknown[/dim]",
+            format_seconds(duration) if duration else "",
+        )
+    console.print(table)
+
+    approx = "~" if plan["estimated"] or plan["unknown"] else ""
+    console.print(
+        f"[bold]{plan['chapters']} chapters to download, "
+        f"{approx}{format_bytes(plan['bytes'])}[/bold]"
+        + (
+            f" [dim]({plan['unknown']} of unknown size)[/dim]"
+            if plan["unknown"]
+            else ""
+        )
+    )
+    console.print(f"Free disk space: {format_bytes(plan['free'])}")
+    if plan["eta"] is not None:
+        console.print(
+            f"Estimated time: ~{format_seconds(plan['eta'])} "
+            f"at {format_bytes(plan['rate'])}/s"
+        )
+    if plan["needed"] > plan["free"]:
+        console.print(
+            f"[red]Not enough disk space: about {format_bytes(plan['needed'])} "
+            f"is needed.[/red]"
+        )
+
+
+def preflight(book_data, book_dir, chapter_workers=1, preallocate=False):
+    """
+    Probes the selected chapters, prints the download plan and checks the
+    disk has room for it (preallocating the chapters if asked).
+
+    Returns (fits, playlists): False if the book doesn't fit, and the
+    Tokybook playlists the probe fetched, by chapter index, for the download
+    to start from (see TokybookPlaylistPrefetcher).
+    """
+    with console.status(f"[cyan]Probing {len(book_data['chapters'])} chapters..."):
+        results = probe_book(book_data)
+        plan = plan_download(book_data, book_dir, results, chapter_workers)
+    print_plan(book_data, results, plan)
+    playlists = {
+        index: result["playlist"]
+        for index, result in enumerate(results)
+        if result and result["playlist"]
+    }
+    if plan["needed"] > plan["free"]:
+        return False, playlists
+    if preallocate:
+        reserved = preallocate_chapters(book_data, book_dir)
+        if reserved:
+            console.print(f"[dim]Preallocated {format_bytes(reserved)}.[/dim]")
+    return True, playlists
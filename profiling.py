@@ -0,0 +1,126 @@
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# From 3.12 cProfile is built on sys.monitoring, which already sees every
+# thread (and allows one active profiler); before that it only sees the
+# thread that enabled it.
+_PER_THREAD = sys.version_info < (3, 12)
+
+
+class Profiler:
+    """
+    Opt-in cProfile + tracemalloc wrapper for the download pipeline.
+
+    Each `with profiler.stage(name):` block is profiled separately. Results are
+    kept in memory (the book directory isn't known until after scraping) and
+    written out with `write_reports()`. When disabled, stages cost nothing.
+
+    Threads started during a stage (chapter, segment and hedging pools) get
+    a profiler of their own, merged into the stage's stats at its end.
+    """
+
+    def __init__(self, enabled=False, top=30, frames=10):
+        self.enabled = enabled
+        self.top = top
+        self.frames = frames
+        self.reports = []
+
+    def enable(self):
+        self.enabled = True
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        profile = cProfile.Profile()
+        thread_profiles = []
+
+        def profile_thread(*args):
+            # First event in a new thread: hand over to a cProfile of its own
+            thread_profile = cProfile.Profile()
+            thread_profiles.append(thread_profile)
+            thread_profile.enable()
+
+        start = time.perf_counter()
+        if _PER_THREAD:
+            threading.setprofile(profile_thread)
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            threading.setprofile(None)
+            stats = pstats.Stats(profile)
+            for thread_profile in list(thread_profiles):
+                thread_profile.create_stats()  # Snapshot; a live thread keeps going
+                if thread_profile.stats:
+                    stats.add(thread_profile)
+            elapsed = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            after = tracemalloc.take_snapshot()
+            self.reports.append(
+                {
+                    "name": name,
+                    "seconds": elapsed,
+                    "stats": stats,
+                    "threads": 1 + len(thread_profiles),
+                    "traced_current": current,
+                    "traced_peak": peak,
+                    "allocations": after.compare_to(before, "lineno"),
+                }
+            )
+
+    def write_reports(self, directory):
+        """
+        Writes, per stage: <stage>.prof (load with pstats/snakeviz),
+        <stage>.txt (top functions by cumulative time) and
+        <stage>-alloc.txt (top allocation sites). Returns the written paths.
+        """
+        if not self.reports:
+            return []
+        os.makedirs(directory, exist_ok=True)
+        written = []
+        for report in self.reports:
+            base = os.path.join(directory, report["name"])
+
+            stats = report["stats"]
+            stats.dump_stats(f"{base}.prof")
+
+            stream = io.StringIO()
+            stats.stream = stream
+            stats.sort_stats("cumulative").print_stats(self.top)
+            with open(f"{base}.txt", "w") as f:
+                f.write(f"Stage: {report['name']}\n")
+                f.write(f"Wall time: {report['seconds']:.3f}s\n")
+                f.write(f"Threads profiled: {report['threads']}\n\n")
+                f.write(stream.getvalue())
+
+            with open(f"{base}-alloc.txt", "w") as f:
+                f.write(f"Stage: {report['name']}\n")
+                f.write(
+                    f"Traced memory at end: {report['traced_current'] / 2**20:.1f} MiB, "
+                    f"peak: {report['traced_peak'] / 2**20:.1f} MiB\n\n"
+                )
+                f.write(f"Top {self.top} allocation sites (growth during stage):\n")
+                for stat in report["allocations"][: self.top]:
+                    f.write(f"{stat}\n")
+
+            written.extend([f"{base}.prof", f"{base}.txt", f"{base}-alloc.txt"])
+        return written
+
+
+# Process-wide profiler, switched on by `main.py --profile`
+profiler = Profiler()
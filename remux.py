@@ -0,0 +1,267 @@
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from dedup import HashingWriter
+from metrics import metrics
+
+try:
+    import av
+except ImportError:  # PyAV is optional; ffmpeg is used without it
+    av = None
+
+BACKENDS = ("auto", "pyav", "ffmpeg")
+# LAME VBR quality, as the ffmpeg path's "-q:a 2" (~190 kbps)
+MP3_QUALITY = 2
+# libavcodec's lambda per quality unit (FF_QP2LAMBDA), for global_quality
+_QP2LAMBDA = 118
+
+
+class RemuxError(Exception):
+    """A chapter could not be converted; the message says why."""
+
+
+def ffmpeg_available():
+    return shutil.which("ffmpeg") is not None
+
+
+def ffmpeg_command(source, mp3_path):
+    """ffmpeg arguments converting MPEG-TS `source` (a path or "pipe:0") to MP3."""
+    return [
+        "ffmpeg",
+        "-f",
+        "mpegts",
+        "-i",
+        source,
+        "-y",  # Overwrite output
+        "-vn",  # No video
+        "-acodec",
+        "libmp3lame",
+        "-q:a",
+        str(MP3_QUALITY),  # VBR Quality ~190kbps
+        "-loglevel",
+        "error",
+        mp3_path,
+    ]
+
+
+def ts_to_mp3_pyav(source, mp3_path):
+    """
+    Converts in-process with PyAV (libav): no process start-up, and errors
+    come back as exceptions with libav's message instead of a return code.
+    `source` is a path or a readable binary stream of MPEG-TS.
+    MP3 audio is copied as is; anything else (AAC) is encoded with LAME.
+    Returns the MP3's audio hash (see dedup.AudioHasher), computed as it is
+    written, or None.
+    """
+    try:
+        with av.open(source, format="mpegts") as container:
+            if not container.streams.audio:
+                raise RemuxError("no audio stream")
+            audio = container.streams.audio[0]
+            with open(mp3_path, "wb") as f:
+                output = HashingWriter(f)
+                with av.open(output, "w", format="mp3") as target:
+                    if audio.codec_context.name in ("mp3", "mp3float"):
+                        _copy_packets(container, audio, target)
+                    else:
+                        _encode_frames(container, audio, target)
+        return output.hexdigest()
+    except av.error.FFmpegError as e:
+        raise RemuxError(str(e)) from e
+
+
+def _copy_packets(source, audio, target):
+    add_stream = getattr(target, "add_stream_from_template", None)
+    stream = add_stream(audio) if add_stream else target.add_stream(template=audio)
+    for packet in source.demux(audio):
+        if packet.dts is None:
+            continue  # Flush packet
+        packet.stream = stream
+        target.mux(packet)
+
+
+def _encode_frames(source, audio, target):
+    rate = audio.codec_context.sample_rate
+    layout = audio.codec_context.layout.name
+    stream = target.add_stream(
+        "libmp3lame",
+        rate=rate,
+        options={
+            "flags": "+qscale",
+            "global_quality": str(MP3_QUALITY * _QP2LAMBDA),
+        },
+    )
+    stream.codec_context.layout = layout
+    resampler = av.AudioResampler(format="fltp", layout=layout, rate=rate)
+
+    def encode(frame):
+        for resampled in resampler.resample(frame):
+            for packet in stream.encode(resampled):
+                target.mux(packet)
+
+    for frame in source.decode(audio):
+        frame.pts = None
+        encode(frame)
+    encode(None)  # Samples still buffered in the resampler
+    for packet in stream.encode(None):
+        target.mux(packet)
+
+
+class _PipeReader:
+    """Read-only view of a pipe, so PyAV doesn't take it for seekable."""
+
+    def __init__(self, f):
+        self._f = f
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+
+class RemuxStream:
+    """
+    Writable binary stream of MPEG-TS that is converted to MP3 as it
+    arrives, by PyAV on a thread or by an ffmpeg process, both reading
+    from a pipe: the chapter is never written to disk as .ts.
+
+    close() waits for the conversion and returns (seconds, audio hash or
+    None). If the conversion fails, write() or close() raise RemuxError.
+    """
+
+    def __init__(self, backend, mp3_path):
+        self.backend = backend
+        self.name = mp3_path
+        self._start = time.perf_counter()
+        self._error = None
+        self._digest = None
+        self._process = None
+        if backend == "pyav":
+            read_fd, write_fd = os.pipe()
+            self._sink = os.fdopen(write_fd, "wb")
+            self._thread = threading.Thread(
+                target=self._convert, args=(os.fdopen(read_fd, "rb"),), daemon=True
+            )
+            self._thread.start()
+        else:
+            try:
+                self._process = subprocess.Popen(
+                    ffmpeg_command("pipe:0", mp3_path),
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.PIPE,
+                )
+            except OSError as e:
+                raise RemuxError(str(e)) from e
+            self._sink = self._process.stdin
+
+    def _convert(self, source):
+        try:
+            self._digest = ts_to_mp3_pyav(_PipeReader(source), self.name)
+        except Exception as e:  # Whatever libav or PyAV raise fails the chapter
+            self._error = str(e) or type(e).__name__
+        finally:
+            source.close()  # A writer still going gets BrokenPipeError
+
+    def write(self, data):
+        try:
+            return self._sink.write(data)
+        except (BrokenPipeError, ValueError):
+            self.close()  # Raises the converter's own error
+            raise RemuxError("converter stopped reading")
+
+    def close(self):
+        if not self._sink.closed:
+            try:
+                self._sink.close()
+            except BrokenPipeError:
+                pass
+        if self._process is not None:
+            stderr = self._process.communicate()[1].decode(errors="replace")
+            if self._process.returncode != 0:
+                message = stderr.strip().splitlines()
+                self._error = (
+                    message[-1]
+                    if message
+                    else f"ffmpeg exited with {self._process.returncode}"
+                )
+        else:
+            self._thread.join()
+        if self._error is not None:
+            raise RemuxError(self._error)
+        return time.perf_counter() - self._start, self._digest
+
+    def abort(self):
+        """Stops the conversion and removes its partial output."""
+        try:
+            self.close()
+        except RemuxError:
+            pass
+        if os.path.exists(self.name):
+            os.remove(self.name)
+
+
+class Remuxer:
+    """
+    Converts Tokybook MPEG-TS chapters to MP3 while they download, with the
+    chosen backend: "pyav" in-process, "ffmpeg" as a subprocess, or "auto"
+    (PyAV when installed, falling back to ffmpeg for a chapter PyAV fails on).
+    """
+
+    def __init__(self, backend="auto"):
+        self._lock = threading.Lock()
+        self.set_backend(backend)
+
+    def set_backend(self, backend):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown remux backend: {backend}")
+        if backend == "pyav" and av is None:
+            raise ValueError("PyAV is not installed (pip install av)")
+        with self._lock:
+            self.backend = backend
+
+    def backends(self):
+        """Backends to try, in order."""
+        with self._lock:
+            backend = self.backend
+        if backend == "auto":
+            return (["pyav"] if av is not None else []) + ["ffmpeg"]
+        return [backend]
+
+    def convert(self, mp3_path, write_ts):
+        """
+        Converts a chapter into `mp3_path` while `write_ts(stream)` writes
+        its MPEG-TS into the RemuxStream it is given. If a backend fails, the
+        next one is tried with a new stream, so `write_ts` must be able to
+        start over (for Tokybook, by downloading the chapter again).
+
+        Returns (backend used, seconds, audio hash or None). Raises
+        RemuxError if every backend fails; errors raised by `write_ts`
+        itself are passed on, after removing the partial MP3.
+        """
+        errors = []
+        for backend in self.backends():
+            try:
+                stream = RemuxStream(backend, mp3_path)
+            except RemuxError as e:
+                metrics.inc("remux_failures", backend=backend)
+                errors.append(f"{backend}: {e}")
+                continue
+            try:
+                write_ts(stream)
+                seconds, digest = stream.close()
+            except RemuxError as e:
+                stream.abort()
+                metrics.inc("remux_failures", backend=backend)
+                errors.append(f"{backend}: {e}")
+                continue
+            except BaseException:
+                stream.abort()
+                raise
+            metrics.observe("remux_seconds", seconds, backend=backend)
+            return backend, seconds, digest
+        raise RemuxError("; ".join(errors))
+
+
+remuxer = Remuxer()
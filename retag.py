@@ -0,0 +1,234 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from mutagen.id3 import ID3, APIC, TDRC, TPE1, TPE2, ID3NoHeaderError
+from rich.console import Console
+from rich.table import Table
+
+from library import INDEX_NAME, Library
+from verify import load_manifest, save_manifest
+
+console = Console()
+
+
+def keep_padding(info):
+    """
+    mutagen padding callback: reuse the existing padding whenever the new tag
+    fits, so only the tag bytes are rewritten and the audio stays in place.
+    mutagen's default would also shrink large padding, rewriting the file.
+    """
+    if info.padding >= 0:
+        return info.padding
+    return info.get_default_padding()
+
+
+def load_cover(source):
+    """Returns (image bytes, mime type) for a cover given as a file path or URL."""
+    if "://" in source:
+        response = requests.get(source, timeout=30)
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "")
+        if not content_type.startswith("image/"):
+            raise ValueError(f"{source} is not an image ({content_type})")
+        data = response.content
+    else:
+        with open(source, "rb") as f:
+            data = f.read()
+        content_type = ""
+    mime_type = (
+        "image/jpeg"
+        if content_type == "image/jpeg"
+        or data[:3] == b"\xff\xd8\xff"
+        or source.lower().endswith((".jpg", ".jpeg"))
+        else "image/png"
+    )
+    return data, mime_type
+
+
+def retag_chapter(path, updates):
+    """
+    Applies `updates` (author, narrator, year, artwork_data/mime_type) to one
+    chapter's ID3 tag in place. Fields that are not given are left untouched.
+    Returns True if the file had to grow, i.e. the audio was moved.
+    """
+    size = os.path.getsize(path)
+    try:
+        audio = ID3(path)
+    except ID3NoHeaderError:
+        audio = ID3()
+
+    if updates.get("author"):
+        audio.setall("TPE1", [TPE1(encoding=3, text=updates["author"])])
+    if updates.get("narrator"):
+        audio.setall("TPE2", [TPE2(encoding=3, text=updates["narrator"])])
+    if updates.get("year"):
+        audio.setall("TDRC", [TDRC(encoding=3, text=updates["year"])])
+    if updates.get("artwork_data"):
+        audio.setall(
+            "APIC",
+            [
+                APIC(
+                    encoding=3,
+                    mime=updates["mime_type"],
+                    type=3,
+                    desc="Cover",
+                    data=updates["artwork_data"],
+                )
+            ],
+        )
+    audio.save(path, v2_version=3, padding=keep_padding)
+    return os.path.getsize(path) != size
+
+
+def retag_books(book_dirs, updates, workers=None, library=None, processes=False):
+    """
+    Retags every chapter of the given book folders in parallel, on threads
+    or, with `processes`, on a process per core (see parallel.py).
+    Returns {book_dir: (chapters retagged, chapters rewritten, [errors])}.
+    """
+    jobs = [
+        (book_dir, name)
+        for book_dir in book_dirs
+        for name in sorted(os.listdir(book_dir))
+        if name.lower().endswith(".mp3") and not name.endswith(".part.mp3")
+    ]
+
+    def run(job):
+        try:
+            return job, retag_chapter(os.path.join(*job), updates), None
+        except Exception as e:
+            return job, False, e
+
+    if processes:
+        from parallel import retag_chapters
+
+        paths = [os.path.join(*job) for job in jobs]
+        outcomes = retag_chapters(paths, updates, workers)
+        outcomes = [(job, grew, error) for job, (grew, error) in zip(jobs, outcomes)]
+    else:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            outcomes = list(executor.map(run, jobs))
+
+    results = {book_dir: [0, 0, []] for book_dir in book_dirs}
+    for (book_dir, name), grew, error in outcomes:
+        counts = results[book_dir]
+        if error:
+            counts[2].append(f"{name}: {error}")
+            continue
+        counts[0] += 1
+        counts[1] += grew
+
+    for book_dir in results:
+        _refresh_records(book_dir, updates, library)
+    return {book_dir: tuple(counts) for book_dir, counts in results.items()}
+
+
+def _refresh_records(book_dir, updates, library):
+    # Sizes change when a tag grows; stale sizes would make the downloader
+    # treat the chapters as incomplete and fetch them again.
+    manifest = load_manifest(book_dir)
+    for name, entry in manifest.items():
+        path = os.path.join(book_dir, name)
+        if os.path.exists(path):
+            entry["size"] = os.path.getsize(path)
+    if manifest:
+        save_manifest(book_dir, manifest)
+
+    if library is None:
+        return
+    for book in library.books_with_title(os.path.basename(book_dir)):
+        library.update_metadata(
+            book["id"],
+            author=updates.get("author"),
+            narrator=updates.get("narrator"),
+            year=updates.get("year"),
+        )
+        for name, row in library.chapters(book["id"]).items():
+            path = os.path.join(book_dir, name)
+            if os.path.exists(path):
+                library.record_chapter(
+                    book["id"],
+                    name,
+                    track=row["track"],
+                    title=row["title"],
+                    url=row["url"],
+                    size=os.path.getsize(path),
+                    sha256=row["sha256"],
+                    duration=row["duration"],
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Update the tags of downloaded books without re-downloading them."
+    )
+    parser.add_argument(
+        "books", nargs="*", help="Book folders (or folder names under --root)."
+    )
+    parser.add_argument("--all", action="store_true", help="Retag every book.")
+    parser.add_argument("--root", default="Audiobooks")
+    parser.add_argument("--author")
+    parser.add_argument("--narrator")
+    parser.add_argument("--year")
+    parser.add_argument("--cover", help="Cover image file or URL.")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="Retag on one process per core instead of threads.",
+    )
+    args = parser.parse_args()
+
+    if args.all:
+        book_dirs = sorted(
+            entry.path
+            for entry in os.scandir(args.root)
+            if entry.is_dir() and not entry.name.startswith(".")
+        )
+    else:
+        book_dirs = [
+            book if os.path.isdir(book) else os.path.join(args.root, book)
+            for book in args.books
+        ]
+    missing = [book_dir for book_dir in book_dirs if not os.path.isdir(book_dir)]
+    if not book_dirs or missing:
+        console.print(
+            f"[red]Error: no such book folder: {', '.join(missing) or '(none given)'}[/red]"
+        )
+        raise SystemExit(2)
+
+    updates = {"author": args.author, "narrator": args.narrator, "year": args.year}
+    if args.cover:
+        try:
+            updates["artwork_data"], updates["mime_type"] = load_cover(args.cover)
+        except (OSError, ValueError, requests.exceptions.RequestException) as e:
+            console.print(f"[red]Error: could not load the cover: {e}[/red]")
+            raise SystemExit(2)
+    if not any(updates.values()):
+        console.print("[red]Error: nothing to change.[/red]")
+        raise SystemExit(2)
+
+    library = None
+    index = os.path.join(args.root, INDEX_NAME)
+    if os.path.exists(index):
+        library = Library(index)
+
+    results = retag_books(
+        book_dirs, updates, args.workers, library, args.processes
+    )
+
+    table = Table(title="Retagged books")
+    table.add_column("Book", style="cyan")
+    table.add_column("Chapters", justify="right")
+    table.add_column("Rewritten", justify="right")
+    table.add_column("Errors", style="red")
+    failed = False
+    for book_dir, (done, grew, errors) in results.items():
+        failed = failed or bool(errors)
+        table.add_row(
+            os.path.basename(book_dir), str(done), str(grew), "\n".join(errors)
+        )
+    console.print(table)
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,256 @@
+import email.utils
+import random
+import threading
+import time
+from http.client import IncompleteRead
+
+import requests
+
+from metrics import host_of, metrics
+
+# Statuses worth another try: timeouts, rate limiting and server-side trouble
+TRANSIENT_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+_TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    IncompleteRead,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class CircuitOpen(requests.exceptions.RequestException):
+    """Raised instead of sending a request to a host whose breaker is open."""
+
+    def __init__(self, host, retry_in):
+        super().__init__(f"{host} is failing, not retrying for {retry_in:.0f}s")
+        self.host = host
+        self.retry_in = retry_in
+
+
+class RetryableStatus(Exception):
+    """Raised by RetryPolicy.call for a response with a transient status."""
+
+    def __init__(self, response):
+        super().__init__(f"{response.status_code} from {response.url}")
+        self.response = response
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (seconds or HTTP date), or None."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def status_of(error):
+    response = getattr(error, "response", None)
+    return response.status_code if response is not None else None
+
+
+def is_transient(error):
+    """True for errors a retry may fix (network trouble, 429, 5xx)."""
+    if isinstance(error, CircuitOpen):
+        return False
+    status = status_of(error)
+    if status is not None:
+        return status in TRANSIENT_STATUSES
+    return isinstance(error, _TRANSIENT_ERRORS)
+
+
+def retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    return parse_retry_after(response.headers.get("Retry-After"))
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker. After `threshold` consecutive transient
+    failures a host is "open": requests to it fail fast with CircuitOpen for
+    `cooldown` seconds, after which one trial request is let through
+    (half-open). A success closes the breaker; a failure re-opens it. A
+    trial that ends any other way, or isn't reported within `cooldown`,
+    makes room for the next one.
+    """
+
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._opened = {}
+        self._trial = {}  # host -> when its trial request was let through
+
+    def check(self, host):
+        """Raises CircuitOpen if `host` shouldn't be tried right now."""
+        with self._lock:
+            opened = self._opened.get(host)
+            if opened is None:
+                return
+            now = time.monotonic()
+            waited = now - opened
+            trial = self._trial.get(host)
+            if waited >= self.cooldown and (
+                trial is None or now - trial >= self.cooldown
+            ):
+                self._trial[host] = now  # Half-open: let one request through
+                return
+        raise CircuitOpen(host, max(0.0, self.cooldown - waited))
+
+    def success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._opened.pop(host, None)
+            self._trial.pop(host, None)
+
+    def failure(self, host, weight=1.0):
+        """
+        Counts a transient failure. `weight` below 1 is for callers that
+        send many requests to the host at once, so that one blip seen by all
+        of them at the same moment counts about once.
+        """
+        with self._lock:
+            failures = self._failures.get(host, 0) + weight
+            self._failures[host] = failures
+            trial = self._trial.pop(host, None) is not None
+            if trial or failures >= self.threshold:
+                if host not in self._opened or trial:
+                    metrics.inc("circuit_opened", host=host)
+                self._opened[host] = time.monotonic()
+
+    def release(self, host):
+        """Ends a trial request that neither succeeded nor failed (cancelled)."""
+        with self._lock:
+            self._trial.pop(host, None)
+
+    def is_open(self, host):
+        with self._lock:
+            return host in self._opened
+
+    def reset(self):
+        with self._lock:
+            self._failures.clear()
+            self._opened.clear()
+            self._trial.clear()
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: the wait before retry n is random
+    in [0, min(cap, base * 2**n)], or the server's Retry-After if that is
+    longer (up to `max_retry_after`). Only transient errors are retried.
+    """
+
+    def __init__(
+        self,
+        max_attempts=5,
+        base=1.0,
+        cap=30.0,
+        max_retry_after=300.0,
+        breaker=None,
+        breaker_weight=1.0,
+    ):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.max_retry_after = max_retry_after
+        self.breaker = breaker
+        # Share of a breaker failure each failed attempt counts as
+        self.breaker_weight = breaker_weight
+
+    def delay(self, attempt, error=None):
+        """Seconds to wait after failed attempt number `attempt` (0-based)."""
+        wait = random.uniform(0, min(self.cap, self.base * 2**attempt))
+        server_wait = retry_after(error) if error is not None else None
+        if server_wait is not None:
+            wait = max(wait, min(server_wait, self.max_retry_after))
+        return wait
+
+    def should_retry(self, attempt, error):
+        return attempt + 1 < self.max_attempts and is_transient(error)
+
+    def record(self, host, error=None):
+        """
+        Feeds an outcome to the breaker: None for success, else the error.
+        Any HTTP response that isn't transient (404, 401/403) shows the host
+        is up and counts as a success; other errors (cancellation) only end
+        a half-open trial.
+        """
+        if self.breaker is None or host is None:
+            return
+        if error is None:
+            self.breaker.success(host)
+        elif is_transient(error):
+            self.breaker.failure(host, self.breaker_weight)
+        elif status_of(error) is not None:
+            self.breaker.success(host)
+        else:
+            self.breaker.release(host)
+
+    def check(self, host):
+        if self.breaker is not None and host is not None:
+            self.breaker.check(host)
+
+    def call(self, func, host=None, on_retry=None):
+        """
+        Calls `func()` until it succeeds, retrying transient errors. A
+        requests.Response with a transient status counts as an error (its
+        last one is returned rather than raised once attempts run out).
+        Raises CircuitOpen without calling `func` if `host`'s breaker is open.
+        """
+        for attempt in range(self.max_attempts):
+            self.check(host)
+            try:
+                result = func()
+                if (
+                    isinstance(result, requests.Response)
+                    and result.status_code in TRANSIENT_STATUSES
+                ):
+                    raise RetryableStatus(result)
+            except Exception as e:
+                self.record(host, e)
+                if not self.should_retry(attempt, e):
+                    if isinstance(e, RetryableStatus):
+                        return e.response
+                    raise
+                metrics.inc("retries", host=host)
+                wait = self.delay(attempt, e)
+                if on_retry is not None:
+                    on_retry(attempt, e, wait)
+                time.sleep(wait)
+                continue
+            self.record(host)
+            return result
+
+
+def get(url, session=None, policy=None, **kwargs):
+    """requests.get (or session.get) with the default retry policy."""
+    policy = policy or default_policy
+    return policy.call(
+        lambda: (session or requests).get(url, **kwargs), host=host_of(url)
+    )
+
+
+breakers = CircuitBreaker()
+default_policy = RetryPolicy(breaker=breakers)
+# Segments are also hedged, so they get fewer, shorter retries. A chapter
+# fetches ~10 segments at once, so a blip fails them all together: each
+# failed segment attempt counts as a tenth of a failure.
+SEGMENT_CONNECTIONS = 10
+segment_policy = RetryPolicy(
+    max_attempts=4,
+    base=0.25,
+    cap=4.0,
+    breaker=breakers,
+    breaker_weight=1 / SEGMENT_CONNECTIONS,
+)
@@ -0,0 +1,60 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+ORDERS = ("list", "longest", "listen-first")
+
+
+def chapter_weights(chapters):
+    """
+    Relative weight of every chapter for progress and ETA: expected byte
+    sizes (see preflight.probe_book), or durations, when every chapter has
+    one of the same kind; otherwise 1 each.
+    """
+    for key in ("size", "duration"):
+        values = [chapter.get(key) for chapter in chapters]
+        if values and all(values):
+            return [float(value) for value in values]
+    return [1.0] * len(chapters)
+
+
+def schedule_chapters(chapters, order="list"):
+    """
+    Returns chapter indices in the order they should start.
+
+    "list" keeps the book order. "longest" starts the biggest chapters first,
+    which minimises the total time when chapters run in parallel (the longest
+    one isn't left running alone at the end). "listen-first" keeps the book
+    order so chapter 1 is finished first and playback can start right away.
+    """
+    indices = list(range(len(chapters)))
+    if order == "longest":
+        weights = chapter_weights(chapters)
+        indices.sort(key=lambda index: -weights[index])
+    elif order not in ("list", "listen-first"):
+        raise ValueError(f"Unknown order {order!r}, expected one of {ORDERS}")
+    return indices
+
+
+def run_schedule(indices, work, workers=1, first_alone=False):
+    """
+    Calls `work(index)` for every index, starting them in the given order on
+    up to `workers` threads. With `first_alone`, the first chapter runs on its
+    own (with the whole bandwidth) before the others start.
+    """
+    indices = list(indices)
+    if first_alone and indices:
+        work(indices.pop(0))
+    if workers <= 1:
+        for index in indices:
+            work(index)
+        return
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="chapter"
+    ) as executor:
+        # Each chapter runs in a copy of the caller's context (metrics book label)
+        futures = [
+            executor.submit(contextvars.copy_context().run, work, index)
+            for index in indices
+        ]
+        for future in futures:
+            future.result()
@@ -4,6 +4,8 @@ from typing import Dict, Any, Optional
 import re
 from urllib.parse import urlparse
 
+import retry
+
 
 class BigAudiobooksScraper:
     """
@@ -60,13 +62,26 @@ class BigAudiobooksScraper:
                 "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
                 "Referer": book_url,
             }
-            response = requests.get(book_url, headers=headers, timeout=10)
+            response = retry.get(book_url, headers=headers, timeout=10)
             response.raise_for_status()
             html = response.text
         except requests.exceptions.RequestException as e:
             print(f"Error fetching URL: {e}")
             return {}
 
+        return self.parse_book_data(html, book_url)
+
+    def parse_book_data(self, html: str, book_url: str) -> Dict[str, Any]:
+        """
+        Extracts the book metadata and chapters from an already fetched page.
+
+        Args:
+            html: The HTML of the audiobook page.
+            book_url: The URL the page was fetched from.
+
+        Returns:
+            A dictionary containing the extracted book metadata and chapters.
+        """
         soup = BeautifulSoup(html, "html.parser")
 
         # 1. Extract Title and Author
@@ -108,7 +123,7 @@ class BigAudiobooksScraper:
                 chapters.append({"title": chapter_title, "url": clean_url})
 
         return {
-            "site": expected_domain,
+            "site": "bigaudiobooks.net",
             "book_url": book_url,
             "title": title_info["title"],
             "author": title_info["author"],
@@ -3,6 +3,8 @@ from bs4 import BeautifulSoup
 from typing import Dict, Any, Optional
 import re
 
+import retry
+
 
 class FulllengthAudiobooksScraper:
     """
@@ -52,13 +54,26 @@ class FulllengthAudiobooksScraper:
         # Fetch the HTML content
         print(f"Fetching data from: {book_url}")
         try:
-            response = requests.get(book_url, timeout=10)
+            response = retry.get(book_url, timeout=10)
             response.raise_for_status()  # Raises an HTTPError for bad responses (4xx or 5xx)
             html = response.text
         except requests.exceptions.RequestException as e:
             print(f"Error fetching URL: {e}")
             return {}
 
+        return self.parse_book_data(html, book_url)
+
+    def parse_book_data(self, html: str, book_url: str) -> Dict[str, Any]:
+        """
+        Extracts the book metadata and chapters from an already fetched page.
+
+        Args:
+            html: The HTML of the audiobook page.
+            book_url: The URL the page was fetched from.
+
+        Returns:
+            A dictionary containing the extracted book metadata and chapters.
+        """
         soup = BeautifulSoup(html, "html.parser")
 
         # 1. Extract Title and Author
@@ -4,6 +4,8 @@ from bs4 import BeautifulSoup
 from urllib.parse import urljoin, urlparse, parse_qs
 from rich.console import Console
 
+import retry
+
 
 class GoldenAudiobookScraper:
     """
@@ -12,23 +14,32 @@ class GoldenAudiobookScraper:
     """
 
     BASE_URL = "https://goldenaudiobook.net"
+    USER_AGENT = (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+    )
     console = Console()
 
     def fetch_book_data(self, url):
         """Fetches all necessary book data from a given goldenaudiobook.net URL."""
         self.console.print(f"Fetching data from Golden Audiobook: {url}")
         session = requests.Session()
-        session.headers.update(
-            {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-                "(KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-            }
-        )
+        session.headers.update({"User-Agent": self.USER_AGENT})
 
         try:
-            response = session.get(url)
+            response = retry.get(url, session=session, timeout=30)
             response.raise_for_status()
-            soup = BeautifulSoup(response.text, "html.parser")
+            return self.parse_book_data(response.text, url)
+        except Exception as e:
+            self.console.print(
+                f"[red]Error occurred while scraping Golden Audiobook: {e}[/red]"
+            )
+            return None
+
+    def parse_book_data(self, html, url):
+        """Extracts the book data from an already fetched goldenaudiobook.net page."""
+        try:
+            soup = BeautifulSoup(html, "html.parser")
 
             # --- Extract Title and Author ---
             title_text = soup.find("h1", class_="title-page").text.strip()
@@ -59,7 +70,7 @@ class GoldenAudiobookScraper:
                 "chapters": chapters,
                 "site_headers": {
                     "Referer": "https://goldenaudiobook.net",
-                    "User-Agent": session.headers["User-Agent"],
+                    "User-Agent": self.USER_AGENT,
                     "Accept": "*/*",
                     "Accept-Language": "en-US,en;q=0.9",
                     "Accept-Encoding": "identity;q=1, *;q=0",
@@ -1,10 +1,20 @@
 import requests
+import contextvars
 import json
 import time
 import re
 import os
+import shutil
+import tempfile
+import threading
 from urllib.parse import urlparse, quote
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import hls
+from hedging import AttemptsExhausted, RequestCancelled, latency, run_hedged
+from metrics import metrics, host_of
+from retry import SEGMENT_CONNECTIONS, default_policy, segment_policy
+from throttle import limiter
 
 
 class TokybookScraper:
@@ -12,12 +22,27 @@ class TokybookScraper:
     AUDIO_API_PATH = "/api/v1/public/audio"
     FULL_AUDIO_BASE = f"{BASE_URL}{AUDIO_API_PATH}"
     USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36"
+    # Responses that mean the stream token has expired or been revoked
+    AUTH_FAILURE_STATUSES = (401, 403)
+    _token_lock = threading.Lock()
 
     def fetch_book_data(self, url):
         """
         Scrapes metadata and prepares the chapter list with tokens.
         """
-        slug = self._get_slug(url)
+        data, playlist_data = self._handshake(self._get_slug(url))
+        if data is None:
+            return None
+
+        book_data = self.parse_book_data(data, playlist_data)
+        book_data["book_url"] = url  # Needed to refresh the stream token later
+        return book_data
+
+    def _handshake(self, slug):
+        """
+        Runs the post-details -> playlist handshake.
+        Returns (details, playlist) or (None, None) on failure.
+        """
         session = requests.Session()
         session.headers.update({"user-agent": self.USER_AGENT, "origin": self.BASE_URL})
 
@@ -34,14 +59,16 @@ class TokybookScraper:
         }
 
         try:
-            r = session.post(details_url, json=payload)
+            r = default_policy.call(
+                lambda: session.post(details_url, json=payload),
+                host=host_of(details_url),
+            )
             r.raise_for_status()
             data = r.json()
         except Exception as e:
             print(f"[!] Error fetching details: {e}")
-            return None
+            return None, None
 
-        title = data.get("title")
         audio_book_id = data.get("audioBookId")
         post_detail_token = data.get("postDetailToken")
 
@@ -55,13 +82,23 @@ class TokybookScraper:
         }
 
         try:
-            r = session.post(playlist_url, json=playlist_payload)
+            r = default_policy.call(
+                lambda: session.post(playlist_url, json=playlist_payload),
+                host=host_of(playlist_url),
+            )
             r.raise_for_status()
             playlist_data = r.json()
         except Exception as e:
             print(f"[!] Error fetching playlist: {e}")
-            return None
+            return None, None
+
+        return data, playlist_data
 
+    def parse_book_data(self, data, playlist_data):
+        """
+        Builds the book data from already fetched post-details and playlist responses.
+        """
+        audio_book_id = data.get("audioBookId")
         stream_token = playlist_data.get("streamToken")
         tracks = playlist_data.get("tracks", [])
 
@@ -81,7 +118,7 @@ class TokybookScraper:
             chapter_number += 1
         return {
             "site": "tokybook.com",
-            "title": title,
+            "title": data.get("title"),
             "author": data.get("authors", [{}])[0].get("name")
             if data.get("authors")
             else None,
@@ -101,6 +138,35 @@ class TokybookScraper:
     def _get_slug(self, url):
         return urlparse(url).path.strip("/").split("/")[-1]
 
+    @staticmethod
+    def refresh_stream_token(book_data, expired_token):
+        """
+        Re-runs the handshake to replace an expired stream token in `book_data`.
+
+        Safe to call from many segment workers at once: only the first caller
+        for a given expired token talks to the server, the rest reuse its
+        result. Returns True if `book_data` now holds a newer token.
+        """
+        with TokybookScraper._token_lock:
+            if book_data.get("stream_token") != expired_token:
+                return True
+            if not book_data.get("book_url"):
+                return False
+
+            scraper = TokybookScraper()
+            data, playlist_data = scraper._handshake(
+                scraper._get_slug(book_data["book_url"])
+            )
+            if not playlist_data or not playlist_data.get("streamToken"):
+                return False
+
+            book_data["stream_token"] = playlist_data["streamToken"]
+            book_data["audio_book_id"] = (
+                data.get("audioBookId") or book_data["audio_book_id"]
+            )
+            metrics.inc("token_refreshes", host=host_of(TokybookScraper.BASE_URL))
+            return True
+
     @staticmethod
     def _get_dynamic_headers(full_url, audio_id, stream_token):
         parsed = urlparse(full_url)
@@ -112,69 +178,403 @@ class TokybookScraper:
         }
 
     @staticmethod
-    def _fetch_segment(args):
-        """Worker for ThreadPool"""
-        ts_url, audio_id, stream_token = args
-        headers = TokybookScraper._get_dynamic_headers(ts_url, audio_id, stream_token)
-        try:
-            # Short timeout for segments to fail fast and potentially retry (handled by main exception)
-            r = requests.get(ts_url, headers=headers, timeout=10)
-            if r.status_code == 200:
-                return r.content
-        except Exception:
-            pass
+    def _stream_segment(segment, book_data, write, size=None):
+        """
+        Streams one playlist segment (see hls.parse_playlist), calling
+        write(position, chunk) for every chunk, where position is relative to
+        the start of the segment. Returns the number of bytes received, or
+        None if the segment failed or `write` raised RequestCancelled because
+        another attempt won.
+        """
+        ts_url = segment["url"]
+        host = host_of(ts_url)
+        byte_range = hls.range_header(segment)
+        refreshed = False
+        attempt = 0
+        while True:
+            stream_token = book_data.get("stream_token")
+            headers = TokybookScraper._get_dynamic_headers(
+                ts_url, book_data.get("audio_book_id"), stream_token
+            )
+            if byte_range:
+                headers["Range"] = byte_range
+            start = time.perf_counter()
+            try:
+                # Fail fast while the host's circuit breaker is open
+                segment_policy.check(host)
+                # Read timeout sized from the host's measured throughput
+                timeout = (10, latency.timeout(host, size))
+                with _session().get(
+                    ts_url, headers=headers, timeout=timeout, stream=True
+                ) as r:
+                    if r.status_code == (206 if byte_range else 200):
+                        position = 0
+                        for chunk in r.iter_content(chunk_size=64 * 1024):
+                            limiter.acquire(len(chunk))
+                            write(position, chunk)
+                            position += len(chunk)
+                        elapsed = time.perf_counter() - start
+                        metrics.observe("segment_seconds", elapsed, host=host)
+                        latency.observe(host, elapsed, position)
+                        segment_policy.record(host)
+                        return position
+                    if r.status_code not in TokybookScraper.AUTH_FAILURE_STATUSES:
+                        r.raise_for_status()
+                        raise requests.exceptions.HTTPError(
+                            f"Unexpected status {r.status_code}", response=r
+                        )
+            except RequestCancelled as e:
+                segment_policy.record(host, e)
+                return None
+            except Exception as e:
+                segment_policy.record(host, e)
+                if not segment_policy.should_retry(attempt, e):
+                    break
+                metrics.inc("retries", host=host)
+                time.sleep(segment_policy.delay(attempt, e))
+                attempt += 1
+                continue
+            # The token expired: a second try is only made after refreshing it.
+            # The host did answer, which is all its circuit breaker cares about.
+            segment_policy.record(host)
+            metrics.inc("segment_auth_failures", host=host)
+            if refreshed or not TokybookScraper.refresh_stream_token(
+                book_data, stream_token
+            ):
+                break
+            refreshed = True
+        metrics.inc("segment_failures", host=host)
         return None
 
     @staticmethod
-    def download_chapter(chapter_data, book_data, output_path, progress):
+    def _fetch_segment(args, cancel=None):
         """
-        Specialized downloader for Tokybook that handles m3u8 and parallel segments.
+        Worker for ThreadPool: streams the segment into an anonymous temporary
+        file in `directory`, decrypted on the fly when the playlist gives a
+        key, and returns the file (rewound), or None on failure.
+        """
+        segment, book_data, key, directory = args
+        spool = tempfile.TemporaryFile(dir=directory)
+        decryptor = None
+
+        def write(position, chunk):
+            nonlocal decryptor
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled()
+            if position == 0:
+                # Restarted after a token refresh
+                spool.seek(0)
+                spool.truncate()
+                if key is not None:
+                    decryptor = hls.SegmentDecryptor(key, segment)
+            spool.write(decryptor.update(chunk) if decryptor else chunk)
+
+        try:
+            if TokybookScraper._stream_segment(segment, book_data, write) is None:
+                spool.close()
+                return None
+            if decryptor is not None:
+                spool.write(decryptor.finalize())
+        except (hls.PlaylistError, OSError):
+            spool.close()
+            return None
+        spool.seek(0)
+        return spool
+
+    @staticmethod
+    def _probe_segment_size(args):
         """
-        audio_id = book_data.get("audio_book_id")
-        stream_token = book_data.get("stream_token")
+        Returns the segment's size on disk from a HEAD request (for the
+        preflight's estimates), or None if it can't be known up front
+        (encrypted segments shrink when decrypted).
+        """
+        segment, book_data, key = args
+        if key is not None:
+            return None
+        if segment["byterange"]:
+            return segment["byterange"][0]
+        ts_url = segment["url"]
+        for attempt in range(2):
+            stream_token = book_data.get("stream_token")
+            headers = TokybookScraper._get_dynamic_headers(
+                ts_url, book_data.get("audio_book_id"), stream_token
+            )
+            try:
+                r = _session().head(
+                    ts_url, headers=headers, timeout=10, allow_redirects=True
+                )
+            except requests.exceptions.RequestException:
+                return None
+            if (
+                attempt == 0
+                and r.status_code in TokybookScraper.AUTH_FAILURE_STATUSES
+                and TokybookScraper.refresh_stream_token(book_data, stream_token)
+            ):
+                continue
+            if r.status_code != 200 or r.headers.get("Content-Encoding"):
+                return None
+            try:
+                return int(r.headers["Content-Length"])
+            except (KeyError, ValueError):
+                return None
+        return None
+
+    @staticmethod
+    def _get_with_token(url, book_data, timeout=30):
+        """GET with the stream token headers, refreshing an expired token once."""
+        for attempt in range(2):
+            stream_token = book_data.get("stream_token")
+            headers = TokybookScraper._get_dynamic_headers(
+                url, book_data.get("audio_book_id"), stream_token
+            )
+            with metrics.timer("playlist_seconds", host=host_of(url)):
+                r = default_policy.call(
+                    lambda: requests.get(url, headers=headers, timeout=timeout),
+                    host=host_of(url),
+                )
+            if (
+                attempt == 0
+                and r.status_code in TokybookScraper.AUTH_FAILURE_STATUSES
+                and TokybookScraper.refresh_stream_token(book_data, stream_token)
+            ):
+                continue
+            break
+        return r, stream_token
+
+    @staticmethod
+    def fetch_playlist(chapter_data, book_data):
+        """
+        Fetches and parses a chapter's m3u8 playlist, following a master
+        playlist to its smallest adequate audio variant and fetching any
+        AES-128 keys.
 
+        Returns a dict with the playlist URL, the segments (see
+        hls.parse_playlist), the total duration, the keys by URL and the
+        stream token the playlist was fetched with.
+        """
         # Construct M3U8 URL
         # The chapter['url'] from fetch_book_data is relative path like "ID/Chapter.m3u8"
         # We need to quote it and prepend base
         safe_src = quote(chapter_data["url"])
         m3u8_url = f"{TokybookScraper.FULL_AUDIO_BASE}/{safe_src}"
 
-        headers = TokybookScraper._get_dynamic_headers(m3u8_url, audio_id, stream_token)
-
-        # 1. Get Playlist
-        r = requests.get(m3u8_url, headers=headers)
+        r, stream_token = TokybookScraper._get_with_token(m3u8_url, book_data)
         if r.status_code != 200:
             raise Exception(f"Failed to fetch m3u8: {r.status_code}")
+        playlist = hls.parse_playlist(r.text, m3u8_url)
+
+        if playlist["type"] == "master":
+            m3u8_url = hls.select_variant(playlist)
+            r, stream_token = TokybookScraper._get_with_token(m3u8_url, book_data)
+            if r.status_code != 200:
+                raise Exception(f"Failed to fetch variant m3u8: {r.status_code}")
+            playlist = hls.parse_playlist(r.text, m3u8_url)
+            if playlist["type"] != "media":
+                raise hls.PlaylistError("Variant is not a media playlist")
+
+        keys = {}
+        for segment in playlist["segments"]:
+            key_url = segment["key"] and segment["key"]["url"]
+            if key_url and key_url not in keys:
+                r, _ = TokybookScraper._get_with_token(key_url, book_data)
+                if r.status_code != 200 or len(r.content) != 16:
+                    raise Exception(f"Failed to fetch AES-128 key: {r.status_code}")
+                keys[key_url] = r.content
+
+        return {
+            "url": m3u8_url,
+            "segments": playlist["segments"],
+            "duration": playlist["duration"],
+            "keys": keys,
+            "stream_token": stream_token,
+        }
+
+    @staticmethod
+    def download_chapter(chapter_data, book_data, output, progress, playlist=None):
+        """
+        Specialized downloader for Tokybook that handles m3u8 and parallel segments.
+
+        `output` is a writable binary stream that receives the chapter's
+        MPEG-TS bytes in order (e.g. remux.RemuxStream).
+
+        `playlist` may be a result of fetch_playlist() fetched ahead of time
+        (see TokybookPlaylistPrefetcher). If its segments can't be fetched,
+        the playlist is fetched again once before giving up, and the download carries on
+        from the first segment not yet written.
+        """
+        # 1. Get Playlist
+        prefetched = playlist is not None
+        if playlist is None:
+            playlist = TokybookScraper.fetch_playlist(chapter_data, book_data)
+
+        written = [0]  # Segments already in `output`
+        try:
+            TokybookScraper._download_segments(
+                playlist, book_data, output, progress, written
+            )
+        except (AttemptsExhausted, requests.exceptions.RequestException):
+            # Segments refused (e.g. 403/404 once the playlist's URLs expired).
+            # Errors writing `output` (a failed conversion, a full disk) are
+            # not the playlist's fault and are passed on.
+            if not prefetched:
+                raise
+            progress.log(
+                "[yellow]Prefetched playlist went stale, refetching...[/yellow]"
+            )
+            playlist = TokybookScraper.fetch_playlist(chapter_data, book_data)
+            TokybookScraper._download_segments(
+                playlist, book_data, output, progress, written
+            )
 
-        lines = r.text.splitlines()
-        ts_files = [line for line in lines if not line.startswith("#") and line.strip()]
-        base_segment_url = m3u8_url.rsplit("/", 1)[0]
+    @staticmethod
+    def _download_segments(playlist, book_data, output, progress, written):
+        """
+        Downloads the playlist's segments from `written[0]` on, appending
+        them to `output` in order and counting them in `written`.
+        """
+        m3u8_url = playlist["url"]
+        segments = playlist["segments"][written[0] :]
+        keys = playlist.get("keys", {})
 
         # 2. Prepare Parallel Tasks
-        tasks = []
-        for ts_file in ts_files:
-            if ts_file.startswith("http"):
-                ts_url = ts_file
-            else:
-                ts_url = f"{base_segment_url}/{ts_file}"
-            tasks.append((ts_url, audio_id, stream_token))
+        # Workers read the token from book_data, so a refresh applies to every later segment
+        tasks = [
+            (segment, book_data, segment["key"] and keys[segment["key"]["url"]])
+            for segment in segments
+        ]
 
         # 3. Download
-        progress.log(f"[dim]Downloading {len(ts_files)} segments in parallel...[/dim]")
+        progress.log(f"[dim]Downloading {len(segments)} segments in parallel...[/dim]")
+        # Progress is measured in seconds of audio, so the bar's ETA is meaningful
+        task = progress.add_task(
+            "[dim]Segments[/dim]", total=playlist.get("duration") or len(segments)
+        )
+        done = []
+        host = host_of(m3u8_url)
 
-        downloaded_buffer = []
+        def on_result(index, nbytes):
+            done.append(index)
+            metrics.set_gauge("segment_queue_depth", len(tasks) - len(done), host=host)
+            metrics.inc("bytes_downloaded", nbytes, host=host)
+            progress.advance(task, segments[index]["duration"] or 1)
 
         # Using 10 threads for speed
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            results = executor.map(TokybookScraper._fetch_segment, tasks)
-
-            for chunk in results:
-                if chunk:
-                    downloaded_buffer.append(chunk)
-                else:
-                    raise Exception("Segment download failed")
-
-        # 4. Write to disk
-        with open(output_path, "wb") as f:
-            for chunk in downloaded_buffer:
-                f.write(chunk)
+        executor = ThreadPoolExecutor(max_workers=SEGMENT_CONNECTIONS)
+        try:
+            TokybookScraper._download_segments_spooled(
+                executor, tasks, output, host, on_result, written
+            )
+        finally:
+            # Don't wait for losing attempts still blocked on a slow response
+            executor.shutdown(wait=False)
+            progress.remove_task(task)
+
+    @staticmethod
+    def _download_segments_spooled(executor, tasks, output, host, on_result, written):
+        """
+        Streams every segment to its own temporary file and appends them to
+        `output` in playlist order as soon as the segments before them are
+        complete, so only the segments finished out of order are ever held,
+        and on disk rather than in memory. `written[0]` counts the segments
+        appended, across calls.
+        """
+        # Spooled next to the output file (a stream's `name`, as for files)
+        directory = None
+        if isinstance(getattr(output, "name", None), str):
+            directory = os.path.dirname(os.path.abspath(output.name))
+        jobs = [task + (directory,) for task in tasks]
+        finished = {}
+        appended = 0
+
+        def append(index, spool):
+            nonlocal appended
+            spool.seek(0, os.SEEK_END)
+            on_result(index, spool.tell())
+            spool.seek(0)
+            finished[index] = spool
+            while appended in finished:
+                with finished.pop(appended) as ready:
+                    shutil.copyfileobj(ready, output, 1024 * 1024)
+                appended += 1
+                written[0] += 1
+
+        try:
+            # Hedge slow segments: one stalled request can't hold up the chapter
+            run_hedged(executor, TokybookScraper._fetch_segment, jobs, host, append)
+        finally:
+            for spool in finished.values():
+                spool.close()
+
+_thread_local = threading.local()
+
+
+def _session():
+    """Per-thread requests.Session, so segment workers keep their connections alive."""
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = _thread_local.session = requests.Session()
+    return session
+
+
+class TokybookPlaylistPrefetcher:
+    """
+    Fetches and parses the m3u8 playlists of the next `ahead` chapters in the
+    background while the current chapter downloads, removing a round trip of
+    dead time at every chapter boundary. `order` is the order chapters will
+    be downloaded in (book order by default). `playlists` are playlists
+    already fetched (by the preflight), by chapter index: they are used
+    instead of fetching again.
+    """
+
+    def __init__(self, chapters, book_data, ahead=3, order=None, playlists=None):
+        self.chapters = chapters
+        self.book_data = book_data
+        self.ahead = ahead
+        self.order = list(order) if order is not None else list(range(len(chapters)))
+        self._position = {index: pos for pos, index in enumerate(self.order)}
+        self._futures = {}
+        for index, playlist in (playlists or {}).items():
+            self._futures[index] = Future()
+            self._futures[index].set_result(playlist)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, ahead), thread_name_prefix="m3u8-prefetch"
+        )
+
+    def _schedule(self, index):
+        if 0 <= index < len(self.chapters) and index not in self._futures:
+            # In a copy of the caller's context, for the metrics book label
+            self._futures[index] = self._executor.submit(
+                contextvars.copy_context().run,
+                TokybookScraper.fetch_playlist,
+                self.chapters[index],
+                self.book_data,
+            )
+
+    def get(self, index):
+        """
+        Returns the playlist for chapter `index` (0-based), or None if it has
+        to be fetched synchronously, and starts prefetching the next chapters.
+        """
+        with self._lock:
+            position = self._position.get(index, -1)
+            for upcoming in self.order[position + 1 : position + 1 + self.ahead]:
+                self._schedule(upcoming)
+            future = self._futures.pop(index, None)
+        if future is None:
+            return None
+        try:
+            playlist = future.result()
+        except Exception:
+            return None
+        # Fetched with a token that has since been replaced: don't trust it
+        if playlist["stream_token"] != self.book_data.get("stream_token"):
+            return None
+        return playlist
+
+    def close(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+        self._executor.shutdown(wait=False)
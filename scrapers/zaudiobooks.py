@@ -1,13 +1,15 @@
 import requests
 from bs4 import BeautifulSoup
 
+import retry
+
 
 class ZaudiobooksScraper:
     def fetch_book_data(self, book_url: str) -> dict:
         """
         Scrape audiobook metadata and chapters from a zaudiobooks.com page.
         """
-        response = requests.get(book_url, timeout=30)
+        response = retry.get(book_url, timeout=30)
         response.raise_for_status()
         html = response.text
 
@@ -15,6 +17,12 @@ class ZaudiobooksScraper:
         # with open("website.html", "w", encoding="utf-8") as f:
         #     f.write(html)
 
+        return self.parse_book_data(html, book_url)
+
+    def parse_book_data(self, html: str, book_url: str) -> dict:
+        """
+        Extract audiobook metadata and chapters from an already fetched page.
+        """
         # Extract track info block
         lines = html.splitlines()
         start_index = None
@@ -0,0 +1,411 @@
+import argparse
+import mmap
+import os
+import re
+
+from mutagen.id3 import ID3, ID3NoHeaderError
+from rich.console import Console
+
+from library import INDEX_NAME, Library
+from tagging import tag_chapter
+from utils import parse_duration
+from verify import (
+    TS_PACKET_SIZE,
+    iter_mp3_frames,
+    load_manifest,
+    parse_mp3_frame_header,
+    save_manifest,
+)
+
+console = Console()
+
+
+# --- Frame-boundary indexes ---
+
+
+def mp3_pieces(data, every=None):
+    """
+    Groups the audio frames of an MP3 into consecutive pieces of about
+    `every` seconds (one piece if `every` is None).
+    Returns [(start offset, end offset, seconds)]; ID3 tags and the
+    Xing/Info header frame are left out, since they describe the whole file.
+    """
+    pieces = []
+    start = end = None
+    seconds = 0.0
+    for index, (pos, length, frame_seconds) in enumerate(iter_mp3_frames(data)):
+        if index == 0 and _is_vbr_header(data, pos, length):
+            continue
+        if start is None:
+            start = pos
+        elif every and seconds >= every:
+            pieces.append((start, end, seconds))
+            start, seconds = pos, 0.0
+        end = pos + length
+        seconds += frame_seconds
+    if start is not None:
+        pieces.append((start, end, seconds))
+    return pieces
+
+
+def _is_vbr_header(data, pos, length):
+    # The tag sits right after the side information, within the first 40 bytes
+    head = data[pos : pos + min(length, 48)]
+    return b"Xing" in head or b"Info" in head or b"VBRI" in head
+
+
+def ts_pieces(data, parts):
+    """Splits an MPEG-TS file into `parts` packet-aligned byte ranges."""
+    packets = len(data) // TS_PACKET_SIZE
+    bounds = [round(packets * n / parts) * TS_PACKET_SIZE for n in range(parts + 1)]
+    return [(bounds[n], bounds[n + 1], None) for n in range(parts)]
+
+
+def _copy_range(src, dst, data, offset, length):
+    """
+    Appends `length` bytes of `src` at `offset` to `dst` (opened unbuffered).
+    copy_file_range keeps the copy inside the kernel; elsewhere the bytes are
+    written straight from the mmap without an intermediate copy.
+    """
+    if hasattr(os, "copy_file_range"):
+        try:
+            while length:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), length, offset)
+                if not copied:
+                    break
+                offset += copied
+                length -= copied
+        except OSError:
+            pass
+    if length:
+        dst.write(memoryview(data)[offset : offset + length])
+
+
+def _write_pieces(path, pieces):
+    """Writes `[(source path, [(start, end)])]` as one file, atomically."""
+    tmp = f"{path}.part"
+    with open(tmp, "wb", buffering=0) as dst:
+        for source, ranges in pieces:
+            with (
+                open(source, "rb") as src,
+                mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as data,
+            ):
+                for start, end in ranges:
+                    _copy_range(src, dst, data, start, end - start)
+    os.replace(tmp, path)
+
+
+# --- Book-level operations ---
+
+
+def book_tags(path):
+    """Reads the book-level tags of a chapter back into a `book_data` dict."""
+    try:
+        tags = ID3(path)
+    except ID3NoHeaderError:
+        tags = ID3()
+    book_data = {
+        "title": str(tags.get("TALB", "")) or os.path.basename(os.path.dirname(path)),
+        "author": str(tags.get("TPE1", "")) or None,
+        "narrator": str(tags.get("TPE2", "")) or None,
+        "year": str(tags.get("TDRC", "")) or None,
+    }
+    covers = tags.getall("APIC")
+    if covers:
+        book_data["artwork_data"] = covers[0].data
+        book_data["mime_type"] = covers[0].mime
+    return book_data
+
+
+def ordered_chapters(book_dir):
+    """Chapter file names in track order (falling back to name order)."""
+
+    def track(name):
+        try:
+            trck = str(ID3(os.path.join(book_dir, name)).get("TRCK", ""))
+        except ID3NoHeaderError:
+            trck = ""
+        match = re.match(r"\d+", trck)
+        return (int(match.group()) if match else float("inf"), name)
+
+    names = [
+        name
+        for name in os.listdir(book_dir)
+        if name.lower().endswith((".mp3", ".ts")) and not name.endswith(".part.mp3")
+    ]
+    return sorted(names, key=track)
+
+
+def split_chapter(book_dir, name, every=None, parts=None):
+    """
+    Splits a chapter into parts of about `every` seconds (MP3) or into `parts`
+    equal parts (MP3 or TS). Returns [(new file name, seconds)].
+    """
+    path = os.path.join(book_dir, name)
+    stem, ext = os.path.splitext(name)
+    with (
+        open(path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+    ):
+        if ext.lower() == ".ts":
+            if not parts:
+                raise ValueError("MPEG-TS chapters can only be split with --parts")
+            pieces = ts_pieces(data, parts)
+        else:
+            if parts:
+                total = sum(seconds for _, _, seconds in mp3_pieces(data))
+                every = total / parts
+            pieces = mp3_pieces(data, every)
+    if len(pieces) < 2:
+        return [(name, pieces[0][2] if pieces else None)]
+
+    outputs = []
+    for n, (start, end, seconds) in enumerate(pieces, start=1):
+        out_name = f"{stem} - Part {n}{ext}"
+        _write_pieces(os.path.join(book_dir, out_name), [(path, [(start, end)])])
+        outputs.append((out_name, seconds))
+    os.remove(path)
+    return outputs
+
+
+def plan_merge(book_dir, names, out_name):
+    """
+    Checks that chapters can be concatenated into `out_name` without writing
+    anything. Returns the plan for merge_chapters: (pieces, seconds).
+    Raises ValueError if they can't.
+    """
+    ext = os.path.splitext(out_name)[1].lower()
+    pieces = []
+    seconds = 0.0
+    sample_rate = None
+    for name in names:
+        path = os.path.join(book_dir, name)
+        if os.path.splitext(name)[1].lower() != ext:
+            raise ValueError(f"{name} is not a {ext} file")
+        with (
+            open(path, "rb") as f,
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+        ):
+            if ext == ".ts":
+                ranges = [(0, len(data) - len(data) % TS_PACKET_SIZE)]
+            else:
+                found = mp3_pieces(data)
+                if not found:
+                    raise ValueError(f"{name} has no audio frames")
+                rate = parse_mp3_frame_header(data, found[0][0])[2]
+                if sample_rate not in (None, rate):
+                    raise ValueError(
+                        f"{name} is {rate} Hz, the previous chapters {sample_rate} Hz"
+                    )
+                sample_rate = rate
+                seconds += found[0][2]
+                ranges = [(found[0][0], found[0][1])]
+        pieces.append((path, ranges))
+    return pieces, seconds if ext != ".ts" else None
+
+
+def merge_chapters(book_dir, names, out_name, plan=None):
+    """
+    Concatenates chapters (audio frames or TS packets) into `out_name`,
+    following `plan` from plan_merge if given.
+    """
+    pieces, seconds = plan or plan_merge(book_dir, names, out_name)
+    _write_pieces(os.path.join(book_dir, out_name), pieces)
+    for name in names:
+        if name != out_name:
+            os.remove(os.path.join(book_dir, name))
+    return seconds
+
+
+def chapter_seconds(book_dir, name, manifest):
+    """Recorded duration of a chapter, or measured from its frames."""
+    seconds = (manifest.get(name) or {}).get("duration")
+    if seconds or not name.lower().endswith(".mp3"):
+        return seconds or 0
+    with (
+        open(os.path.join(book_dir, name), "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+    ):
+        return sum(seconds for _, _, seconds in mp3_pieces(data))
+
+
+def retag_book(book_dir, order, book_data, processes=False):
+    """
+    Rewrites titles and "n/total" track numbers for the new chapter list,
+    with `processes` on one process per core (see parallel.py).
+    """
+    jobs = [
+        (os.path.join(book_dir, name), f"{n}/{len(order)}", os.path.splitext(name)[0])
+        for n, name in enumerate(order, start=1)
+        if name.lower().endswith(".mp3")
+    ]
+    if processes:
+        from parallel import tag_chapters
+
+        tag_chapters(jobs, book_data)
+        return
+    for file_name, track, title in jobs:
+        tag_chapter(file_name, book_data, track, title)
+
+
+def update_records(book_dir, removed, added):
+    """
+    Replaces chapter records in the manifest and library index.
+    `added` is [(new file name, seconds, name of the chapter it came from)].
+    """
+    manifest = load_manifest(book_dir)
+    old = {name: manifest.pop(name, None) or {} for name in removed}
+    for name, seconds, source in added:
+        manifest[name] = {"url": old.get(source, {}).get("url"), "duration": seconds}
+    for name, entry in manifest.items():
+        path = os.path.join(book_dir, name)
+        if os.path.exists(path):
+            entry["size"] = os.path.getsize(path)
+    save_manifest(book_dir, manifest)
+
+    # The index of the Audiobooks folder the book is in
+    index = os.path.join(os.path.dirname(os.path.abspath(book_dir)), INDEX_NAME)
+    if not os.path.exists(index):
+        return
+    library = Library(index)
+    for book in library.books_with_title(os.path.basename(book_dir)):
+        for name in removed:
+            library.remove_chapter(book["id"], name)
+        for track, name in enumerate(ordered_chapters(book_dir), start=1):
+            entry = manifest.get(name, {})
+            library.record_chapter(
+                book["id"],
+                name,
+                track=track,
+                title=os.path.splitext(name)[0],
+                url=entry.get("url"),
+                size=entry.get("size"),
+                duration=entry.get("duration"),
+            )
+    library.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Split long chapters or merge short ones without re-encoding."
+    )
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="Retag the chapters on one process per core.",
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+    split = sub.add_parser("split", help="Split chapters into shorter parts.")
+    split.add_argument("book_dir")
+    split.add_argument(
+        "chapters",
+        nargs="*",
+        help="Chapter files to split (default: every chapter longer than --every).",
+    )
+    group = split.add_mutually_exclusive_group(required=True)
+    group.add_argument("--every", help='Part length, e.g. "30m" or "1h".')
+    group.add_argument("--parts", type=int, help="Number of equal parts.")
+    merge = sub.add_parser("merge", help="Merge consecutive chapters.")
+    merge.add_argument("book_dir")
+    merge.add_argument("chapters", nargs="*", help="Chapter files to merge, in order.")
+    merge.add_argument("--output", help="Name of the merged file.")
+    merge.add_argument(
+        "--target",
+        help='Merge every run of consecutive chapters up to this length, e.g. "1h".',
+    )
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.book_dir):
+        console.print(f"[red]Error: {args.book_dir} is not a folder.[/red]")
+        raise SystemExit(2)
+
+    order = ordered_chapters(args.book_dir)
+    if not order:
+        console.print("[red]Error: no chapters found.[/red]")
+        raise SystemExit(2)
+    book_data = book_tags(os.path.join(args.book_dir, order[0]))
+    removed, added = [], []
+    failed = False
+
+    try:
+        if args.command == "split":
+            every = parse_duration(args.every) if args.every else None
+            manifest = load_manifest(args.book_dir)
+            # Chapters without a recorded duration are measured by split_chapter
+            targets = args.chapters or [
+                name
+                for name in order
+                if name.lower().endswith(".mp3")
+                and ((manifest.get(name) or {}).get("duration") or every or 1)
+                >= (every or 0)
+            ]
+            for name in targets:
+                outputs = split_chapter(args.book_dir, name, every, args.parts)
+                if len(outputs) < 2:
+                    continue
+                index = order.index(name)
+                order[index : index + 1] = [out for out, _ in outputs]
+                removed.append(name)
+                added.extend((out, seconds, name) for out, seconds in outputs)
+                console.print(f"[green]Split {name} into {len(outputs)} parts.[/green]")
+        else:
+            if args.target:
+                target = parse_duration(args.target)
+                manifest = load_manifest(args.book_dir)
+                groups, current, length = [], [], 0.0
+                for name in order:
+                    seconds = chapter_seconds(args.book_dir, name, manifest)
+                    if current and length + seconds > target:
+                        groups.append(current)
+                        current, length = [], 0.0
+                    current.append(name)
+                    length += seconds
+                groups.append(current)
+            elif len(args.chapters) >= 2:
+                groups = [args.chapters]
+            else:
+                console.print(
+                    "[red]Error: give two chapters or more, or --target.[/red]"
+                )
+                raise SystemExit(2)
+
+            # Every group is checked first, so a bad one can't leave the book
+            # half merged
+            merges = []
+            for group in groups:
+                if len(group) < 2:
+                    continue
+                ext = os.path.splitext(group[0])[1]
+                out_name = (
+                    args.output
+                    if args.output and len(groups) == 1
+                    else f"{os.path.splitext(group[0])[0]} - "
+                    f"{os.path.splitext(group[-1])[0]}{ext}"
+                )
+                merges.append(
+                    (group, out_name, plan_merge(args.book_dir, group, out_name))
+                )
+            for group, out_name, plan in merges:
+                seconds = merge_chapters(args.book_dir, group, out_name, plan)
+                index = order.index(group[0])
+                order[index : index + len(group)] = [out_name]
+                removed.extend(group)
+                added.append((out_name, seconds, group[0]))
+                console.print(
+                    f"[green]Merged {len(group)} chapters into {out_name}.[/green]"
+                )
+    except (OSError, ValueError) as e:
+        # Chapters already split or merged are still retagged and recorded below
+        console.print(f"[red]Error: {e}[/red]")
+        failed = True
+
+    if not added:
+        if not failed:
+            console.print("[yellow]Nothing to do.[/yellow]")
+        raise SystemExit(1 if failed else 0)
+
+    retag_book(args.book_dir, order, book_data, args.processes)
+    update_records(args.book_dir, removed, added)
+    console.print(f"[bold green]Retagged {len(order)} chapters.[/bold green]")
+    if failed:
+        raise SystemExit(1)
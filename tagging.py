@@ -0,0 +1,48 @@
+from mutagen.id3 import (
+    APIC,
+    ID3,
+    TALB,
+    TCON,
+    TDRC,
+    TIT2,
+    TPE1,
+    TPE2,
+    TRCK,
+    ID3NoHeaderError,
+)
+
+
+def tag_chapter(file_name, book_data, track, chapter_title):
+    """Writes the book's ID3 tags into a chapter MP3. `track` is "n/total"."""
+    author_name = book_data.get("author")
+    narrator_name = book_data.get("narrator")
+    year_text = book_data.get("year")
+    artwork_data = book_data.get("artwork_data")
+    mime_type = book_data.get("mime_type")
+
+    try:
+        audio = ID3(file_name)
+    except ID3NoHeaderError:
+        audio = ID3()
+
+    audio.add(TALB(encoding=3, text=book_data["title"]))
+    audio.add(TCON(encoding=3, text="Audiobook"))
+    audio.add(TRCK(encoding=3, text=track))
+    audio.add(TIT2(encoding=3, text=chapter_title))
+    if author_name:
+        audio.add(TPE1(encoding=3, text=author_name))
+    if narrator_name:
+        audio.add(TPE2(encoding=3, text=narrator_name))
+    if year_text:
+        audio.add(TDRC(encoding=3, text=year_text))
+    if artwork_data and mime_type:
+        audio.add(
+            APIC(
+                encoding=3,
+                mime=mime_type,
+                type=3,
+                desc="Cover",
+                data=artwork_data,
+            )
+        )
+    audio.save(file_name, v2_version=3)
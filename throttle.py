@@ -0,0 +1,173 @@
+import collections
+import contextlib
+import contextvars
+import os
+import threading
+import time
+
+from utils import parse_size
+
+
+_consumer = contextvars.ContextVar("throttle_consumer", default=None)
+
+
+class _Waiter:
+    __slots__ = ("n", "granted")
+
+    def __init__(self, n):
+        self.n = n
+        self.granted = False
+
+
+class BandwidthLimiter:
+    """
+    Global token bucket over bytes, shared by every download stream.
+
+    Streams call `acquire(len(chunk))` for each chunk they receive. Waiting
+    chunks are queued per consumer (a chapter, see `consumer()`), and the
+    next chunk always goes to the waiting consumer that has been served the
+    fewest bytes (fair queueing), so chapters get an equal share whatever
+    their chunk size or number of parallel streams. A consumer that was idle
+    starts level with the others rather than with saved-up credit. The rate
+    can be changed at any time with `set_rate()`; `None` or 0 means unlimited.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self._cond = threading.Condition()
+        self._queues = {}  # consumer -> deque of waiters
+        self._served = {}  # consumer -> bytes granted (virtual time)
+        self._vtime = 0.0
+        self._listeners = []
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self.rate = None
+        self.burst = 0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """Changes the limit (bytes/sec) for all current and future streams."""
+        with self._cond:
+            self._refill()
+            self.rate = rate or None
+            # Default burst: a quarter second of traffic, at least one 64 KiB chunk
+            self.burst = burst or (max(int(rate) // 4, 64 * 1024) if rate else 0)
+            self._tokens = min(self._tokens, self.burst)
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener(self.rate)
+
+    def add_listener(self, listener):
+        """Calls `listener(rate)` whenever the rate changes (for yt-dlp)."""
+        with self._cond:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._cond:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    @contextlib.contextmanager
+    def consumer(self, key):
+        """Chunks acquired in this context (and threads copying it) share `key`'s turn."""
+        token = _consumer.set(key)
+        try:
+            yield
+        finally:
+            _consumer.reset(token)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+        self._last = now
+
+    def _next(self):
+        """The waiting consumer served least so far."""
+        return min(self._queues, key=self._served.__getitem__)
+
+    def _dispatch(self):
+        """Grants waiting chunks, least-served consumer first, while tokens last."""
+        granted = False
+        while self._queues:
+            key = self._next()
+            queue = self._queues[key]
+            waiter = queue[0]
+            # Chunks larger than the burst are allowed to go into debt
+            if self._tokens < min(waiter.n, self.burst):
+                break
+            self._vtime = self._served[key]
+            self._served[key] += waiter.n
+            self._tokens -= waiter.n
+            waiter.granted = granted = True
+            queue.popleft()
+            if not queue:
+                self._retire(key)
+        if granted:
+            self._cond.notify_all()
+
+    def _retire(self, key):
+        del self._queues[key]
+        # Idle consumers at or behind the virtual time would rejoin there anyway
+        for idle in [k for k in self._served if k not in self._queues]:
+            if self._served[idle] <= self._vtime:
+                del self._served[idle]
+
+    def acquire(self, n):
+        """Blocks until `n` bytes may be consumed."""
+        if not self.rate:
+            return
+        key = _consumer.get()
+        waiter = _Waiter(n)
+        with self._cond:
+            if key not in self._queues:
+                self._queues[key] = collections.deque()
+                self._served[key] = max(self._served.get(key, 0.0), self._vtime)
+            self._queues[key].append(waiter)
+            try:
+                while not waiter.granted:
+                    if not self.rate:
+                        return
+                    self._refill()
+                    self._dispatch()
+                    if waiter.granted:
+                        return
+                    head = self._queues[self._next()][0]
+                    needed = min(head.n, self.burst) - self._tokens
+                    self._cond.wait(min(max(needed / self.rate, 0.001), 0.1))
+            finally:
+                queue = self._queues.get(key)
+                if queue is not None and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        self._retire(key)
+                self._cond.notify_all()
+
+    def watch_file(self, path, interval=2.0):
+        """
+        Re-reads the rate (e.g. "500K", "2M", "0" for unlimited) from `path`
+        every `interval` seconds, so the limit can be adjusted mid-run.
+        """
+
+        def watch():
+            last_mtime = None
+            while True:
+                try:
+                    mtime = os.path.getmtime(path)
+                    if mtime != last_mtime:
+                        last_mtime = mtime
+                        with open(path) as f:
+                            self.set_rate(parse_size(f.read().strip()))
+                except (OSError, ValueError):
+                    pass
+                time.sleep(interval)
+
+        thread = threading.Thread(target=watch, daemon=True)
+        thread.start()
+        return thread
+
+
+# Process-wide limiter shared by every download path
+limiter = BandwidthLimiter()
@@ -1,4 +1,5 @@
 import re
+from urllib.parse import urlparse
 
 
 def sanitize_book_title(title, max_length=200):
@@ -102,6 +103,52 @@ def parse_chapter_ranges(selection_str, max_chapters):
     return sorted(list(indices))
 
 
+def is_direct_mp3_url(url):
+    """
+    Returns True if the URL points straight at an MP3 file that can be
+    streamed to disk as-is, without yt-dlp extraction or re-encoding.
+    """
+    if not url:
+        return False
+    parsed = urlparse(url)
+    return parsed.scheme in ("http", "https") and parsed.path.lower().endswith(
+        ".mp3"
+    )
+
+
+def parse_size(size_str):
+    """
+    Parses a human-readable byte size such as "500K", "2M", "1.5G" or "8192"
+    (binary multiples) and returns the number of bytes as an int.
+    Returns None for "", "0" or "none".
+    """
+    size_str = (size_str or "").strip().upper().rstrip("B").rstrip("I")
+    if size_str in ("", "0", "NONE"):
+        return None
+    multipliers = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    if size_str[-1] in multipliers:
+        return int(float(size_str[:-1]) * multipliers[size_str[-1]])
+    return int(float(size_str))
+
+
+def parse_duration(duration_str):
+    """
+    Parses a duration such as "90", "45m", "1h30m", "1h 30m 15s" or "1:30:00"
+    and returns the number of seconds as a float. Plain numbers are seconds.
+    """
+    duration_str = duration_str.strip().lower()
+    if ":" in duration_str:
+        seconds = 0.0
+        for part in duration_str.split(":"):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    parts = re.findall(r"(\d+(?:\.\d+)?)\s*([hms]?)", duration_str)
+    if not parts or re.sub(r"[\d.\shms]", "", duration_str):
+        raise ValueError(f"Invalid duration: {duration_str!r}")
+    units = {"h": 3600, "m": 60, "s": 1, "": 1}
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
 # --- Example Usage ---
 if __name__ == "__main__":
     from rich.console import Console
@@ -0,0 +1,329 @@
+import argparse
+import json
+import mmap
+import os
+import socket
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from rich.console import Console
+from rich.table import Table
+
+console = Console()
+
+MANIFEST_NAME = ".manifest.json"
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+
+# Bitrates in kbps, indexed by [version is MPEG1][layer][bitrate index]
+_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Sample rates indexed by the 2-bit version id (0 = MPEG2.5, 2 = MPEG2, 3 = MPEG1)
+_SAMPLE_RATES = {
+    0: (11025, 12000, 8000),
+    2: (22050, 24000, 16000),
+    3: (44100, 48000, 32000),
+}
+
+
+# --- Frame walking ---
+
+
+def parse_mp3_frame_header(data, pos):
+    """
+    Decodes the MPEG audio frame header at `pos`.
+    Returns (frame_length, samples, sample_rate) or None if it isn't a valid header.
+    """
+    if pos + 4 > len(data) or data[pos] != 0xFF or data[pos + 1] & 0xE0 != 0xE0:
+        return None
+    b1, b2 = data[pos + 1], data[pos + 2]
+    version = (b1 >> 3) & 0x03
+    layer = 4 - ((b1 >> 1) & 0x03)  # 1, 2 or 3 (4 means reserved)
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 0x03
+    padding = (b2 >> 1) & 0x01
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = _BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    if layer == 3 and not mpeg1:
+        return 72 * bitrate // sample_rate + padding, 576, sample_rate
+    return 144 * bitrate // sample_rate + padding, 1152, sample_rate
+
+
+def id3v2_size(data):
+    """Returns the size of a leading ID3v2 tag (header included), or 0."""
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = 0
+    for byte in data[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def iter_mp3_frames(data, stats=None):
+    """
+    Yields (offset, length, seconds) for every complete MPEG audio frame in an
+    MP3 file's bytes, skipping ID3 tags and resynchronising over junk.
+
+    If a `stats` dict is given, it receives `skipped` (bytes of non-audio data)
+    and `missing` (how many bytes the last frame is short by).
+    """
+    stats = stats if stats is not None else {}
+    stats.update(skipped=0, missing=0)
+    pos = id3v2_size(data)
+    end = len(data)
+    if end - pos >= 128 and data[end - 128 : end - 125] == b"TAG":
+        end -= 128  # ID3v1 tag
+
+    while pos + 4 <= end:
+        header = parse_mp3_frame_header(data, pos)
+        if header is None:
+            # Lost sync: look for the next plausible frame header
+            next_pos = data.find(b"\xff", pos + 1, end)
+            if next_pos == -1:
+                stats["skipped"] += end - pos
+                return
+            stats["skipped"] += next_pos - pos
+            pos = next_pos
+            continue
+        length, samples, sample_rate = header
+        if pos + length > end:
+            stats["missing"] = pos + length - end
+            return
+        yield pos, length, samples / sample_rate
+        pos += length
+    stats["skipped"] += end - pos
+
+
+def walk_mp3_frames(data):
+    """
+    Walks the MPEG frame headers of an MP3 file's bytes without decoding audio.
+
+    Returns a dict with the frame count, duration in seconds, bytes skipped
+    while resynchronising, and `missing` - how many bytes the last frame is
+    short by (non-zero means the file is truncated).
+    """
+    stats = {}
+    frames = 0
+    duration = 0.0
+    for _, _, seconds in iter_mp3_frames(data, stats):
+        frames += 1
+        duration += seconds
+    return {"frames": frames, "duration": duration, **stats}
+
+
+def check_ts(data):
+    """Checks MPEG-TS packet alignment. Returns a list of problems (empty if fine)."""
+    problems = []
+    if len(data) % TS_PACKET_SIZE:
+        problems.append(
+            f"size is not a multiple of {TS_PACKET_SIZE} "
+            f"({len(data) % TS_PACKET_SIZE} trailing bytes)"
+        )
+    sync = data[::TS_PACKET_SIZE]
+    bad = len(sync) - sync.count(bytes([TS_SYNC_BYTE]))
+    if bad:
+        problems.append(f"{bad} packets without sync byte")
+    return problems
+
+
+def ffprobe_duration(path, timeout=15):
+    """Returns the duration ffprobe reports for `path`, or None."""
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration",
+                "-of",
+                "default=noprint_wrappers=1:nokey=1",
+                path,
+            ],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+        return float(result.stdout.strip())
+    except (OSError, subprocess.TimeoutExpired, ValueError):
+        return None
+
+
+# --- Manifest (written by the downloader) ---
+
+
+def load_manifest(book_dir):
+    """Returns {file name: {"url", "size", "duration"}} for a book."""
+    try:
+        with open(os.path.join(book_dir, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(book_dir, manifest):
+    path = os.path.join(book_dir, MANIFEST_NAME)
+    # Unique per writer, so concurrent writers never share a temporary file
+    tmp = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, path)
+
+
+# --- Verification ---
+
+
+def verify_chapter(path, entry=None, use_ffprobe=False, duration_tolerance=0.02):
+    """
+    Checks one chapter file. `entry` is its manifest record, if any.
+    Returns a list of problems; an empty list means the chapter looks complete.
+    """
+    entry = entry or {}
+    problems = []
+    size = os.path.getsize(path)
+    if size == 0:
+        return ["empty file"]
+    if entry.get("size") is not None and size != entry["size"]:
+        problems.append(f"size {size} != recorded {entry['size']}")
+
+    with (
+        open(path, "rb") as f,
+        mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data,
+    ):
+        if path.lower().endswith(".ts"):
+            problems.extend(check_ts(data))
+            duration = None
+        else:
+            walk = walk_mp3_frames(data)
+            duration = walk["duration"]
+            if walk["frames"] == 0:
+                problems.append("no MPEG audio frames found")
+            if walk["missing"]:
+                problems.append(
+                    f"truncated: last frame is {walk['missing']} bytes short"
+                )
+            if walk["skipped"] > max(4096, size // 100):
+                problems.append(f"{walk['skipped']} bytes of non-audio data")
+
+    expected = entry.get("duration")
+    if expected:
+        if use_ffprobe:
+            duration = ffprobe_duration(path)
+        if duration is not None and duration < expected * (1 - duration_tolerance):
+            problems.append(f"duration {duration:.0f}s < expected {expected:.0f}s")
+    return problems
+
+
+def quick_check(path, entry=None):
+    """
+    Cheap check used before skipping an existing chapter: the recorded size
+    when there is one, otherwise a frame walk.
+    """
+    if entry and entry.get("size") is not None:
+        return os.path.getsize(path) == entry["size"]
+    return not verify_chapter(path)
+
+
+def iter_chapters(root):
+    """Yields (book_dir, file_name) for every chapter under `root`."""
+    book_dirs = [root] if os.path.exists(os.path.join(root, MANIFEST_NAME)) else []
+    if not book_dirs:
+        book_dirs = [
+            entry.path
+            for entry in os.scandir(root)
+            if entry.is_dir() and not entry.name.startswith(".")
+        ]
+    for book_dir in sorted(book_dirs):
+        for name in sorted(os.listdir(book_dir)):
+            if name.lower().endswith((".mp3", ".ts")):
+                yield book_dir, name
+
+
+def verify_library(root, use_ffprobe=False, workers=None, processes=False):
+    """
+    Verifies every chapter under `root` in parallel, on threads or, with
+    `processes`, on a process per core (the frame walk is pure Python).
+    Returns (number checked, [(path, problems)] for the bad ones).
+    """
+    manifests = {}
+    jobs = []
+    for book_dir, name in iter_chapters(root):
+        if book_dir not in manifests:
+            manifests[book_dir] = load_manifest(book_dir)
+        jobs.append((os.path.join(book_dir, name), manifests[book_dir].get(name)))
+
+    if processes:
+        from parallel import verify_chapters
+
+        problems = verify_chapters(jobs, use_ffprobe, workers)
+        results = zip((path for path, _ in jobs), problems)
+        return len(jobs), [(path, problems) for path, problems in results if problems]
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        results = executor.map(
+            lambda job: (job[0], verify_chapter(job[0], job[1], use_ffprobe)), jobs
+        )
+        return len(jobs), [(path, problems) for path, problems in results if problems]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Verify downloaded chapters without decoding them."
+    )
+    parser.add_argument(
+        "root", nargs="?", default="Audiobooks", help="Library or single book folder."
+    )
+    parser.add_argument(
+        "--ffprobe",
+        action="store_true",
+        help="Also compare ffprobe's duration with the recorded one (slower).",
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--processes",
+        action="store_true",
+        help="Check on one process per core instead of threads.",
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        help="Delete flagged chapters so the next download run re-fetches them.",
+    )
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        console.print(f"[red]Error: {args.root} is not a folder.[/red]")
+        raise SystemExit(2)
+
+    checked, bad = verify_library(
+        args.root, args.ffprobe, args.workers, args.processes
+    )
+    if not bad:
+        console.print(f"[bold green]All {checked} chapters look complete.[/bold green]")
+        raise SystemExit(0)
+
+    table = Table(title=f"{len(bad)} of {checked} chapters need re-fetching")
+    table.add_column("Chapter", style="cyan")
+    table.add_column("Problems", style="red")
+    for path, problems in bad:
+        table.add_row(os.path.relpath(path, args.root), "; ".join(problems))
+    console.print(table)
+
+    if args.delete:
+        for path, _ in bad:
+            os.remove(path)
+        console.print(f"[yellow]Deleted {len(bad)} chapters.[/yellow]")
+    raise SystemExit(1)
@@ -0,0 +1,89 @@
+import os
+import threading
+
+from yt_dlp import YoutubeDL
+from yt_dlp.utils import DownloadError
+
+from throttle import limiter
+
+
+class YtdlpWorker:
+    """
+    Long-lived in-process yt-dlp downloader.
+
+    A single YoutubeDL instance is created per book and reused for every
+    chapter, so the extractors, HTTP session and configuration are only set
+    up once. Download progress is reported straight into a rich Progress bar.
+    """
+
+    def __init__(self, headers=None, progress=None, retries=5):
+        self.progress = progress
+        self._task = None
+        self._lock = threading.Lock()
+        self._ydl = YoutubeDL(
+            {
+                "format": "bestaudio/best",
+                "outtmpl": {"default": "%(title)s.%(ext)s"},
+                "retries": retries,
+                "fragment_retries": retries,
+                "http_headers": dict(headers or {}),
+                "quiet": True,
+                "no_warnings": True,
+                "noprogress": True,
+                "overwrites": True,
+                "progress_hooks": [self._progress_hook],
+                # yt-dlp throttles itself; it can't share the global token bucket,
+                # but follows its rate as it changes (see _set_rate)
+                "ratelimit": limiter.rate,
+                "postprocessors": [
+                    {
+                        "key": "FFmpegExtractAudio",
+                        "preferredcodec": "mp3",
+                        "preferredquality": "0",
+                    }
+                ],
+            }
+        )
+        limiter.add_listener(self._set_rate)
+
+    def _set_rate(self, rate):
+        # yt-dlp's downloaders read this dict on every block, so it applies mid-chapter
+        self._ydl.params["ratelimit"] = rate
+
+    def _progress_hook(self, d):
+        if self.progress is None or self._task is None:
+            return
+        total = d.get("total_bytes") or d.get("total_bytes_estimate")
+        if d.get("status") == "downloading":
+            self.progress.update(
+                self._task, completed=d.get("downloaded_bytes") or 0, total=total
+            )
+        elif d.get("status") == "finished":
+            self.progress.update(self._task, completed=total or 1, total=total or 1)
+
+    def download(self, link, book_dir, chapter_title):
+        """
+        Downloads a chapter and converts it to "<book_dir>/<chapter_title>.mp3".
+        Returns True on success.
+        """
+        # YoutubeDL is not thread-safe, so chapters sharing a worker are serialised
+        with self._lock:
+            self._ydl.params["outtmpl"]["default"] = os.path.join(
+                book_dir, f"{chapter_title}.%(ext)s"
+            )
+            if self.progress is not None:
+                self._task = self.progress.add_task(
+                    f"[dim]{chapter_title}[/dim]", total=None
+                )
+            try:
+                return self._ydl.download([link]) == 0
+            except DownloadError:
+                return False
+            finally:
+                if self._task is not None:
+                    self.progress.remove_task(self._task)
+                    self._task = None
+
+    def close(self):
+        limiter.remove_listener(self._set_rate)
+        self._ydl.close()